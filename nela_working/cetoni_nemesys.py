@@ -8,6 +8,7 @@
 
 from bliss.controllers.motor import Controller
 from bliss.controllers.motors.pyNemesys_linux import Nemesys
+from bliss.controllers.motors.pyNemesys_progress import make_progress
 from bliss.comm.util import get_comm
 
 
@@ -22,28 +23,58 @@ class Cetoni_Nemesys(Controller):
         self._node = config.get("node")
         self._stroke = config.get("syringe_stroke")
         self._diameter = config.get("syringe_diameter")
-        self._volume = (self._diameter/2)**2 * 3.14 * self._stroke    
-        self.pump = Nemesys(self._node, b'/dev/ttyS4' , self._stroke, self._diameter)
-        self.state()
+        self._snapshot_ttl = config.get("snapshot_ttl", 0.2)
+        self._backend = config.get("backend") # "sim" for the simulated EPOS2 library
+        self._poll_rate = config.get("poll_rate") # snapshots/s shared by all the pumps on the bus, no background polling if not set
+        self._valve_pulse = config.get("valve_pulse") # s the valve power output stays on, actuation time plus margin
+        self._progress = config.get("progress", "console") # console, logger, bliss (event "progress" from the controller) or none
+        self._progress_rate = config.get("progress_rate") # reports/s while moving, reporter default if not set
+        self._pump = None # connected on first hardware access, see pump
+
+    @property
+    def pump(self):
+        if self._pump is None:
+            self._connect()
+        return self._pump
+
+    # Open the bus (or share the handle already open on the port) and enable the drive only if it is not enabled yet
+    def _connect(self):
+        self._pump = Nemesys(self._node, b'/dev/ttyS4', self._stroke, self._diameter, snapshot_ttl = self._snapshot_ttl, backend = self._backend, warm = True,
+                             progress = make_progress(self._progress, self._progress_rate, sender = self))
+        if self._valve_pulse is not None:
+            self._pump.valve_pulse = self._valve_pulse
+        if self._poll_rate:
+            self._pump._poll(self._poll_rate)
 
     def _initialize(self):
-        return self.pump._nemesys_init()
+        if self._pump is not None: # "enable" from Daiquiri: clear the faults and enable the drive
+            return self._pump._nemesys_init()
+        return 0 # nothing to do until the pump is used
     
     def finalize(self):
-        self.pump._nemesys_disable()
-        self.pump._bus_close()
-        self.pump = []
+        if self._pump is not None:
+            self._pump._nemesys_disable()
+            self._pump._bus_close()
+            self._pump = None
         return 0
 
     def initialize_axis(self):   
-        self.pump = Nemesys(self._node, b'/dev/ttyS4', self._stroke, self._diameter)
-        return self.state()
+        if self._pump is not None and self._pump.bus is not None:
+            self._pump._ensure_enabled() # re-initialisation reuses the open handle and the enabled drive
+        return 0
+
+    def reconnect(self):
+        """reopen the bus handle without homing again or re-reading the conversion objects"""
+        if self._pump is None:
+            self._connect()
+            return 0
+        return self._pump._reconnect()
 
     def get_axis_info(self):
         return self.pump._pump_state()
 
     def read_position(self):
-        return self.pump._get_position()/self.pump.ul
+        return self.pump._get_position(cached = True)/self.pump.ul
 
     def set_position(self, new_position):
         self.pump._move_at_set_speed(new_position)
@@ -59,34 +90,32 @@ class Cetoni_Nemesys(Controller):
         return self.pump._get_set_speed()
 
     def read_inst_velocity(self):
-        return self.pump._get_velocity()/self.pump.uls
+        return self.pump._get_velocity(cached = True)/self.pump.uls
 
     def set_velocity(self, new_velocity):
         self.pump._set_speed(new_velocity)
         return self.pump._get_set_speed()
 
     def state(self):
-        return self.pump._get_state()
+        return self.pump._get_state(cached = True)
 
     def start_one(self):
         pass
     
     def aspirate(self, new_values, wait = False):
         """new_values = list[volume to aspirate, flow rate]"""
-        if self.is_valve_open():
-            self.switch_valve()
+        self.pump._set_valve(False)
 
         curr_vol = int(self.pump._get_position()/self.pump.ul)
         new_vol = -abs(new_values[0])
-        if (curr_vol + new_vol) >= round(-self._volume // 1):
+        if (curr_vol + new_vol) >= round(-self.pump._syringe_volume() // 1):
             self.pump._move_to_position_speed((curr_vol + new_vol), new_values[1], wait)
         else:
             print("\nThe syringe is too full, aspirate less or empty it!\n")
 
     def dose(self, new_values, wait = False):
         """new_values = list[volume to dose, flow rate]"""
-        if self.is_valve_open() == False:
-            self.switch_valve()
+        self.pump._set_valve(True)
 
         curr_vol = int(self.pump._get_position()/self.pump.ul)
         new_vol = abs(new_values[0])
@@ -95,23 +124,51 @@ class Cetoni_Nemesys(Controller):
         else:
             print("\nThe syringe does not contain enough liquid, dose less or fill it up!\n")
     
+    def start_flow(self, rate, volume = None):
+        """rate in ul/s, > 0 doses and < 0 aspirates, stops by itself after volume ul or at the end of the syringe"""
+        self.pump._set_valve(rate > 0)
+        return self.pump.start_flow(rate, volume)
+
+    def set_flow(self, rate):
+        """change the rate of the running flow, same direction only since the valve is not switched"""
+        if self.pump._flow is not None and (rate > 0) != (self.pump._flow[0] > 0):
+            print("\nStop the flow before reversing it!\n")
+            return -1
+        return self.pump.set_flow(rate)
+
+    def stop_flow(self):
+        return self.pump.stop_flow()
+
     def stop(self):
         self.pump._halt()
         
-    def home(self):
+    def home(self, skip_referenced = False):
+        """homing at the positive limit switch, skip_referenced keeps a drive still referenced since the last homing"""
+        if skip_referenced and (self.pump.restored or self.pump._is_referenced()):
+            return 0
         return self.pump._reference_pos_lim(wait = False)
+
+    def persisted_state(self):
+        """state kept across restarts: referenced, position, fill_ul, profile, valve and restored (confirmed by the drive)"""
+        return self.pump._persisted_state()
     
     def home_neg_lim(self):
         return self.pump._reference_neg_lim(wait = False)
     
     def is_moving(self):
-        return self.pump._is_moving()
+        return self.pump._is_moving(cached = True)
     
     def is_target_reached(self):
-        return self.pump._is_target_reached()
+        return self.pump._is_target_reached(cached = True)
     
     def is_valve_open(self):
-        return self.pump._is_valve_open()
+        return self.pump._is_valve_open(cached = True)
     
     def switch_valve(self):
         return self.pump._switch_valve()
+
+    def open_valve(self, confirm = False):
+        return self.pump._set_valve(True, confirm)
+
+    def close_valve(self, confirm = False):
+        return self.pump._set_valve(False, confirm)
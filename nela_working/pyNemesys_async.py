@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the bliss project
+#
+# Copyright (c) 2015-2023 Beamline Control Unit, ESRF
+# Distributed under the GNU LGPLv3. See LICENSE for more info.
+# Author: Antonino Calio'
+#
+# asyncio API of the Nemesys driver. Every VCS_* transaction runs on the single worker thread of its bus,
+# waits (valve pulses, motion completion) are event loop sleeps, so any number of pumps progress in one loop:
+#
+#   pumps = [AsyncNemesys(Nemesys(node)) for node in (2, 3)]
+#   await asyncio.gather(*(pump.home() for pump in pumps))
+#   await asyncio.gather(*(pump.aspirate(50, 50) for pump in pumps))
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .pyNemesys_linux import Nemesys
+except ImportError:
+    from pyNemesys_linux import Nemesys
+
+_executors_lock = threading.Lock()
+
+# Single worker executor of a bus, created on first use and shut down when the bus handle is closed
+def bus_executor(bus):
+    with _executors_lock:
+        if bus.executor is None:
+            bus.executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "nemesys-%s" % bus.port.decode(errors = "replace"))
+        return bus.executor
+
+
+# Async façade over a Nemesys pump or a Cetoni_Nemesys controller
+class AsyncNemesys:
+
+    def __init__(self, pump):
+        self._controller = None if isinstance(pump, Nemesys) else pump # the controller rebuilds its pump on initialize_axis
+        self._pump = pump if isinstance(pump, Nemesys) else None
+
+    @property
+    def pump(self):
+        return self._pump if self._controller is None else self._controller.pump
+
+    @property
+    def nodeID(self):
+        return self.pump.nodeID
+
+    # Run a blocking driver call on the bus worker
+    def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(bus_executor(self.pump.bus), functools.partial(method, *args, **kwargs))
+
+    async def move(self, position, speed, timeout = None):
+        """Move to position ul at speed ul/s, returns the MotionResult or None if the move was refused"""
+        pump = self.pump
+        if speed == 0:
+            await self.halt()
+            return None
+        if await self._run(pump._prepare_move, position, speed) != 0:
+            return None
+        target, estimate = pump._pending
+        if await self._run(pump._start_move) != 0:
+            return None
+        return await self._wait_motion(estimate, timeout, target = target)
+
+    async def home(self, negative = False, timeout = None):
+        """Homing at the positive limit switch, or at the negative one"""
+        pump = self.pump
+        reference = pump._reference_neg_lim if negative else pump._reference_pos_lim
+        if await self._run(reference, wait = False) != 0:
+            return None
+        return await self._wait_motion(timeout = timeout, homing = True)
+
+    async def aspirate(self, volume, rate, timeout = None):
+        """Aspirate volume ul at rate ul/s through the closed valve"""
+        pump = self.pump
+        await self.set_valve(False)
+        curr_vol = int(await self._run(pump._get_position)/pump.ul)
+        new_vol = -abs(volume)
+        if (curr_vol + new_vol) < round(-pump._syringe_volume() // 1):
+            print("\nThe syringe is too full, aspirate less or empty it!\n")
+            return None
+        return await self.move(curr_vol + new_vol, rate, timeout)
+
+    async def dose(self, volume, rate, timeout = None):
+        """Dose volume ul at rate ul/s through the open valve"""
+        pump = self.pump
+        await self.set_valve(True)
+        curr_vol = int(await self._run(pump._get_position)/pump.ul)
+        new_vol = abs(volume)
+        if (curr_vol + new_vol) > 0:
+            print("\nThe syringe does not contain enough liquid, dose less or fill it up!\n")
+            return None
+        return await self.move(curr_vol + new_vol, rate, timeout)
+
+    async def switch_valve(self, confirm = False):
+        """Switch the valve, the power pulse is an event loop sleep"""
+        return await self.set_valve(None, confirm)
+
+    async def set_valve(self, open_valve = None, confirm = False):
+        """Open (True), close (False) or switch (None) the valve, nothing to do if it is commanded there already"""
+        pump = self.pump
+        pErrorCode, newstate = await self._run(pump._valve_power, open_valve)
+        if newstate is None:
+            return pErrorCode
+        await asyncio.sleep(pump.valve_pulse)
+        pErrorCode, newstate = await self._run(pump._valve_release)
+        await asyncio.sleep(pump.valve_settle)
+        if confirm and pErrorCode == 0:
+            pErrorCode = await self._run(pump._valve_confirm, newstate)
+        pump._valve_report(newstate)
+        return pErrorCode
+
+    async def halt(self):
+        """Halt from the default executor, not queued behind the bus worker: the bus arbiter gives it priority"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.pump._halt)
+
+    async def snapshot(self, max_age = None):
+        return await self._run(self.pump.snapshot, max_age)
+
+    # Completion policy of Nemesys._motion_steps, with the sleeps in the event loop and the polls on the bus worker
+    async def _wait_motion(self, estimate = 0.0, timeout = None, homing = False, target = None):
+        pump = self.pump
+        steps = pump._motion_steps(estimate, timeout, homing, target = target) # polling, a library wait would hold the bus worker
+        value = None
+        while True:
+            try:
+                kind, arg = steps.send(value)
+            except StopIteration as done:
+                return done.value
+            if kind == "sleep":
+                while arg > 0 and not pump._stopped.is_set(): # a halt ends the sleep within poll_period
+                    await asyncio.sleep(min(arg, pump.poll_period))
+                    arg -= pump.poll_period
+                value = None
+            else:
+                value = await self._run(arg)
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the bliss project
+#
+# Copyright (c) 2015-2023 Beamline Control Unit, ESRF
+# Distributed under the GNU LGPLv3. See LICENSE for more info.
+# Author: Antonino Calio'
+#
+# Latency and throughput benchmarks of the Nemesys driver, against the simulated EPOS2 backend or real pumps.
+#
+#   python pyNemesys_bench.py --latency 0.003 --pumps 6 --json results.json
+#   python pyNemesys_bench.py --baseline results.json      # exit code 1 on regression
+#   python pyNemesys_bench.py --backend hw --port /dev/ttyS4 --nodes 2 3
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import contextlib
+
+ACCESSORS = ["_get_position", "_get_velocity", "_is_moving", "_is_target_reached", "_is_valve_open", "_get_state", "snapshot"]
+
+# Results compared against a baseline, tails are too noisy to gate on
+COMPARED = ("s", "mean", "p50", "python_overhead", "transactions_per_call", "transactions_per_read", "reads_per_s", "min_pump_reads_per_s")
+
+# Results where a higher value is better, all the others are times or transaction counts
+HIGHER_IS_BETTER = ("reads_per_s", "min_pump_reads_per_s")
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(q*(len(ordered) - 1)))))
+    return ordered[index]
+
+# Latency distribution in s
+def distribution(samples):
+    return {
+        "n": len(samples),
+        "mean": sum(samples)/len(samples) if samples else None,
+        "min": min(samples) if samples else None,
+        "p50": percentile(samples, 0.5),
+        "p90": percentile(samples, 0.9),
+        "p99": percentile(samples, 0.99),
+        "max": max(samples) if samples else None,
+    }
+
+# The driver reports on stdout, keep it out of the benchmark output
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+class Bench:
+
+    def __init__(self, args):
+        self.args = args
+        self.sim = None
+        if args.backend == "sim":
+            os.environ.setdefault("NEMESYS_BACKEND", "sim")
+            import pyNemesys_sim
+            self.sim = pyNemesys_sim.EposSim(latency = args.latency)
+        import pyNemesys_linux
+        self.driver = pyNemesys_linux
+        self.port = args.port.encode()
+        self.nodes = args.nodes or list(range(2, 2 + args.pumps))
+        self.pumps = []
+
+    def make_pump(self, nodeID):
+        with quiet():
+            return self.driver.Nemesys(nodeID, self.port, backend = self.sim)
+
+    def calls(self):
+        return self.sim.calls if self.sim is not None else None
+
+    def run(self):
+        results = {
+            "backend": self.args.backend,
+            "latency": self.args.latency if self.sim is not None else None,
+            "pumps": len(self.nodes),
+            "timestamp": time.time(),
+        }
+        results["time_to_first_move"] = self.time_to_first_move()
+        for nodeID in self.nodes[1:]:
+            self.pumps.append(self.make_pump(nodeID))
+        results["accessors"] = self.accessor_latency()
+        results["status_reads"] = self.status_reads()
+        results["valve_cycle"] = self.valve_cycle()
+        results["move_completion"] = self.move_completion()
+        results["stop_latency"] = self.stop_latency()
+        for pump in self.pumps:
+            with quiet():
+                pump._nemesys_disable()
+                pump._bus_close()
+        return results
+
+    # Construction of a pump until its first move command has been accepted
+    def time_to_first_move(self):
+        start = time.perf_counter()
+        pump = self.make_pump(self.nodes[0])
+        with quiet():
+            pump._move_to_position_speed(pump._get_position()/pump.ul - 1, 10, wait = False)
+        elapsed = time.perf_counter() - start
+        with quiet():
+            pump._halt()
+        self.pumps.append(pump)
+        return {"s": elapsed}
+
+    def accessor_latency(self):
+        pump = self.pumps[0]
+        results = {}
+        for name in ACCESSORS:
+            method = getattr(pump, name)
+            kwargs = {"max_age": 0} if name == "snapshot" else {}
+            samples = []
+            calls = self.calls()
+            with quiet():
+                for _ in range(self.args.iterations):
+                    start = time.perf_counter()
+                    method(**kwargs)
+                    samples.append(time.perf_counter() - start)
+            results[name] = distribution(samples)
+            if calls is not None:
+                transactions = (self.calls() - calls)/self.args.iterations
+                results[name]["transactions_per_call"] = transactions
+                results[name]["python_overhead"] = results[name]["p50"] - transactions*self.args.latency # driver and simulator time per call
+        return results
+
+    # Full status reads per second over all the pumps of the bus, from one thread and from one thread per pump
+    def status_reads(self):
+        results = {}
+        duration = self.args.duration
+        reads = 0
+        calls = self.calls()
+        with quiet():
+            start = time.perf_counter()
+            while time.perf_counter() - start < duration:
+                for pump in self.pumps:
+                    pump.snapshot(max_age = 0)
+                    reads += 1
+        elapsed = time.perf_counter() - start
+        results["sequential"] = {"reads_per_s": reads/elapsed}
+        if calls is not None:
+            results["sequential"]["transactions_per_read"] = (self.calls() - calls)/reads
+
+        counts = [0]*len(self.pumps)
+        stop = threading.Event()
+        def reader(index, pump):
+            while not stop.is_set():
+                pump.snapshot(max_age = 0)
+                counts[index] += 1
+        threads = [threading.Thread(target = reader, args = (i, pump)) for i, pump in enumerate(self.pumps)]
+        with quiet():
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - start
+        results["threaded"] = {"reads_per_s": sum(counts)/elapsed, "min_pump_reads_per_s": min(counts)/elapsed}
+        return results
+
+    # Open/close cycle of the valve
+    def valve_cycle(self):
+        pump = self.pumps[0]
+        samples = []
+        with quiet():
+            for _ in range(self.args.valve_cycles):
+                start = time.perf_counter()
+                pump._switch_valve()
+                pump._switch_valve()
+                samples.append(time.perf_counter() - start)
+        return distribution(samples)
+
+    # Delay between the physical end of a move and its detection by the completion wait; needs the simulator to know the physical end
+    def move_completion(self):
+        pump = self.pumps[0]
+        samples = []
+        elapsed = []
+        polls = []
+        with quiet():
+            base = pump._get_position()/pump.ul
+        for i in range(self.args.moves):
+            target = base - self.args.move_volume*((i + 1) % 2)
+            end = {}
+            watcher = None
+            if self.sim is not None:
+                node = self.sim.node(self.port, pump.nodeID)
+                def watch():
+                    started = False
+                    while True:
+                        with self.sim._lock:
+                            node.update(self.sim.clock())
+                            done = node.target_reached and node.v == 0
+                        if not done:
+                            started = True
+                        elif started:
+                            end["t"] = time.perf_counter()
+                            return
+                        time.sleep(0.0005)
+                watcher = threading.Thread(target = watch)
+            with quiet():
+                start = time.perf_counter()
+                if watcher is not None:
+                    watcher.start()
+                pump._move_to_position_speed(target, self.args.move_speed)
+                detected = time.perf_counter()
+            if watcher is not None:
+                watcher.join()
+                samples.append(detected - end["t"])
+            elapsed.append(detected - start)
+            polls.append(pump.last_motion.polls)
+        results = {"elapsed": distribution(elapsed), "polls": distribution(polls)}
+        if samples:
+            results["detection_latency"] = distribution(samples)
+        return results
+
+    # Halt of a moving pump while every pump of the bus is status polled as fast as possible from its own thread
+    def stop_latency(self):
+        pump = self.pumps[0]
+        stop = threading.Event()
+        def reader(reader_pump):
+            while not stop.is_set():
+                reader_pump.snapshot(max_age = 0)
+        threads = [threading.Thread(target = reader, args = (reader_pump,)) for reader_pump in self.pumps for _ in range(2)]
+        samples = []
+        with quiet():
+            base = pump._get_position()/pump.ul
+            pump._bus_stats(reset = True)
+            for thread in threads:
+                thread.start()
+            for _ in range(self.args.moves):
+                pump._move_to_position_speed(base - self.args.move_volume, self.args.move_speed, wait = False)
+                time.sleep(0.05)
+                start = time.perf_counter()
+                pump._halt()
+                samples.append(time.perf_counter() - start)
+                time.sleep(0.05)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            stats = pump._bus_stats()
+            pump._move_to_position_speed(base, self.args.move_speed)
+        results = distribution(samples)
+        results["queue_wait"] = stats
+        return results
+
+
+# Walk two result trees and list the metrics worse than baseline by more than tolerance
+def regressions(baseline, results, tolerance, path = ""):
+    found = []
+    for key, old in baseline.items():
+        new = results.get(key) if isinstance(results, dict) else None
+        name = path + "/" + key if path else key
+        if isinstance(old, dict) and isinstance(new, dict):
+            found += regressions(old, new, tolerance, name)
+        elif isinstance(old, (int, float)) and isinstance(new, (int, float)) and not isinstance(old, bool) and old > 0:
+            if key not in COMPARED:
+                continue
+            if key in HIGHER_IS_BETTER:
+                worse = new < old*(1 - tolerance)
+            else:
+                worse = new > old*(1 + tolerance)
+            if worse:
+                found.append((name, old, new))
+    return found
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Nemesys driver benchmarks")
+    parser.add_argument("--backend", choices = ["sim", "hw"], default = "sim")
+    parser.add_argument("--latency", type = float, default = 0.003, help = "simulated s per serial transaction")
+    parser.add_argument("--port", default = "/dev/ttyS4")
+    parser.add_argument("--pumps", type = int, default = 2, help = "number of pumps, node IDs from 2")
+    parser.add_argument("--nodes", type = int, nargs = "*", help = "explicit node IDs, overrides --pumps")
+    parser.add_argument("--iterations", type = int, default = 200, help = "calls per accessor")
+    parser.add_argument("--duration", type = float, default = 2.0, help = "s per status read throughput run")
+    parser.add_argument("--valve-cycles", type = int, default = 3)
+    parser.add_argument("--moves", type = int, default = 4)
+    parser.add_argument("--move-volume", type = float, default = 5.0, help = "ul")
+    parser.add_argument("--move-speed", type = float, default = 20.0, help = "ul/s")
+    parser.add_argument("--json", help = "write the results to this file, - for stdout")
+    parser.add_argument("--baseline", help = "results of a previous run to compare with")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "relative degradation accepted against the baseline")
+    args = parser.parse_args(argv)
+
+    results = Bench(args).run()
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent = 2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+    else:
+        for name, values in results["accessors"].items():
+            print("%-20s p50 %7.3f ms  p99 %7.3f ms  overhead %7.1f us" % (name, values["p50"]*1000, values["p99"]*1000, values.get("python_overhead", 0)*1e6))
+        print("status reads/s      sequential %7.1f  threaded %7.1f" % (results["status_reads"]["sequential"]["reads_per_s"], results["status_reads"]["threaded"]["reads_per_s"]))
+        print("time to first move  %7.3f s" % results["time_to_first_move"]["s"])
+        print("valve cycle         %7.3f s" % results["valve_cycle"]["p50"])
+        if "detection_latency" in results["move_completion"]:
+            print("move detection      %7.3f ms" % (results["move_completion"]["detection_latency"]["p50"]*1000))
+        print("stop under load     %7.3f ms  max %7.3f ms" % (results["stop_latency"]["p50"]*1000, results["stop_latency"]["max"]*1000))
+        for lane, values in results["stop_latency"]["queue_wait"].items():
+            print("  %-8s queue wait mean %7.3f ms  max %7.3f ms" % (lane, values["mean_wait"]*1000, values["max_wait"]*1000))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(baseline, results, args.tolerance)
+        for name, old, new in found:
+            print("REGRESSION %s: %.6g -> %.6g" % (name, old, new))
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the bliss project
+#
+# Copyright (c) 2015-2023 Beamline Control Unit, ESRF
+# Distributed under the GNU LGPLv3. See LICENSE for more info.
+# Author: Antonino Calio'
+#
+# Flow modes built on Nemesys pumps.
+#
+# Continuous flow with two pumps in alternation: one doses while the other refills through its closed valve,
+# reopens the valve and waits; near the end of the stroke the dosing rate is handed over in steps so that
+# the sum of the two flows stays at the set point.
+#
+#   flow = ContinuousFlow(Nemesys(2), Nemesys(3), fill_volume = 400, refill_rate = 200)
+#   flow.start(20)
+#   ...
+#   flow.stop()
+#   print(flow.handovers)
+
+import time
+import threading
+from collections import namedtuple, deque
+
+# Flow measured across one handover, flows in ul/s, discontinuity as the largest relative deviation from the set point
+Handover = namedtuple("Handover", ["index", "timestamp", "from_node", "to_node", "setpoint", "min_flow", "max_flow", "discontinuity", "duration"])
+
+
+class ContinuousFlow:
+
+    def __init__(self, pumpA, pumpB, fill_volume = None, refill_rate = None, handover_time = 2.0, handover_steps = 5, sample_period = 0.05):
+        self.pumps = [pumpA, pumpB]
+        self.fill_volume = fill_volume # ul aspirated per stroke, 90 % of the smaller syringe if not set
+        self.refill_rate = refill_rate # ul/s, 10 times the flow rate if not set
+        self.handover_time = handover_time # s over which the flow is handed from one pump to the other
+        self.handover_steps = handover_steps
+        self.sample_period = sample_period # s between the flow samples taken during a handover
+        self.rate = None
+        self.handovers = []
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Start dosing at rate ul/s, returns False if the pumps cannot keep up with it
+    def start(self, rate):
+        if self._thread is not None and self._thread.is_alive():
+            print("\nContinuous flow already running!\n")
+            return False
+        fill = self.fill_volume or 0.9*min(pump._syringe_volume() for pump in self.pumps)
+        refill_rate = self.refill_rate or 10*rate
+        valve_time = max(pump.valve_pulse + pump.valve_settle for pump in self.pumps)
+        busy = 2*valve_time + fill/refill_rate + self.handover_time # standby pump: close valve, refill, open valve, hand over
+        if rate <= 0 or busy >= fill/rate - self.handover_time:
+            print("\nThe refill cannot keep up with %.1f ul/s, lower the rate or raise the refill rate!\n" % rate)
+            return False
+        self.rate = rate
+        self._fill = fill
+        self._refill_rate = refill_rate
+        self.handovers = []
+        self.error = None
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, name = "nemesys-flow", daemon = True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        for pump in self.pumps: # before the join, the flow thread may be in the middle of a refill
+            pump._halt()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        active, standby = self.pumps
+        try:
+            if not self._refill(active):
+                return
+            if active._move_to_position_speed(0, self.rate, wait = False) != 0:
+                raise RuntimeError("pump %d refused to dose" % active.nodeID)
+            while not self._stop.is_set():
+                if not self._refill(standby) or not self._wait_handover(active):
+                    break
+                handover = self._handover(active, standby)
+                if handover is None:
+                    break
+                self.handovers.append(handover)
+                active, standby = standby, active
+        except Exception as e:
+            self.error = e
+            print("\nContinuous flow stopped: %s\n" % e)
+        finally:
+            for pump in self.pumps:
+                pump._halt()
+
+    # Close the valve, aspirate the stroke volume and reopen the valve so the pump is ready to take over,
+    # False if the flow was stopped meanwhile
+    def _refill(self, pump):
+        pump._set_valve(False)
+        remaining = abs(self._fill + pump._get_position()/pump.ul)/self._refill_rate
+        if pump._move_to_position_speed(-self._fill, self._refill_rate, wait = False) != 0:
+            raise RuntimeError("pump %d could not refill" % pump.nodeID)
+        deadline = time.monotonic() + max(2*remaining, remaining + 10)
+        self._stop.wait(max(0.0, remaining - self.sample_period))
+        while not self._stop.is_set() and not pump._is_target_reached(): # also set by a halt, the position tells
+            if time.monotonic() >= deadline or pump._read_state() == "FAULT":
+                break
+            self._stop.wait(self.sample_period)
+        if self._stop.is_set():
+            return False
+        position = pump._get_position()
+        pump._remember_position(position)
+        if abs(position/pump.ul + self._fill) > pump.target_tolerance:
+            raise RuntimeError("pump %d could not refill" % pump.nodeID)
+        pump._set_valve(True)
+        return True
+
+    # Sleep until the remaining volume of the dosing pump is what the handover ramp will dispense
+    def _wait_handover(self, pump):
+        reserve = self.rate*self.handover_time/2
+        while not self._stop.is_set():
+            remaining = -pump._get_position()/pump.ul
+            if remaining <= reserve:
+                return True
+            self._stop.wait(min(1.0, max(self.sample_period, (remaining - reserve)/self.rate - self.sample_period)))
+        return False
+
+    # Hand the flow over in steps, outgoing + incoming rates always sum to the set point; the combined flow is sampled meanwhile.
+    # None if the flow was stopped in the middle
+    def _handover(self, outgoing, incoming):
+        steps = self.handover_steps
+        step = self.handover_time/steps
+        start = time.monotonic()
+        volume = lambda: outgoing._get_position()/outgoing.ul + incoming._get_position()/incoming.ul
+        last_t, last_v = time.monotonic(), volume()
+        flows = []
+        for k in range(1, steps + 1):
+            incoming._move_to_position_speed(0, self.rate*k/steps, wait = False)
+            outgoing._move_to_position_speed(0, self.rate*(steps - k)/steps, wait = False) # speed 0 halts the outgoing pump
+            while time.monotonic() < start + k*step:
+                if self._stop.wait(self.sample_period):
+                    return None
+                t, v = time.monotonic(), volume()
+                flows.append((v - last_v)/(t - last_t))
+                last_t, last_v = t, v
+        duration = time.monotonic() - start
+        low, high = min(flows), max(flows)
+        discontinuity = max(abs(low - self.rate), abs(high - self.rate))/self.rate
+        print("\nHandover %d: pump %d -> pump %d flow %.1f..%.1f ul/s for %.1f ul/s (discontinuity %.1f %%)" % (len(self.handovers) + 1, outgoing.nodeID, incoming.nodeID, low, high, self.rate, 100*discontinuity))
+        return Handover(len(self.handovers) + 1, time.time(), outgoing.nodeID, incoming.nodeID, self.rate, low, high, discontinuity, duration)
+
+
+# One step of a flow program: volume ul > 0 doses and < 0 aspirates, at rate ul/s, with the valve open (True) or closed (False);
+# valve None opens it for dosing and closes it for aspirating, like the BLISS controller does
+Segment = namedtuple("Segment", ["volume", "rate", "valve"], defaults = [None])
+
+# Outcome of a flow program: start time in s of each segment from the program start, None if never reached,
+# late counts the segments whose set point was buffered after the drive had already stopped
+ProgramResult = namedtuple("ProgramResult", ["completed", "starts", "elapsed", "late", "stops"])
+
+
+# Flow program executed on one pump: consecutive segments with the same valve state are chained on the drive,
+# each one buffered as a non-immediate set point while the previous one runs, so the drive goes on without stopping
+class FlowProgram:
+
+    def __init__(self, pump, segments, poll_period = None):
+        self.pump = pump
+        self.segments = [segment if isinstance(segment, Segment) else Segment(*segment) for segment in segments]
+        self.poll_period = poll_period or pump.poll_period # s between position polls while a segment runs
+        self.result = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Absolute target in ul and valve state of every segment, None if the program leaves the syringe range
+    def _plan(self):
+        volume = self.pump._syringe_volume()
+        position = self.pump._get_position()/self.pump.ul
+        plan = []
+        for index, segment in enumerate(self.segments):
+            position += segment.volume
+            if segment.rate <= 0 or segment.volume == 0 or not round(-volume // 1) <= position <= 0:
+                print("\nSegment %d of the flow program is not feasible (volume %.1f ul, rate %.1f ul/s)!\n" % (index, segment.volume, segment.rate))
+                return None
+            valve = segment.valve if segment.valve is not None else segment.volume > 0
+            plan.append((position, segment.rate, valve))
+        return plan
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            print("\nFlow program already running!\n")
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target = self.run, name = "nemesys-program", daemon = True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        self.pump._halt() # before the join, the program thread may be waiting for a segment
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+        return self.result
+
+    def run(self):
+        pump = self.pump
+        plan = self._plan()
+        if plan is None:
+            return None
+        start = time.monotonic()
+        starts = [None]*len(plan)
+        late = 0
+        stops = 0
+        index = 0
+        while index < len(plan) and not self._stop.is_set():
+            chain = index
+            while chain + 1 < len(plan) and plan[chain + 1][2] == plan[index][2]:
+                chain += 1
+            pump._set_valve(plan[index][2])
+            if pump._prepare_move(plan[index][0], plan[index][1]) != 0 or pump._start_move() != 0:
+                break
+            stops += 1
+            starts[index] = time.monotonic() - start
+            if index < chain:
+                pump._queue_move(*plan[index + 1][:2])
+            ended = self._run_chain(plan, index, chain, starts, start)
+            if ended is None:
+                break
+            index, chain_late = ended
+            late += chain_late
+        if self._stop.is_set():
+            pump._halt() # a segment started after the halt of stop
+        completed = index >= len(plan) and pump.last_motion is not None and pump.last_motion.reached
+        self.result = ProgramResult(completed, starts, time.monotonic() - start, late, stops)
+        return self.result
+
+    # Follow segments first..last already started on the drive, buffering the next one as soon as the previous one is passed
+    def _run_chain(self, plan, first, last, starts, start):
+        pump = self.pump
+        late = 0
+        previous = pump._get_position()/pump.ul
+        index = first
+        origin = plan[first - 1][0] if first > 0 else previous
+        while index < last:
+            if self._stop.is_set():
+                return None
+            target, rate = plan[index][:2]
+            direction = 1 if target > origin else -1
+            remaining = abs(target - pump._get_position()/pump.ul)
+            self._stop.wait(max(0.0, remaining/rate - self.poll_period))
+            while not self._stop.is_set():
+                position = pump._get_position()/pump.ul
+                if (position - target)*direction >= -1/pump.ul:
+                    break
+                self._stop.wait(self.poll_period)
+            if self._stop.is_set():
+                return None
+            index += 1
+            starts[index] = time.monotonic() - start
+            origin = target
+            if index < last:
+                if (pump._get_position()/pump.ul - plan[index][0])*(1 if plan[index][0] > target else -1) >= -1/pump.ul:
+                    late += 1 # the buffered segment already ended, the drive stopped in between
+                pump._queue_move(*plan[index + 1][:2])
+        target, rate = plan[last][:2]
+        estimate = pump._motion_time(abs(target*pump.ul - pump._get_position()), rate*pump.uls, 200000, 200000)
+        pump.last_motion = self._wait_last(estimate, int(target*pump.ul))
+        return last + 1, late
+
+    # Completion wait of the last segment of a chain, the sleeps of Nemesys._wait_motion also end on stop
+    def _wait_last(self, estimate, target):
+        pump = self.pump
+        steps = pump._motion_steps(estimate, target = target)
+        value = None
+        while True:
+            try:
+                kind, arg = steps.send(value)
+            except StopIteration as done:
+                return done.value
+            if kind == "sleep":
+                if self._stop.wait(arg):
+                    pump._halt() # the halt ends the motion wait, the result is not reached
+                value = None
+            else:
+                value = arg()
+
+
+# PVT points (position ul, velocity ul/s, time ms) of a flow waveform given as rates in ul/s sampled every period_ms,
+# starting from position ul; positions are the trapezoidal integral of the rates, the last point ramps down to rest
+def pvt_from_flow(rates, period_ms, position):
+    previous = None
+    for rate in rates:
+        if previous is not None:
+            position += (previous + rate)/2*period_ms/1000
+        yield (position, rate, period_ms)
+        previous = rate
+    if previous is not None:
+        yield (position + previous/2*period_ms/1000, 0.0, 0)
+
+# PVT buffer level sampled while streaming: s from the start, points in the buffer, points sent so far
+IpmTelemetry = namedtuple("IpmTelemetry", ["time", "level", "sent", "underflow_warning", "overflow_warning"])
+
+
+# Stream PVT points into the interpolated position mode buffer of the drive, which interpolates the trajectory itself.
+# points: iterable (generator, list, NumPy array of rows) of (position ul, velocity ul/s, time ms to the next point);
+# the buffer is topped up whenever about half of it has been played, a last point at rest ends the trajectory.
+class PvtStream:
+
+    def __init__(self, pump, points, underflow_warning = 10, overflow_warning = 60, telemetry = 10000):
+        self.pump = pump
+        self.points = points.tolist() if hasattr(points, "tolist") else points
+        self.underflow_warning = underflow_warning # buffer levels in points
+        self.overflow_warning = overflow_warning
+        self.telemetry = deque(maxlen = telemetry) # IpmTelemetry samples, the latest ones
+        self.sent = 0
+        self.completed = False
+        self.underflow = False
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Points in drive units, checked against the syringe range
+    def _drive_points(self):
+        pump = self.pump
+        lower = round(-pump._syringe_volume() // 1)
+        last = None
+        for position, velocity, duration in self.points:
+            if not lower <= position <= 0 or not 0 <= duration <= 255:
+                raise ValueError("PVT point (%.1f ul, %.1f ul/s, %d ms) out of range" % (position, velocity, duration))
+            last = (int(position*pump.ul), int(velocity*pump.uls), int(duration))
+            yield last
+        if last is not None and (last[1] != 0 or last[2] != 0):
+            yield (last[0], 0, 0)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            print("\nPVT stream already running!\n")
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target = self.run, name = "nemesys-pvt", daemon = True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+        return self.completed
+
+    def run(self):
+        pump = self.pump
+        self.sent = 0
+        self.completed = False
+        self.underflow = False
+        self.error = None
+        size = pump._ipm_setup(self.underflow_warning, self.overflow_warning)
+        if not size:
+            self.error = "interpolated position mode not available"
+            return False
+        source = self._drive_points()
+        durations = deque(maxlen = size) # ms of the points sent, the buffered ones are the latest
+        exhausted = False
+        start = None
+        try:
+            while not self._stop.is_set():
+                free = pump._ipm_free()
+                if free < 0:
+                    self.error = "buffer level not readable"
+                    break
+                if not exhausted and free > 0:
+                    batch = []
+                    for point in source:
+                        batch.append(point)
+                        if len(batch) >= free:
+                            break
+                    exhausted = len(batch) < free
+                    added = pump._ipm_add(batch)
+                    self.sent += added
+                    durations.extend(point[2] for point in batch[:added])
+                    if added < len(batch):
+                        self.error = "PVT point refused by the drive"
+                        break
+                    free -= added
+                if start is None:
+                    if pump._ipm_start() != 0:
+                        self.error = "trajectory not started"
+                        break
+                    start = time.monotonic()
+                status = pump._ipm_status()
+                if status is None:
+                    self.error = "buffer status not readable"
+                    break
+                level = size - free
+                self.telemetry.append(IpmTelemetry(time.monotonic() - start, level, self.sent, status.underflow_warning, status.overflow_warning))
+                if status.underflow_error:
+                    self.underflow = True
+                    print("\nPump ID: %1d PVT buffer underflow after %d points, the drive stopped!" % (pump.nodeID, self.sent))
+                    break
+                if status.overflow_error or status.velocity_error or status.acceleration_error:
+                    self.error = "trajectory error %s" % (status,)
+                    break
+                if exhausted and not status.running:
+                    self.completed = True
+                    break
+                buffered = sum(list(durations)[-level:])/1000 if level > 0 else 0.0
+                self._stop.wait(max(pump.poll_period, buffered/2))
+        except ValueError as e:
+            self.error = str(e)
+            print("\n%s\n" % e)
+        if not self.completed and not self.underflow:
+            pump._ipm_stop()
+        pump._remember_position(pump._get_position())
+        return self.completed
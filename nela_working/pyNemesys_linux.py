@@ -8,41 +8,564 @@
 #
 # Python wrapper for the Maxon EPOS2 command library, to control Cetoni Nemesys Low Pressure syring pumps
 
+import os
+import json
+import atexit
+import math
+import fcntl
 import time
+import functools
+import contextlib
+import threading
+import weakref
+from collections import namedtuple, deque
 
 from ctypes import *
+from ctypes.util import find_library
 
-# EPOS Command Library path
+try:
+    import numpy
+except ImportError:
+    numpy = None # recordings come back as lists
+
+try:
+    from .pyNemesys_progress import Progress, ConsoleProgress
+    from .pyNemesys_trace import Tracer
+    from .pyNemesys_replay import SessionRecorder
+except ImportError:
+    from pyNemesys_progress import Progress, ConsoleProgress
+    from pyNemesys_trace import Tracer
+    from pyNemesys_replay import SessionRecorder
+
+# EPOS Command Library path, NEMESYS_EPOS_LIB takes precedence, then the linker search path
 path = "/opt/EposCmdLib_6.3.1.0/lib/x86_64/libEposCmd.so.6.3.1.0"
 
-# Load library
-cdll.LoadLibrary(path)
-epos = CDLL(path)
-            
+# Drive objects behind the conversion factors, cached per port and node, NEMESYS_CACHE="" disables the file.
+# Both files are for the EPOS library only, simulated pumps keep their entries in memory, see _stores
+conversion_cache_path = os.environ.get("NEMESYS_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "pyNemesys", "conversion.json"))
+
+# Pump state kept across process restarts per port and node (referenced, position, profile, valve, fill volume),
+# NEMESYS_STATE="" keeps it in memory only
+state_path = os.environ.get("NEMESYS_STATE", os.path.join(os.path.expanduser("~"), ".cache", "pyNemesys", "state.json"))
+
+# C prototypes of the library functions used here, name: (restype, argtypes)
+_PROTOTYPES = {
+    "VCS_OpenDevice": (c_void_p, [c_char_p, c_char_p, c_char_p, c_char_p, POINTER(c_uint)]),
+    "VCS_SetProtocolStackSettings": (c_int, [c_void_p, c_uint, c_uint, POINTER(c_uint)]),
+    "VCS_CloseDevice": (c_int, [c_void_p, POINTER(c_uint)]),
+    "VCS_GetErrorInfo": (c_int, [c_uint, c_char_p, c_ushort]),
+    "VCS_ClearFault": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_SetEnableState": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_SetDisableState": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_GetState": (c_int, [c_void_p, c_ushort, POINTER(c_ushort), POINTER(c_uint)]),
+    "VCS_GetOperationMode": (c_int, [c_void_p, c_ushort, POINTER(c_int8), POINTER(c_uint)]),
+    "VCS_GetObject": (c_int, [c_void_p, c_ushort, c_ushort, c_ubyte, c_void_p, c_uint, POINTER(c_uint), POINTER(c_uint)]),
+    "VCS_SetObject": (c_int, [c_void_p, c_ushort, c_ushort, c_ubyte, c_void_p, c_uint, POINTER(c_uint), POINTER(c_uint)]),
+    "VCS_GetPositionIs": (c_int, [c_void_p, c_ushort, POINTER(c_int32), POINTER(c_uint)]),
+    "VCS_GetVelocityIs": (c_int, [c_void_p, c_ushort, POINTER(c_int32), POINTER(c_uint)]),
+    "VCS_GetVelocityIsAveraged": (c_int, [c_void_p, c_ushort, POINTER(c_int32), POINTER(c_uint)]),
+    "VCS_GetMovementState": (c_int, [c_void_p, c_ushort, POINTER(c_int), POINTER(c_uint)]),
+    "VCS_ActivateHomingMode": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_SetHomingParameter": (c_int, [c_void_p, c_ushort, c_uint, c_uint, c_uint, c_int, c_ushort, c_int, POINTER(c_uint)]),
+    "VCS_FindHome": (c_int, [c_void_p, c_ushort, c_int8, POINTER(c_uint)]),
+    "VCS_StopHoming": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_GetHomingState": (c_int, [c_void_p, c_ushort, POINTER(c_int), POINTER(c_int), POINTER(c_uint)]),
+    "VCS_WaitForHomingAttained": (c_int, [c_void_p, c_ushort, c_uint, POINTER(c_uint)]),
+    "VCS_ActivateProfilePositionMode": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_SetPositionProfile": (c_int, [c_void_p, c_ushort, c_uint, c_uint, c_uint, POINTER(c_uint)]),
+    "VCS_GetPositionProfile": (c_int, [c_void_p, c_ushort, POINTER(c_uint), POINTER(c_uint), POINTER(c_uint), POINTER(c_uint)]),
+    "VCS_MoveToPosition": (c_int, [c_void_p, c_ushort, c_long, c_int, c_int, POINTER(c_uint)]),
+    "VCS_HaltPositionMovement": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_ActivateProfileVelocityMode": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_SetVelocityProfile": (c_int, [c_void_p, c_ushort, c_uint, c_uint, POINTER(c_uint)]),
+    "VCS_MoveWithVelocity": (c_int, [c_void_p, c_ushort, c_long, POINTER(c_uint)]),
+    "VCS_HaltVelocityMovement": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_ActivateInterpolatedPositionMode": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_SetIpmBufferParameter": (c_int, [c_void_p, c_ushort, c_ushort, c_ushort, POINTER(c_uint)]),
+    "VCS_GetIpmBufferParameter": (c_int, [c_void_p, c_ushort, POINTER(c_ushort), POINTER(c_ushort), POINTER(c_uint), POINTER(c_uint)]),
+    "VCS_ClearIpmBuffer": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_GetFreeIpmBufferSize": (c_int, [c_void_p, c_ushort, POINTER(c_uint), POINTER(c_uint)]),
+    "VCS_AddPvtValueToIpmBuffer": (c_int, [c_void_p, c_ushort, c_long, c_long, c_ubyte, POINTER(c_uint)]),
+    "VCS_StartIpmTrajectory": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_StopIpmTrajectory": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_GetIpmStatus": (c_int, [c_void_p, c_ushort] + [POINTER(c_int)]*9 + [POINTER(c_uint)]),
+    "VCS_SetRecorderParameter": (c_int, [c_void_p, c_ushort, c_ushort, c_ushort, POINTER(c_uint)]),
+    "VCS_EnableTrigger": (c_int, [c_void_p, c_ushort, c_ubyte, POINTER(c_uint)]),
+    "VCS_DisableAllTriggers": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_ActivateChannel": (c_int, [c_void_p, c_ushort, c_ubyte, c_ushort, c_ubyte, c_ubyte, POINTER(c_uint)]),
+    "VCS_DeactivateAllChannels": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_StartRecorder": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_StopRecorder": (c_int, [c_void_p, c_ushort, POINTER(c_uint)]),
+    "VCS_IsRecorderRunning": (c_int, [c_void_p, c_ushort, POINTER(c_int), POINTER(c_uint)]),
+    "VCS_IsRecorderTriggered": (c_int, [c_void_p, c_ushort, POINTER(c_int), POINTER(c_uint)]),
+    "VCS_ReadChannelVectorSize": (c_int, [c_void_p, c_ushort, POINTER(c_uint), POINTER(c_uint)]),
+    "VCS_ReadChannelDataVector": (c_int, [c_void_p, c_ushort, c_ubyte, POINTER(c_ubyte), c_uint, POINTER(c_uint)]),
+    "VCS_WaitForTargetReached": (c_int, [c_void_p, c_ushort, c_uint, POINTER(c_uint)]),
+    "VCS_GetAllDigitalOutputs": (c_int, [c_void_p, c_ushort, POINTER(c_ushort), POINTER(c_uint)]),
+    "VCS_SetAllDigitalOutputs": (c_int, [c_void_p, c_ushort, c_ushort, POINTER(c_uint)]),
+}
+
+# EPOS Command Library loaded on first use, with the prototypes declared
+class _EposLibrary:
+
+    def __init__(self):
+        self._lib = None
+        self._lock = threading.Lock()
+
+    # Candidate library files, in order
+    def search_paths(self):
+        paths = [p for p in os.environ.get("NEMESYS_EPOS_LIB", "").split(os.pathsep) if p]
+        paths.append(path)
+        found = find_library("EposCmd")
+        if found:
+            paths.append(found)
+        return paths
+
+    def load(self):
+        with self._lock:
+            if self._lib is not None:
+                return self._lib
+            errors = []
+            for candidate in self.search_paths():
+                try:
+                    lib = CDLL(candidate)
+                except OSError as e:
+                    errors.append(str(e))
+                    continue
+                for name, (restype, argtypes) in _PROTOTYPES.items():
+                    function = getattr(lib, name)
+                    function.restype = restype
+                    function.argtypes = argtypes
+                self._lib = lib
+                return lib
+            raise OSError("EPOS Command Library not found, set NEMESYS_EPOS_LIB or use the simulated backend: " + "; ".join(errors))
+
+    # The function is cached on the instance, later lookups skip this method
+    def __getattr__(self, name):
+        if not name.startswith("VCS_"):
+            raise AttributeError(name)
+        function = getattr(self.load(), name)
+        setattr(self, name, function)
+        return function
+
+# Simulated EPOS2 backend, see pyNemesys_sim
+def _sim_backend():
+    try:
+        from . import pyNemesys_sim
+    except ImportError:
+        import pyNemesys_sim
+    return pyNemesys_sim.default()
+
+# Library loaded lazily, or the simulator when NEMESYS_BACKEND=sim
+if os.environ.get("NEMESYS_BACKEND") == "sim":
+    epos = _sim_backend()
+else:
+    epos = _EposLibrary()
+
+# NEMESYS_TRACE=<ring size> traces every call of the default backend, see pyNemesys_trace
+tracer = None
+if os.environ.get("NEMESYS_TRACE"):
+    tracer = Tracer(ring_size = int(os.environ["NEMESYS_TRACE"]))
+    epos = tracer.wrap(epos)
+
+# NEMESYS_RECORD=<file> records the whole session of the default backend for replay, see pyNemesys_replay
+recorder = None
+if os.environ.get("NEMESYS_RECORD"):
+    if tracer is None:
+        tracer = Tracer()
+        epos = tracer.wrap(epos)
+    recorder = SessionRecorder(tracer, os.environ["NEMESYS_RECORD"]).start()
+
+# Reentrant lock of a bus handle granting the transactions first come first served, except for the priority lane
+# (halt, disable) which goes ahead of every queued normal request. Queue wait times are accumulated per lane.
+class _Arbiter:
+
+    LANES = ("normal", "priority")
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        self._queues = (deque(), deque()) # tickets of the waiting threads, normal and priority lane
+        self._stats = [[0, 0, 0.0, 0.0] for lane in self.LANES] # acquisitions, queued, total wait s, max wait s
+
+    def acquire(self, priority = False):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return True
+            lane = 1 if priority else 0
+            stats = self._stats[lane]
+            stats[0] += 1
+            if self._owner is None and not self._queues[1] and (priority or not self._queues[0]):
+                self._owner = me
+                self._depth = 1
+                return True
+            ticket = object()
+            queue = self._queues[lane]
+            queue.append(ticket)
+            start = time.perf_counter()
+            while not (self._owner is None and queue[0] is ticket and (priority or not self._queues[1])):
+                self._cond.wait()
+            queue.popleft()
+            waited = time.perf_counter() - start
+            stats[1] += 1
+            stats[2] += waited
+            stats[3] = max(stats[3], waited)
+            self._owner = me
+            self._depth = 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("cannot release un-acquired lock")
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._cond.notify_all()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+    # Context manager taking the lock in the priority lane
+    @contextlib.contextmanager
+    def priority(self):
+        self.acquire(priority = True)
+        try:
+            yield
+        finally:
+            self.release()
+
+    # Queue wait statistics per lane, times in s
+    def stats(self, reset = False):
+        with self._cond:
+            result = {}
+            for lane, (count, queued, total, longest) in zip(self.LANES, self._stats):
+                result[lane] = {"acquisitions": count, "queued": queued, "mean_wait": total/count if count else 0.0, "max_wait": longest, "waiting": len(self._queues[self.LANES.index(lane)])}
+            if reset:
+                self._stats = [[0, 0, 0.0, 0.0] for lane in self.LANES]
+            return result
+
+# Serial bus handles shared by all the pumps on the same port
+class _Bus:
+
+    def __init__(self, epos, port, keyHandle):
+        self.epos = epos
+        self.port = port
+        self.keyHandle = keyHandle
+        self.refs = 0
+        self.lock = _Arbiter() # serializes the transactions on this handle
+        self.poller = None
+        self.executor = None # single worker running the calls of the asyncio API, see pyNemesys_async
+
+_buses = {}
+_buses_lock = threading.Lock()
+
+# JSON file of entries per port:node key, loaded on first use and replaced atomically when an entry changes.
+# path is called for the file name, so that the module setting can be changed after import; an empty name keeps it in memory.
+# put only updates the in-process copy, the file is written by a background writer so that callers holding the bus lock
+# never wait on the disk; entries put meanwhile are written together. Writes merge into the file as it is on disk under
+# an exclusive lock, so processes sharing it keep each other's entries.
+class _JsonStore:
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = None
+        self._pending = {} # entries not written to the file yet
+        self._writer = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            return {} # no file yet or unreadable, rebuilt from the drives
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._read(self._path()) if self._path() else {}
+
+    # Entry of a port:node key, None if unknown
+    def get(self, key):
+        with self._lock:
+            self._load()
+            return self._entries.get(key)
+
+    def put(self, key, entry):
+        with self._lock:
+            self._load()
+            if self._entries.get(key) == entry:
+                return
+            self._entries[key] = entry
+            if not self._path():
+                return
+            self._pending[key] = entry
+            if self._writer is None:
+                self._writer = threading.Thread(target = self._write_pending, name = "nemesys-store", daemon = True)
+                self._writer.start()
+
+    # Wait until the entries put so far are in the file
+    def flush(self):
+        writer = self._writer
+        if writer is not None and writer is not threading.current_thread():
+            writer.join()
+
+    def _write_pending(self):
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                if not pending:
+                    self._writer = None
+                    return
+            path = self._path()
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+                with open(path + ".lock", "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX) # released when closed
+                    entries = self._read(path)
+                    entries.update(pending)
+                    tmp = "%s.%d.tmp" % (path, os.getpid())
+                    with open(tmp, "w") as f:
+                        json.dump(entries, f, indent = 1)
+                    os.replace(tmp, path)
+            except OSError:
+                continue # read-only home: the in-process copy still applies
+            with self._lock:
+                entries.update(self._pending) # put while writing, the next pass writes them
+                self._entries = entries
+
+_conversion_store = _JsonStore(lambda: conversion_cache_path)
+_state_store = _JsonStore(lambda: state_path)
+atexit.register(_conversion_store.flush)
+atexit.register(_state_store.flush)
+_memory_stores = weakref.WeakKeyDictionary() # backend -> (conversion, state) stores
+
+# Conversion and state stores of a backend: the files for the EPOS library, in memory for anything else (simulator),
+# whose port:node keys would otherwise overwrite the entries of the real pumps
+def _stores(backend):
+    backend = getattr(backend, "_backend", backend) # behind a tracer
+    if isinstance(backend, (_EposLibrary, CDLL)):
+        return _conversion_store, _state_store
+    with _buses_lock:
+        stores = _memory_stores.get(backend)
+        if stores is None:
+            stores = _memory_stores[backend] = (_JsonStore(lambda: ""), _JsonStore(lambda: ""))
+        return stores
+
+# Run a method holding the lock of the pump bus handle
+def _locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.bus.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+# Run a method holding the lock of the pump bus handle, taken in the priority lane
+def _priority(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.bus.lock.priority():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+# Outcome of a motion completion wait
+MotionResult = namedtuple("MotionResult", ["nodeID", "reached", "position", "elapsed", "polls", "timeout"])
+
+# Outcome of a group move, motions in the order of the group pumps
+GroupResult = namedtuple("GroupResult", ["reached", "motions", "skew", "elapsed"])
+
+# Pump status read in one pass, position in qc and velocity in motor units
+Snapshot = namedtuple("Snapshot", ["nodeID", "timestamp", "position", "velocity", "moving", "target_reached", "outputs", "valve_open", "state"])
+
+# Interpolated position mode trajectory and buffer flags, as returned by VCS_GetIpmStatus
+IpmStatus = namedtuple("IpmStatus", ["running", "underflow_warning", "overflow_warning", "velocity_warning", "acceleration_warning",
+                                     "underflow_error", "overflow_error", "velocity_error", "acceleration_error"])
+
+# Outcome of the homing of one pump of a fleet: skipped when the drive was still referenced
+HomingResult = namedtuple("HomingResult", ["nodeID", "attained", "error", "skipped", "elapsed", "timeout"])
+
+# On-drive recordings: sampling period in s, time of every sample in s from the trigger, channel name: values in ul, ul/s or mA
+Recording = namedtuple("Recording", ["nodeID", "period", "time", "channels", "triggered"])
+
+# Objects the data recorder can sample: name: (index, subindex, size in bytes, unit)
+RECORDER_CHANNELS = {
+    "position": (0x6064, 0x00, 4, "qc"), # position actual value
+    "velocity": (0x606C, 0x00, 4, "velocity"), # velocity actual value
+    "velocity_averaged": (0x2028, 0x00, 4, "velocity"),
+    "current": (0x6078, 0x00, 2, "mA"), # current actual value
+    "current_averaged": (0x2027, 0x00, 2, "mA"),
+}
+
+# Device states as returned by VCS_GetState
+_STATES = ("DISABLED", "ENABLED", "QUICKSTOP", "FAULT")
+
+# Error code of a library wait (VCS_WaitForTargetReached, VCS_WaitForHomingAttained) that timed out
+_ERROR_TIMEOUT = 0x1000000B
+
+# Output buffers of the status reads and their byref pointers, allocated once per pump.
+# Only used with the bus lock held, values are copied out before the lock is released.
+class _StatusBuffers:
+
+    def __init__(self):
+        self.errorCode = c_uint()
+        self.pErrorCode = byref(self.errorCode)
+        self.position = c_int32()
+        self.pPosition = byref(self.position)
+        self.velocity = c_int32()
+        self.pVelocity = byref(self.velocity)
+        self.targetReached = c_int()
+        self.pTargetReached = byref(self.targetReached)
+        self.outputs = c_ushort()
+        self.pOutputs = byref(self.outputs)
+        self.state = c_uint16()
+        self.pState = byref(self.state)
+        self.homingAttained = c_int()
+        self.pHomingAttained = byref(self.homingAttained)
+        self.homingError = c_int()
+        self.pHomingError = byref(self.homingError)
+        self.errorInfo = create_string_buffer(256)
+
+# Open (True), close (False) or switch (None) the valves of several pumps with one shared actuation wait: every power
+# pulse starts, the longest valve_pulse elapses, every pulse ends. states is one value for all or one per pump.
+# Returns the error codes in pump order.
+def set_valves(pumps, states = None, confirm = False):
+    pumps = list(pumps)
+    if not isinstance(states, (list, tuple)):
+        states = [states]*len(pumps)
+    errors = [0]*len(pumps)
+    powered = []
+    for i, (pump, state) in enumerate(zip(pumps, states)):
+        errors[i], newstate = pump._valve_power(state)
+        if newstate is not None:
+            powered.append(i)
+    if not powered:
+        return errors
+    time.sleep(max(pumps[i].valve_pulse for i in powered))
+    words = {}
+    for i in powered:
+        errors[i], words[i] = pumps[i]._valve_release()
+    time.sleep(max(pumps[i].valve_settle for i in powered))
+    for i in powered:
+        if confirm and errors[i] == 0:
+            errors[i] = pumps[i]._valve_confirm(words[i])
+        pumps[i]._valve_report(words[i])
+    return errors
+
+# Home several pumps at once: every homing is started, then one loop polls the homing state of each pump until it is
+# attained or failed. Pumps still referenced are skipped if skip_referenced, the ones still homing after timeout s are
+# stopped. Returns the HomingResults in pump order.
+def home_pumps(pumps, negative = False, skip_referenced = True, timeout = None, poll_period = 0.1):
+    pumps = list(pumps)
+    if timeout is None:
+        timeout = max([pump.homing_timeout for pump in pumps] or [0])
+    start = time.monotonic()
+    results = [None]*len(pumps)
+    for i, pump in enumerate(pumps):
+        if skip_referenced and pump._is_referenced():
+            results[i] = HomingResult(pump.nodeID, True, False, True, 0.0, False)
+            continue
+        reference = pump._reference_neg_lim if negative else pump._reference_pos_lim
+        if reference(wait = False) != 0:
+            results[i] = HomingResult(pump.nodeID, False, True, False, time.monotonic() - start, False)
+    deadline = start + timeout
+    while None in results:
+        for i, pump in enumerate(pumps):
+            if results[i] is not None:
+                continue
+            attained, failed = pump._get_homing_state()
+            if attained or failed:
+                results[i] = HomingResult(pump.nodeID, attained and not failed, failed, False, time.monotonic() - start, False)
+                if results[i].attained:
+                    pump._remember_position(0, homed = True) # home position
+        if None not in results:
+            break
+        if time.monotonic() >= deadline:
+            for i, pump in enumerate(pumps):
+                if results[i] is None:
+                    pump._stop_homing()
+                    print("\nPump ID: %1d Homing timed out after %.1f s" % (pump.nodeID, timeout))
+                    results[i] = HomingResult(pump.nodeID, False, False, False, time.monotonic() - start, True)
+            break
+        time.sleep(poll_period)
+    return results
+
 # Definition of Nemesys class
 class Nemesys:
     
     # Initialization method
-    def __init__(self, nodeID, port = b'/dev/ttyS4', syringe_stroke_mm = 60, syringe_diameter_mm = 3.2574):
+    def __init__(self, nodeID, port = b'/dev/ttyS4', syringe_stroke_mm = 60, syringe_diameter_mm = 3.2574, poll_period = 0.05, drive_wait = False, snapshot_ttl = 0.2, backend = None, warm = False, progress = None):
         
         self.nodeID = nodeID
+        self.epos = epos if backend is None else _sim_backend() if backend == "sim" else backend # EPOS library or an object with the same VCS_* functions
+        self.poll_period = poll_period # s between completion polls once the motion is expected to end
+        self.drive_wait = drive_wait # wait inside the EPOS library instead of polling, in poll_period slices holding the bus
+        self.homing_timeout = 120 # s
+        self.valve_pulse = 0.2 # s the valve power output stays on
+        self.valve_settle = 0.01 # s after the power output is released
+        self.last_motion = None
+        self.progress = ConsoleProgress() if progress is None else progress # reporter of the completion loops, see pyNemesys_progress
+        self.snapshot_ttl = snapshot_ttl # s a status snapshot is served from cache
+        self._snapshot = None
+        self._pending = None # (target qc, expected duration s) of the move preloaded by _prepare_move
+        self._shadow = {} # write-through copy of operation mode, position profile and digital outputs
+        self._flow = None # [rate ul/s, lower qc, upper qc] while flowing in profile velocity mode
+        self._flow_wake = threading.Event() # set on rate changes and stops
+        self._flow_guard = None
+        self.recorder_cycle = 0.0001 # s, current regulator cycle, unit of the recorder sampling period
+        self._recording = None # (channels, sampling period s, preceding samples) of the armed recorder
+        self.poller = None
+        self._buf = _StatusBuffers()
         self.port = port
+        self._key = "%s:%d" % (port.decode(errors = "replace") if isinstance(port, bytes) else port, nodeID) # conversion and state stores
+        self._serial = None
+        self._conversions, self._states = _stores(self.epos)
+        self._state = None # persisted state, see _restore_state
+        self.restored = False # persisted state confirmed by the drive
+        self.restore_tolerance = 10 # qc between the persisted and the actual position of a drive left untouched
+        self.target_tolerance = 0.5 # ul between the final position and the target of a move counted as reached
+        self._stopped = threading.Event() # set by _halt and _stop_homing, ends the wait of the motion in progress
+        self.bus = None
         self.keyHandle = self._bus_open(self.port)
-        self._nemesys_init()
+        if warm:
+            self._ensure_enabled() # keep a drive that is enabled already as it is
+        else:
+            self._nemesys_init()
         self.syr_str = syringe_stroke_mm
         self.syr_diam = syringe_diameter_mm
         self.ul, self.uls = self._get_conversion_data()
+        self._restore_state()
         
     # Error Handling
     def _error(self, pErrorCode):
-        err_str = create_string_buffer(256)
-        str_len = c_uint16(256)
-        epos.VCS_GetErrorInfo(pErrorCode,byref(err_str),byref(str_len))
+        err_str = self._buf.errorInfo
+        self.epos.VCS_GetErrorInfo(pErrorCode.value, err_str, len(err_str))
         print("\nPumpID: "+str(self.nodeID)+" Error Code = "+hex(pErrorCode.value)+" Error Info: "+err_str.value.decode())
+        self._invalidate_shadow() # the failed write may have been partially applied
         return 0
     
-    # Open the serial bus with the appropriate settings
+    # Get the handle of the serial bus, opening the port only if no other pump uses it yet
     def _bus_open(self, port):
+        with _buses_lock:
+            bus = _buses.get((self.epos, port))
+            if bus is None:
+                bus = _Bus(self.epos, port, self._device_open(port))
+                if bus.keyHandle:
+                    _buses[(self.epos, port)] = bus
+            bus.refs += 1
+            self.bus = bus
+        self._invalidate_shadow()
+        return bus.keyHandle
+
+    # Open the serial bus with the appropriate settings
+    def _device_open(self, port):
         pErrorCode = c_uint()
         deviceName = b'EPOS2'
         protocolStackName = b'MAXON_RS232'
@@ -50,182 +573,239 @@ class Nemesys:
         portName = port
         baudrate = 115200
         timeout = 1000
+        keyHandle = 0
         try:
-            keyHandle = epos.VCS_OpenDevice(deviceName, protocolStackName, interfaceName, portName, byref(pErrorCode)) # specify EPOS version and interface
+            keyHandle = self.epos.VCS_OpenDevice(deviceName, protocolStackName, interfaceName, portName, byref(pErrorCode)) # specify EPOS version and interface
             if not keyHandle:
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
         try:
-            if not epos.VCS_SetProtocolStackSettings(keyHandle, baudrate, timeout, byref(pErrorCode)): # set baudrate and timeout
+            if not self.epos.VCS_SetProtocolStackSettings(keyHandle, baudrate, timeout, byref(pErrorCode)): # set baudrate and timeout
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
 
         return keyHandle
     
-    # Close serial bus
+    # Release the serial bus, the port is closed when the last pump on it leaves
     def _bus_close(self):
         pErrorCode = c_uint()
-        try:
-            if not epos.VCS_CloseDevice(self.keyHandle, byref(pErrorCode)): # close device
-                raise Exception("An Error has occurred, exiting...")
-        except:
-            self._error(pErrorCode)
+        if self.poller is not None:
+            self.poller.unregister(self)
+        with _buses_lock:
+            bus = self.bus
+            if bus is None:
+                return pErrorCode.value
+            self.bus = None
+            bus.refs -= 1
+            if bus.refs > 0:
+                return pErrorCode.value
+            if _buses.get((bus.epos, bus.port)) is bus:
+                del _buses[(bus.epos, bus.port)]
+            if bus.poller is not None:
+                bus.poller.stop()
+            if bus.executor is not None:
+                bus.executor.shutdown(wait = False)
+            with bus.lock:
+                try:
+                    if not self.epos.VCS_CloseDevice(bus.keyHandle, byref(pErrorCode)): # close device
+                        raise Exception("An Error has occurred, exiting...")
+                except:
+                    self._error(pErrorCode)
         return pErrorCode.value
     
     # Initialize pump object and enable drive
+    @_locked
     def _nemesys_init(self):
         pErrorCode = c_uint()
+        self._snapshot = None
+        self._invalidate_shadow()
         try:
-            if not epos.VCS_ClearFault(self.keyHandle, self.nodeID, byref(pErrorCode)): # clear all faults
+            if not self.epos.VCS_ClearFault(self.keyHandle, self.nodeID, byref(pErrorCode)): # clear all faults
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
         try:
-            if not epos.VCS_SetEnableState(self.keyHandle, self.nodeID, byref(pErrorCode)): # enable device
+            if not self.epos.VCS_SetEnableState(self.keyHandle, self.nodeID, byref(pErrorCode)): # enable device
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
         return pErrorCode.value
     
+    # Enable the drive only if it is not enabled already, one transaction when it is
+    @_locked
+    def _ensure_enabled(self):
+        buf = self._buf
+        try:
+            if not self.epos.VCS_GetState(self.keyHandle, self.nodeID, buf.pState, buf.pErrorCode):
+                raise Exception("An Error has occurred, exiting...")
+        except:
+            self._error(buf.errorCode)
+            return self._nemesys_init()
+        if buf.state.value == 1: # ENABLED
+            return 0
+        return self._nemesys_init()
+
+    # Reopen the bus handle and re-enable the drive if needed, keeping the conversion factors and the homing done on the drive.
+    # The handle is shared: it is really reopened once every pump of the port has let it go. The poller and its subscribers are kept.
+    def _reconnect(self):
+        poller = self.poller
+        self._bus_close()
+        self.keyHandle = self._bus_open(self.port)
+        if poller is not None:
+            with _buses_lock:
+                if self.bus.poller is None: # the old handle was closed with its poller, which keeps its subscribers
+                    self.bus.poller = poller
+            self._poll()
+        pErrorCode = self._ensure_enabled()
+        self._restore_state()
+        return pErrorCode
+
     # Disable pump device
+    @_priority
     def _nemesys_disable(self):
         pErrorCode = c_uint()
+        self._snapshot = None
         try:
-            if not epos.VCS_SetDisableState(self.keyHandle, self.nodeID, byref(pErrorCode)): # disable device  
+            if not self.epos.VCS_SetDisableState(self.keyHandle, self.nodeID, byref(pErrorCode)): # disable device  
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
         return pErrorCode.value
     
     # Query actual motor position
-    def _get_position(self):
-        pPositionIs = c_int32()
-        pErrorCode = c_uint()
+    @_locked
+    def _get_position(self, cached = False):
+        if cached:
+            return self.snapshot().position
+        buf = self._buf
         try:
-            if not epos.VCS_GetPositionIs(self.keyHandle, self.nodeID, byref(pPositionIs), byref(pErrorCode)):
+            if not self.epos.VCS_GetPositionIs(self.keyHandle, self.nodeID, buf.pPosition, buf.pErrorCode):
                 raise Exception("An Error has occurred, exiting...")
         except:
-            self._error(pErrorCode)
-        return pPositionIs.value # motor steps
+            self._error(buf.errorCode)
+        return buf.position.value # motor steps
     
     # Query actual motor velocity
-    def _get_velocity(self):
-        pVelocityIs = c_int32()
-        pErrorCode = c_uint()
+    @_locked
+    def _get_velocity(self, cached = False):
+        if cached:
+            return self.snapshot().velocity
+        buf = self._buf
         try:
-            if not epos.VCS_GetVelocityIsAveraged(self.keyHandle, self.nodeID, byref(pVelocityIs), byref(pErrorCode)):
+            if not self.epos.VCS_GetVelocityIsAveraged(self.keyHandle, self.nodeID, buf.pVelocity, buf.pErrorCode):
                 raise Exception("An Error has occurred, exiting...")
         except:
-            self._error(pErrorCode)
-        return pVelocityIs.value # motor speed
+            self._error(buf.errorCode)
+        return buf.velocity.value # motor speed
     
     # Homing move at the positive limit switch
     def _reference_pos_lim(self, wait = True):
         pErrorCode = c_uint()
-        homingAcceleration = c_uint32(200000)
-        speedSwitch = c_uint32(2000000)
-        speedIndex = c_uint32(10000)
-        homeOffset = c_int32(20000)
-        currentThreshold = c_uint32(200)
-        homePosition = c_int32(0)
-        truePosition = self._get_position()
-        try:
-            if not epos.VCS_ActivateHomingMode(self.keyHandle, self.nodeID, byref(pErrorCode)): # activate homing mode
-                raise Exception("An Error has occurred, exiting...")
-        except:
-            self._error(pErrorCode)
-        try:
-            if not epos.VCS_SetHomingParameter(self.keyHandle, self.nodeID, homingAcceleration, speedSwitch, speedIndex, homeOffset, currentThreshold, homePosition, byref(pErrorCode)): # homing settings
-                raise Exception("An Error has occurred, exiting...")
-        except:
-            self._error(pErrorCode)
-        try:
-            if not epos.VCS_FindHome(self.keyHandle, self.nodeID, c_int8(18), byref(pErrorCode)): # homing motion
-                raise Exception("An Error has occurred, exiting...")
-        except:
-            self._error(pErrorCode)
-        if wait == True:
-            while truePosition != 0:
-                truePosition = self._get_position()
-                print('\rPumpID: %1d Motor position: %5d ul Velocity: %3.2f ul/s Moving: %5s  Target Reached: %5s  Valve open: %5s' % (self.nodeID, truePosition/self.ul, self._get_velocity()/self.uls, self._is_moving(), self._is_target_reached(), self._is_valve_open()), end='', flush = True)
+        self._snapshot = None
+        homingAcceleration = 200000
+        speedSwitch = 2000000
+        speedIndex = 10000
+        homeOffset = 20000
+        currentThreshold = 200
+        homePosition = 0
+        with self.bus.lock:
+            try:
+                self._activate_mode(6, pErrorCode) # activate homing mode
+            except:
+                self._error(pErrorCode)
+            try:
+                if not self.epos.VCS_SetHomingParameter(self.keyHandle, self.nodeID, homingAcceleration, speedSwitch, speedIndex, homeOffset, currentThreshold, homePosition, byref(pErrorCode)): # homing settings
+                    raise Exception("An Error has occurred, exiting...")
+            except:
+                self._error(pErrorCode)
+            try:
+                self._stopped.clear()
+                if not self.epos.VCS_FindHome(self.keyHandle, self.nodeID, c_int8(18), byref(pErrorCode)): # homing motion
+                    raise Exception("An Error has occurred, exiting...")
+                self._remember(referenced = False)
+            except:
+                self._error(pErrorCode)
+        if wait == True and pErrorCode.value == 0:
+            self.last_motion = self._wait_motion(homing = True)
         return pErrorCode.value
             
     # Homing move at the negative limit switch
     def _reference_neg_lim(self, wait = True):
         pErrorCode = c_uint()
+        self._snapshot = None
         homingAcceleration = 200000
         speedSwitch = 2000000
         speedIndex = 10000
         homeOffset = 20000
         currentThreshold = 200
         homePosition = 0
-        truePosition = self._get_position()
-        try:
-            if not epos.VCS_ActivateHomingMode(self.keyHandle, self.nodeID, byref(pErrorCode)): # activate homing mode
-                raise Exception("An Error has occurred, exiting...")
-        except:
-            self._error(pErrorCode)
-        try:
-            if not epos.VCS_SetHomingParameter(self.keyHandle, self.nodeID, homingAcceleration, speedSwitch, speedIndex, homeOffset, currentThreshold, homePosition, byref(pErrorCode)): # homing settings
-                raise Exception("An Error has occurred, exiting...")
-        except:
-            self._error(pErrorCode)
-        try:
-            if not epos.VCS_FindHome(self.keyHandle, self.nodeID, c_int8(17), byref(pErrorCode)): # homing motion
-                raise Exception("An Error has occurred, exiting...")
-        except:
-            self._error(pErrorCode)
-        if wait == True:
-            while truePosition != homePosition:
-                truePosition = self._get_position()
-                print('\rPump ID: %1d Motor position: %5d ul Velocity: %3.2f ul/s Moving: %5s  Target Reached: %5s  Valve open: %5s' % (self.nodeID, truePosition/self.ul, self._get_velocity()/self.uls, self._is_moving(), self._is_target_reached(), self._is_valve_open()), end='', flush = True)
-        return pErrorCode.value
-    
-    # Move to position at speed
-    def _move_to_position_speed(self, targetPosition, targetSpeed, wait = True):
-        pErrorCode = c_uint()
-        try:
-            if not epos.VCS_ActivateProfilePositionMode(self.keyHandle, self.nodeID, byref(pErrorCode)): # activate profile position mode
-                raise Exception("An Error has occurred, exiting...")
-        except:
-            self._error(pErrorCode)
-        # Configure desired motion profile
-        acceleration = 200000 # rpm/s, up to 1e7 would be possible
-        deceleration = 200000 # rpm/s
-        truePosition = self._get_position()
-        newpos = c_int32(int(targetPosition*self.ul))
-        newvel = c_uint32(int(targetSpeed*self.uls))
-        if targetSpeed != 0:
+        with self.bus.lock:
             try:
-                if not epos.VCS_SetPositionProfile(self.keyHandle, self.nodeID, newvel.value, acceleration, deceleration, byref(pErrorCode)): # set profile parameters
-                    raise Exception("An Error has occurred, exiting...")
+                self._activate_mode(6, pErrorCode) # activate homing mode
             except:
                 self._error(pErrorCode)
             try:
-                if not epos.VCS_MoveToPosition(self.keyHandle, self.nodeID, newpos.value, True, True, byref(pErrorCode)): # move to position
+                if not self.epos.VCS_SetHomingParameter(self.keyHandle, self.nodeID, homingAcceleration, speedSwitch, speedIndex, homeOffset, currentThreshold, homePosition, byref(pErrorCode)): # homing settings
                     raise Exception("An Error has occurred, exiting...")
             except:
                 self._error(pErrorCode)
-            if wait == True:
-                while truePosition != targetPosition*self.ul:
-                    truePosition = self._get_position()
-                    print('\rPump ID: %1d Motor position: %5d ul Velocity: %3.2f ul/s Moving: %5s  Target Reached: %5s  Valve open: %5s' % (self.nodeID, truePosition/self.ul, self._get_velocity()/self.uls, self._is_moving(), self._is_target_reached(), self._is_valve_open()), end='', flush = True)
-        elif targetSpeed == 0:
             try:
-                if not epos.VCS_HaltPositionMovement(self.keyHandle, self.nodeID, byref(pErrorCode)): # halt motor
+                self._stopped.clear()
+                if not self.epos.VCS_FindHome(self.keyHandle, self.nodeID, c_int8(17), byref(pErrorCode)): # homing motion
                     raise Exception("An Error has occurred, exiting...")
+                self._remember(referenced = False)
+            except:
+                self._error(pErrorCode)
+        if wait == True and pErrorCode.value == 0:
+            self.last_motion = self._wait_motion(homing = True)
+        return pErrorCode.value
+    
+    # Move to position at speed
+    def _move_to_position_speed(self, targetPosition, targetSpeed, wait = True):
+        pErrorCode = c_uint()
+        self._snapshot = None
+        with self.bus.lock:
+            try:
+                self._activate_mode(1, pErrorCode) # activate profile position mode
             except:
                 self._error(pErrorCode)
+            # Configure desired motion profile
+            acceleration = 200000 # rpm/s, up to 1e7 would be possible
+            deceleration = 200000 # rpm/s
+            truePosition = self._get_position()
+            newpos = c_int32(int(targetPosition*self.ul))
+            newvel = c_uint32(int(targetSpeed*self.uls))
+            if targetSpeed != 0:
+                try:
+                    self._position_profile(newvel.value, acceleration, deceleration, pErrorCode) # set profile parameters
+                except:
+                    self._error(pErrorCode)
+                try:
+                    self._stopped.clear()
+                    if not self.epos.VCS_MoveToPosition(self.keyHandle, self.nodeID, newpos.value, True, True, byref(pErrorCode)): # move to position
+                        raise Exception("An Error has occurred, exiting...")
+                except:
+                    self._error(pErrorCode)
+            elif targetSpeed == 0:
+                try:
+                    if not self.epos.VCS_HaltPositionMovement(self.keyHandle, self.nodeID, byref(pErrorCode)): # halt motor
+                        raise Exception("An Error has occurred, exiting...")
+                except:
+                    self._error(pErrorCode)
+        if wait == True and targetSpeed != 0 and pErrorCode.value == 0:
+            estimate = self._motion_time(abs(newpos.value - truePosition), newvel.value, acceleration, deceleration)
+            self.last_motion = self._wait_motion(estimate, target = newpos.value)
         return pErrorCode.value
             
     # Set speed but doesn't move
+    @_locked
     def _set_speed(self, targetSpeed):
         pErrorCode = c_uint()
+        self._snapshot = None
         try:
-            if not epos.VCS_ActivateProfilePositionMode(self.keyHandle, self.nodeID, byref(pErrorCode)): # activate profile position mode
-                raise Exception("An Error has occurred, exiting...")
+            self._activate_mode(1, pErrorCode) # activate profile position mode
         except:
             self._error(pErrorCode)
         # Configure desired motion profile
@@ -237,19 +817,17 @@ class Nemesys:
         newvel = c_uint32(int(targetSpeed*self.uls))
         if targetSpeed != 0:
             try:
-                if not epos.VCS_SetPositionProfile(self.keyHandle, self.nodeID, newvel.value, acceleration, deceleration, byref(pErrorCode)): # set profile parameters
-                    raise Exception("An Error has occurred, exiting...")
+                self._position_profile(newvel.value, acceleration, deceleration, pErrorCode) # set profile parameters
             except:
                 self._error(pErrorCode)
             try:
-                if not epos.VCS_GetPositionProfile(self.keyHandle, self.nodeID, byref(pVelocity), byref(pAcc), byref(pDec), byref(pErrorCode)): # get profile parameters
-                    raise Exception("An Error has occurred, exiting...")
+                pVelocity.value = self._read_position_profile(pErrorCode)[0] # get profile parameters
             except:
                 self._error(pErrorCode)
             print('\nPump ID: %1d New set velocity value: %3.2f ul/s \n' % (self.nodeID, pVelocity.value/self.uls))
         elif targetSpeed == 0:
             try:
-                if not epos.VCS_HaltPositionMovement(self.keyHandle, self.nodeID, byref(pErrorCode)): # halt motor
+                if not self.epos.VCS_HaltPositionMovement(self.keyHandle, self.nodeID, byref(pErrorCode)): # halt motor
                     raise Exception("An Error has occurred, exiting...")
             except:
                 self._error(pErrorCode)
@@ -257,6 +835,7 @@ class Nemesys:
         return pErrorCode.value
             
     # Get set speed (not instantaneous)
+    @_locked
     def _get_set_speed(self):
         pErrorCode = c_uint()
         pVelocity = c_uint32()
@@ -264,14 +843,12 @@ class Nemesys:
         pDec = c_uint32()
         pMode = c_int8()
         try:
-            if not epos.VCS_GetOperationMode(self.keyHandle, self.nodeID, byref(pMode), byref(pErrorCode)): # Check if device is in profile position mode
-                raise Exception("An Error has occurred, exiting...")
+            pMode.value = self._operation_mode(pErrorCode) # Check if device is in profile position mode
         except:
             self._error(pErrorCode)
         if pMode.value == 1:
             try:
-                if not epos.VCS_GetPositionProfile(self.keyHandle, self.nodeID, byref(pVelocity), byref(pAcc), byref(pDec), byref(pErrorCode)): # get profile parameters
-                    raise Exception("An Error has occurred, exiting...")
+                pVelocity.value, pAcc.value, pDec.value = self._read_position_profile(pErrorCode) # get profile parameters
             except:
                 self._error(pErrorCode)
             print('\nPump ID: %1d Set velocity value: %3.2f ul/s \n' % (self.nodeID, pVelocity.value/self.uls))
@@ -283,162 +860,858 @@ class Nemesys:
     # Move to position with set speed
     def _move_at_set_speed(self, targetPosition, wait = True):
         pErrorCode = c_uint()
+        self._snapshot = None
         pMode = c_int8()
+        pVelocity = c_uint32()
+        pAcc = c_uint32()
+        pDec = c_uint32()
+        newpos = c_int32(int(targetPosition*self.ul))
+        with self.bus.lock:
+            try:
+                pMode.value = self._operation_mode(pErrorCode) # Check if device is in profile position mode
+            except:
+                self._error(pErrorCode)
+            truePosition = self._get_position()
+            if pMode.value == 1:
+                if wait == True:
+                    try:
+                        pVelocity.value, pAcc.value, pDec.value = self._read_position_profile(pErrorCode) # get profile parameters for the completion estimate
+                    except:
+                        self._error(pErrorCode)
+                try:
+                    self._stopped.clear()
+                    if not self.epos.VCS_MoveToPosition(self.keyHandle, self.nodeID, newpos.value, True, True, byref(pErrorCode)): # move to position
+                        raise Exception("An Error has occurred, exiting...")
+                except:
+                    self._error(pErrorCode)
+            else:
+                print("\n!! You have to set the speed first !!\n")
+        if wait == True and pMode.value == 1 and pErrorCode.value == 0:
+            estimate = self._motion_time(abs(newpos.value - truePosition), pVelocity.value, pAcc.value, pDec.value)
+            self.last_motion = self._wait_motion(estimate, target = newpos.value)
+        return pErrorCode.value
+            
+    # Preload profile position mode, profile and target of a move without starting it, see _start_move.
+    # With deferred the target is written to the object dictionary and the move is later started by the controlword alone.
+    @_locked
+    def _prepare_move(self, targetPosition, targetSpeed, deferred = False):
+        pErrorCode = c_uint()
+        pNbOfBytesWritten = c_uint()
+        self._snapshot = None
+        self._pending = None
+        acceleration = 200000 # rpm/s
+        deceleration = 200000 # rpm/s
         newpos = c_int32(int(targetPosition*self.ul))
+        newvel = c_uint32(int(targetSpeed*self.uls))
         try:
-            if not epos.VCS_GetOperationMode(self.keyHandle, self.nodeID, byref(pMode), byref(pErrorCode)): # Check if device is in profile position mode
-                raise Exception("An Error has occurred, exiting...")
+            self._activate_mode(1, pErrorCode) # activate profile position mode
+            self._position_profile(newvel.value, acceleration, deceleration, pErrorCode) # set profile parameters
+            if deferred:
+                if not self.epos.VCS_SetObject(self.keyHandle, self.nodeID, 0x607A, 0, byref(newpos), 4, byref(pNbOfBytesWritten), byref(pErrorCode)): # target position
+                    raise Exception("An Error has occurred, exiting...")
+                controlword = c_uint16(0x000F) # enable operation, new setpoint bit low so the trigger is a rising edge
+                if not self.epos.VCS_SetObject(self.keyHandle, self.nodeID, 0x6040, 0, byref(controlword), 2, byref(pNbOfBytesWritten), byref(pErrorCode)):
+                    raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
+            return pErrorCode.value
         truePosition = self._get_position()
-        if pMode.value == 1:
+        self._pending = (newpos.value, self._motion_time(abs(newpos.value - truePosition), newvel.value, acceleration, deceleration))
+        return pErrorCode.value
+
+    # Start the move preloaded by _prepare_move, a single transaction
+    @_locked
+    def _start_move(self, deferred = False):
+        pErrorCode = c_uint()
+        pNbOfBytesWritten = c_uint()
+        self._snapshot = None
+        if self._pending is None:
+            print("\n!! Pump ID: %1d has no move prepared !!\n" % self.nodeID)
+            return -1
+        self._stopped.clear()
+        try:
+            if deferred:
+                controlword = c_uint16(0x003F) # enable operation, new setpoint, change immediately, absolute target
+                if not self.epos.VCS_SetObject(self.keyHandle, self.nodeID, 0x6040, 0, byref(controlword), 2, byref(pNbOfBytesWritten), byref(pErrorCode)):
+                    raise Exception("An Error has occurred, exiting...")
+            else:
+                if not self.epos.VCS_MoveToPosition(self.keyHandle, self.nodeID, self._pending[0], True, True, byref(pErrorCode)): # move to position
+                    raise Exception("An Error has occurred, exiting...")
+        except:
+            self._error(pErrorCode)
+        return pErrorCode.value
+
+    # Buffer a move behind the one in progress (non-immediate set point), the drive starts it when the current target is reached.
+    # The profile written here is latched with the buffered set point, the move in progress keeps its own.
+    @_locked
+    def _queue_move(self, targetPosition, targetSpeed):
+        pErrorCode = c_uint()
+        self._snapshot = None
+        acceleration = 200000 # rpm/s
+        deceleration = 200000 # rpm/s
+        newpos = c_int32(int(targetPosition*self.ul))
+        newvel = c_uint32(int(targetSpeed*self.uls))
+        try:
+            self._position_profile(newvel.value, acceleration, deceleration, pErrorCode) # set profile parameters
+            self._stopped.clear()
+            if not self.epos.VCS_MoveToPosition(self.keyHandle, self.nodeID, newpos.value, True, False, byref(pErrorCode)): # absolute, not immediately
+                raise Exception("An Error has occurred, exiting...")
+        except:
+            self._error(pErrorCode)
+        return pErrorCode.value
+
+    # Constant flow in profile velocity mode, rate ul/s > 0 doses and < 0 aspirates. The flow guard ends it with a position
+    # move onto the limit after volume ul, or at the end of the syringe, so the plunger never runs into the end stop.
+    def start_flow(self, rate, volume = None):
+        pErrorCode = c_uint()
+        self._snapshot = None
+        self.stop_flow(halt = False)
+        acceleration = 200000 # rpm/s
+        deceleration = 200000 # rpm/s
+        newvel = c_long(int(rate*self.uls))
+        with self.bus.lock:
             try:
-                if not epos.VCS_MoveToPosition(self.keyHandle, self.nodeID, newpos.value, True, True, byref(pErrorCode)): # move to position
+                self._activate_mode(3, pErrorCode) # activate profile velocity mode
+                self._velocity_profile(acceleration, deceleration, pErrorCode) # set profile parameters
+                start = self._get_position()
+                lower = -int(self._syringe_volume()*self.ul) # full syringe
+                upper = 0 # empty syringe
+                if volume is not None and rate > 0:
+                    upper = min(upper, start + int(abs(volume)*self.ul))
+                elif volume is not None and rate < 0:
+                    lower = max(lower, start - int(abs(volume)*self.ul))
+                self._flow = [rate, lower, upper]
+                self._stopped.clear()
+                if not self.epos.VCS_MoveWithVelocity(self.keyHandle, self.nodeID, newvel.value, byref(pErrorCode)): # start moving
                     raise Exception("An Error has occurred, exiting...")
             except:
+                self._flow = None
                 self._error(pErrorCode)
-            if wait == True:
-                while truePosition != targetPosition*self.ul:
-                    truePosition = self._get_position()
-                    print('\rPump ID: %1d Motor position: %5d ul Velocity: %3.2f ul/s Moving: %5s  Target Reached: %5s  Valve open: %5s' % (self.nodeID, truePosition/self.ul, self._get_velocity()/self.uls, self._is_moving(), self._is_target_reached(), self._is_valve_open()), end='', flush = True)
-        else:
-            print("\n!! You have to set the speed first !!\n")
+                return pErrorCode.value
+        self._flow_wake.clear()
+        self._flow_guard = threading.Thread(target = self._guard_flow, args = (deceleration,), name = "nemesys-flow-guard-%d" % self.nodeID, daemon = True)
+        self._flow_guard.start()
         return pErrorCode.value
-            
-    # Halt the motor
-    def _halt(self):
+
+    # Change the rate of a running flow, one transaction
+    @_locked
+    def set_flow(self, rate):
         pErrorCode = c_uint()
+        self._snapshot = None
+        if self._flow is None:
+            print("\n!! Pump ID: %1d is not flowing, use start_flow !!\n" % self.nodeID)
+            return -1
+        self._flow[0] = rate
+        self._flow_wake.set()
         try:
-            if not epos.VCS_HaltPositionMovement(self.keyHandle, self.nodeID, byref(pErrorCode)): # halt motor
+            if not self.epos.VCS_MoveWithVelocity(self.keyHandle, self.nodeID, int(rate*self.uls), byref(pErrorCode)):
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
+        return pErrorCode.value
+
+    # Stop a flow started by start_flow
+    def stop_flow(self, halt = True):
+        pErrorCode = c_uint()
+        flowing = self._flow is not None
+        self._flow = None
+        self._flow_wake.set()
+        if self._flow_guard is not None and self._flow_guard is not threading.current_thread():
+            self._flow_guard.join()
+            self._flow_guard = None
+        if halt and flowing:
+            with self.bus.lock.priority():
+                self._snapshot = None
+                try:
+                    if not self.epos.VCS_HaltVelocityMovement(self.keyHandle, self.nodeID, byref(pErrorCode)): # halt motor
+                        raise Exception("An Error has occurred, exiting...")
+                except:
+                    self._error(pErrorCode)
+                self._remember_position(self._get_position()) # still braking, a restart then just does not trust it
+        return pErrorCode.value
+
+    # Watch the position of a flow, polled faster as the limit in the flow direction gets closer
+    def _guard_flow(self, deceleration):
+        dec = deceleration/(self.uls*self.vel_notation) # ul/s2, accelerations are in rpm/s
+        flow = self._flow
+        while flow is not None and self._flow is flow:
+            rate, lower, upper = flow
+            position = self._get_position()
+            distance = ((upper - position) if rate > 0 else (position - lower))/self.ul if rate != 0 else float("inf")
+            margin = abs(rate)*2*self.poll_period + rate**2/(2*dec) # ul covered before the next poll, plus the braking distance
+            if distance <= margin:
+                with self.bus.lock:
+                    if self._flow is not flow:
+                        return
+                    self._flow = None
+                    self._move_to_position_speed((upper if rate > 0 else lower)/self.ul, abs(rate), wait = False) # land on the limit in profile position mode
+                self._remember_position(upper if rate > 0 else lower)
+                print("\nPump ID: %1d Flow stopped at the volume limit" % self.nodeID)
+                return
+            self._flow_wake.wait(min(1.0, max(self.poll_period, (distance - margin)/abs(rate) - self.poll_period)) if rate != 0 else 1.0)
+            self._flow_wake.clear()
+
+    # Interpolated position mode with an empty PVT buffer, returns the buffer size in points, 0 on error
+    @_locked
+    def _ipm_setup(self, underflow_warning = 10, overflow_warning = 60):
+        pErrorCode = c_uint()
+        self._snapshot = None
+        underflow = c_ushort()
+        overflow = c_ushort()
+        size = c_uint()
+        try:
+            self._activate_mode(7, pErrorCode) # activate interpolated position mode
+            if not self.epos.VCS_SetIpmBufferParameter(self.keyHandle, self.nodeID, underflow_warning, overflow_warning, byref(pErrorCode)): # buffer warning levels
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_ClearIpmBuffer(self.keyHandle, self.nodeID, byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_GetIpmBufferParameter(self.keyHandle, self.nodeID, byref(underflow), byref(overflow), byref(size), byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+        except:
+            self._error(pErrorCode)
+            return 0
+        return size.value
+
+    # Free points in the PVT buffer, -1 on error
+    @_locked
+    def _ipm_free(self):
+        pErrorCode = c_uint()
+        free = c_uint()
         try:
-            if notepos.VCS_ClearFault(self.keyHandle, self.nodeID, byref(pErrorCode)): # clear all faults
+            if not self.epos.VCS_GetFreeIpmBufferSize(self.keyHandle, self.nodeID, byref(free), byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+        except:
+            self._error(pErrorCode)
+            return -1
+        return free.value
+
+    # Append PVT points (position qc, velocity in drive units, time ms) to the buffer, returns how many were accepted.
+    # The bus lock is taken per point so a halt can get in between.
+    def _ipm_add(self, points):
+        pErrorCode = c_uint()
+        added = 0
+        for position, velocity, duration in points:
+            with self.bus.lock:
+                try:
+                    if not self.epos.VCS_AddPvtValueToIpmBuffer(self.keyHandle, self.nodeID, position, velocity, duration, byref(pErrorCode)):
+                        raise Exception("An Error has occurred, exiting...")
+                except:
+                    self._error(pErrorCode)
+                    return added
+            added += 1
+        return added
+
+    # Start the trajectory in the PVT buffer
+    @_locked
+    def _ipm_start(self):
+        pErrorCode = c_uint()
+        self._snapshot = None
+        try:
+            self._stopped.clear()
+            if not self.epos.VCS_StartIpmTrajectory(self.keyHandle, self.nodeID, byref(pErrorCode)):
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
         return pErrorCode.value
-    
-    # Check if motor has reached target
-    def _is_target_reached(self):
+
+    # Stop the trajectory with the quick stop deceleration
+    @_priority
+    def _ipm_stop(self):
         pErrorCode = c_uint()
-        pTargetReached = c_long()
+        self._snapshot = None
         try:
-            if not epos.VCS_GetMovementState(self.keyHandle, self.nodeID, byref(pTargetReached), byref(pErrorCode)):
+            if not self.epos.VCS_StopIpmTrajectory(self.keyHandle, self.nodeID, byref(pErrorCode)):
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
-        return bool(pTargetReached.value)
-    
-    # Check if motor is moving
-    def _is_moving(self):
+        return pErrorCode.value
+
+    @_locked
+    def _ipm_status(self):
         pErrorCode = c_uint()
-        pVelocityIs = c_long()
+        flags = [c_int() for field in IpmStatus._fields]
         try:
-            if not epos.VCS_GetVelocityIs(self.keyHandle, self.nodeID, byref(pVelocityIs), byref(pErrorCode)):
+            if not self.epos.VCS_GetIpmStatus(self.keyHandle, self.nodeID, *[byref(flag) for flag in flags], byref(pErrorCode)):
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
-        return bool(pVelocityIs)
-    
-    # Check if valve is open
-    def _is_valve_open(self):
+            return None
+        return IpmStatus(*[bool(flag.value) for flag in flags])
+
+    # Arm the data recorder: the channels are sampled every sampling_period_ms from the next movement start on,
+    # preceding_samples from before it are kept (start the move no sooner than that many periods after arming).
+    # The drive memory is shared by the channels: the fewer the channels, the longer the recording.
+    @_locked
+    def _recorder_arm(self, channels = ("position", "velocity"), sampling_period_ms = 1.0, preceding_samples = 0):
         pErrorCode = c_uint()
-        current_state = c_ushort()
+        unknown = [name for name in channels if name not in RECORDER_CHANNELS]
+        if unknown or not 1 <= len(channels) <= 4:
+            print("\nPump ID: %1d Record 1 to 4 channels among %s" % (self.nodeID, ", ".join(RECORDER_CHANNELS)))
+            return -1
+        period = max(1, int(round(sampling_period_ms/1000/self.recorder_cycle)))
+        self._recording = None
         try:
-            if not epos.VCS_GetAllDigitalOutputs(self.keyHandle, self.nodeID, byref(current_state), byref(pErrorCode)): # Get digital output word
+            if not self.epos.VCS_StopRecorder(self.keyHandle, self.nodeID, byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_DeactivateAllChannels(self.keyHandle, self.nodeID, byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+            for number, name in enumerate(channels, 1):
+                index, subindex, size, unit = RECORDER_CHANNELS[name]
+                if not self.epos.VCS_ActivateChannel(self.keyHandle, self.nodeID, number, index, subindex, size, byref(pErrorCode)):
+                    raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_SetRecorderParameter(self.keyHandle, self.nodeID, period, preceding_samples, byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_DisableAllTriggers(self.keyHandle, self.nodeID, byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_EnableTrigger(self.keyHandle, self.nodeID, 1, byref(pErrorCode)): # trigger on movement start
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_StartRecorder(self.keyHandle, self.nodeID, byref(pErrorCode)):
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
-        if (current_state.value & 0x1000) == 0x1000:
-            return True
+            return pErrorCode.value
+        self._recording = (tuple(channels), period*self.recorder_cycle, preceding_samples)
+        return pErrorCode.value
+
+    # Stop the recorder and read every channel in one bulk transfer each, None on error.
+    # Values are numpy arrays when numpy is available: positions in ul, velocities in ul/s, currents in mA.
+    @_locked
+    def _recorder_read(self, stop = True):
+        if self._recording is None:
+            print("\nPump ID: %1d Data recorder not armed" % self.nodeID)
+            return None
+        channels, period, preceding = self._recording
+        pErrorCode = c_uint()
+        triggered = c_int()
+        samples = c_uint()
+        raw = {}
+        try:
+            if stop:
+                if not self.epos.VCS_StopRecorder(self.keyHandle, self.nodeID, byref(pErrorCode)):
+                    raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_IsRecorderTriggered(self.keyHandle, self.nodeID, byref(triggered), byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_ReadChannelVectorSize(self.keyHandle, self.nodeID, byref(samples), byref(pErrorCode)): # samples per channel
+                raise Exception("An Error has occurred, exiting...")
+            for number, name in enumerate(channels, 1):
+                size = RECORDER_CHANNELS[name][2]
+                vector = (c_ubyte*(samples.value*size))()
+                if not self.epos.VCS_ReadChannelDataVector(self.keyHandle, self.nodeID, number, vector, len(vector), byref(pErrorCode)):
+                    raise Exception("An Error has occurred, exiting...")
+                raw[name] = bytes(vector)
+        except:
+            self._error(pErrorCode)
+            return None
+        scales = {"qc": self.ul, "velocity": self.uls, "mA": 1}
+        data = {}
+        for name, vector in raw.items():
+            size, unit = RECORDER_CHANNELS[name][2:]
+            if numpy is not None:
+                data[name] = numpy.frombuffer(vector, dtype = "<i%d" % size)/scales[unit]
+            else:
+                data[name] = [int.from_bytes(vector[i:i + size], "little", signed = True)/scales[unit] for i in range(0, len(vector), size)]
+        shift = preceding if triggered.value else 0 # sample at the trigger is time 0
+        if numpy is not None:
+            times = (numpy.arange(samples.value) - shift)*period
         else:
+            times = [(i - shift)*period for i in range(samples.value)]
+        return Recording(self.nodeID, period, times, data, bool(triggered.value))
+
+    # Move with the data recorder armed, returns the Recording of the move
+    def _record_move(self, targetPosition, targetSpeed, channels = ("position", "velocity"), sampling_period_ms = 1.0, preceding_samples = 0):
+        if self._recorder_arm(channels, sampling_period_ms, preceding_samples) != 0:
+            return None
+        time.sleep(self._recording[1]*preceding_samples) # let the preceding samples fill up
+        self._move_to_position_speed(targetPosition, targetSpeed, wait = True)
+        return self._recorder_read()
+
+    # Persisted state: fields are written to the state store only when they change
+    def _remember(self, **fields):
+        entry = dict(self._state or {}, serial = self._serial)
+        entry.update(fields)
+        if entry != self._state:
+            self._state = entry
+            self._states.put(self._key, entry)
+
+    def _remember_position(self, position, homed = False):
+        fields = {"position": position, "fill_ul": max(0.0, -position/self.ul)}
+        if homed:
+            fields["referenced"] = True
+        self._remember(**fields)
+
+    # Check the state left by a previous process against the drive. Same serial, still referenced and at the persisted
+    # position: the drive was neither power cycled nor moved meanwhile, the homing and the profile are trusted (restored).
+    # The valve stays where it was last switched even across a power cycle, so the output word is aligned on it
+    # without powering the valve.
+    @_locked
+    def _restore_state(self):
+        pErrorCode = c_uint()
+        entry = self._state or self._states.get(self._key)
+        self.restored = False
+        if not entry or entry.get("serial") != self._serial:
+            self._state = None
+            return self.restored
+        self._state = entry
+        referenced = self._is_referenced()
+        position = self._get_position()
+        self.restored = bool(entry.get("referenced")) and referenced and abs(position - entry.get("position", 0)) <= self.restore_tolerance
+        if self.restored and entry.get("profile"):
+            self._shadow.setdefault("profile", tuple(entry["profile"]))
+        if "valve" in entry:
+            try:
+                outputs = self._outputs(pErrorCode)
+                if bool(outputs & 0x1000) != entry["valve"] and not outputs & 0x2000:
+                    self._write_outputs(outputs ^ 0x1000, pErrorCode) # position bit only, the valve does not move
+            except:
+                self._error(pErrorCode)
+        self._remember(referenced = referenced)
+        self._remember_position(position)
+        return self.restored
+
+    # Persisted state of the pump: referenced, position qc, fill_ul, profile, valve, and whether the drive confirmed it
+    def _persisted_state(self):
+        return dict(self._state or {}, restored = self.restored)
+
+    # Write-through shadow of the device parameters: unchanged values cost no transaction. Dropped on errors, faults,
+    # re-enable and reconnect, then read back or rewritten. The helpers raise like the inline calls, bus lock held.
+    def _invalidate_shadow(self):
+        self._shadow = {}
+
+    _MODE_FUNCTIONS = {1: "VCS_ActivateProfilePositionMode", 3: "VCS_ActivateProfileVelocityMode", 6: "VCS_ActivateHomingMode", 7: "VCS_ActivateInterpolatedPositionMode"}
+
+    def _activate_mode(self, mode, pErrorCode):
+        if self._shadow.get("mode") == mode:
+            return
+        if not getattr(self.epos, self._MODE_FUNCTIONS[mode])(self.keyHandle, self.nodeID, byref(pErrorCode)):
+            raise Exception("An Error has occurred, exiting...")
+        self._shadow["mode"] = mode
+
+    def _operation_mode(self, pErrorCode, fresh = False):
+        if fresh or "mode" not in self._shadow:
+            pMode = c_int8()
+            if not self.epos.VCS_GetOperationMode(self.keyHandle, self.nodeID, byref(pMode), byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+            self._shadow["mode"] = pMode.value
+        return self._shadow["mode"]
+
+    def _position_profile(self, velocity, acceleration, deceleration, pErrorCode):
+        profile = (velocity, acceleration, deceleration)
+        if self._shadow.get("profile") == profile:
+            return
+        if not self.epos.VCS_SetPositionProfile(self.keyHandle, self.nodeID, velocity, acceleration, deceleration, byref(pErrorCode)):
+            raise Exception("An Error has occurred, exiting...")
+        self._shadow["profile"] = profile
+        self._remember(profile = list(profile))
+
+    def _read_position_profile(self, pErrorCode):
+        if "profile" not in self._shadow:
+            pVelocity = c_uint32()
+            pAcc = c_uint32()
+            pDec = c_uint32()
+            if not self.epos.VCS_GetPositionProfile(self.keyHandle, self.nodeID, byref(pVelocity), byref(pAcc), byref(pDec), byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+            self._shadow["profile"] = (pVelocity.value, pAcc.value, pDec.value)
+        return self._shadow["profile"]
+
+    # Acceleration and deceleration are the objects of the position profile too
+    def _velocity_profile(self, acceleration, deceleration, pErrorCode):
+        profile = self._shadow.get("profile")
+        if profile is not None and profile[1:] == (acceleration, deceleration):
+            return
+        self._shadow.pop("profile", None)
+        if not self.epos.VCS_SetVelocityProfile(self.keyHandle, self.nodeID, acceleration, deceleration, byref(pErrorCode)):
+            raise Exception("An Error has occurred, exiting...")
+        if profile is not None:
+            self._shadow["profile"] = (profile[0], acceleration, deceleration)
+
+    def _outputs(self, pErrorCode):
+        if "outputs" not in self._shadow:
+            outputs = c_ushort()
+            if not self.epos.VCS_GetAllDigitalOutputs(self.keyHandle, self.nodeID, byref(outputs), byref(pErrorCode)):
+                raise Exception("An Error has occurred, exiting...")
+            self._shadow["outputs"] = outputs.value
+        return self._shadow["outputs"]
+
+    def _write_outputs(self, outputs, pErrorCode):
+        if self._shadow.get("outputs") == outputs:
+            return
+        self._shadow.pop("outputs", None)
+        if not self.epos.VCS_SetAllDigitalOutputs(self.keyHandle, self.nodeID, outputs, byref(pErrorCode)):
+            raise Exception("An Error has occurred, exiting...")
+        self._shadow["outputs"] = outputs
+
+    # Syringe volume in ul, the plunger travels from 0 (empty) down to minus this volume (full)
+    def _syringe_volume(self):
+        return math.pi*(self.syr_diam/2)**2*self.syr_str
+
+    # Expected duration in s of a trapezoidal profile move over distance qc
+    def _motion_time(self, distance, velocity, acceleration, deceleration):
+        if velocity <= 0 or acceleration <= 0 or deceleration <= 0:
+            return 0.0
+        distance_ul = distance/self.ul
+        velocity_ul = velocity/self.uls
+        ramps = velocity*self.vel_notation/acceleration + velocity*self.vel_notation/deceleration # s spent accelerating and decelerating, accelerations are in rpm/s
+        ramps_ul = 0.5*velocity_ul*ramps
+        if distance_ul >= ramps_ul:
+            return ramps + (distance_ul - ramps_ul)/velocity_ul
+        return ramps*(distance_ul/ramps_ul)**0.5 # triangular profile, top speed never reached
+    
+    # Wait for the end of a move to target qc or of a homing: sleep through the expected duration, then poll the drive.
+    # A halt or a homing stop ends the sleep.
+    def _wait_motion(self, estimate = 0.0, timeout = None, homing = False, target = None):
+        steps = self._motion_steps(estimate, timeout, homing, self.drive_wait, target)
+        value = None
+        while True:
+            try:
+                kind, arg = steps.send(value)
+            except StopIteration as done:
+                return done.value
+            if kind == "sleep":
+                self._stopped.wait(arg)
+                value = None
+            else:
+                value = arg()
+
+    # Completion policy of the move and homing waits, shared by _wait_motion and the asyncio API which only differ in
+    # how they sleep and call the drive: yields ("sleep", s) and ("call", function) steps, is sent back the call results,
+    # and returns the MotionResult after the bookkeeping (last_motion, persisted position, final progress report).
+    # A move is reached when the drive ends it within target_tolerance of target qc and not in fault: the target reached
+    # flag alone is also set by a halt.
+    def _motion_steps(self, estimate = 0.0, timeout = None, homing = False, drive_wait = False, target = None):
+        if timeout is None:
+            timeout = self.homing_timeout if homing else max(2*estimate, estimate + 10)
+        start = time.monotonic()
+        deadline = start + timeout
+        wake = start + max(0.0, estimate - self.poll_period)
+        polls = 0
+        reached = False
+        while True: # through the expected duration, in steps of the reporter interval
+            remaining = wake - time.monotonic()
+            interval = self.progress.interval
+            if remaining <= 0 or self._stopped.is_set():
+                break
+            yield "sleep", remaining if interval is None else min(remaining, interval)
+            if interval is not None:
+                self.progress(Progress(self.nodeID, time.monotonic() - start, estimate, False, None, 0, False))
+        if drive_wait:
+            while True: # in slices of poll_period, the bus is free in between for a halt or the other pumps
+                polls += 1
+                slice_ms = max(0, min(int(self.poll_period*1000), int((deadline - time.monotonic())*1000)))
+                reached = yield "call", functools.partial(self._wait_drive, slice_ms, homing)
+                if reached or self._stopped.is_set() or time.monotonic() >= deadline:
+                    break
+                self.progress(Progress(self.nodeID, time.monotonic() - start, estimate, reached, None, polls, False))
+        else:
+            while True:
+                polls += 1
+                if homing:
+                    reached, failed = yield "call", self._get_homing_state
+                    if failed:
+                        break
+                else:
+                    reached = yield "call", self._is_target_reached
+                if reached or self._stopped.is_set() or time.monotonic() >= deadline:
+                    break
+                self.progress(Progress(self.nodeID, time.monotonic() - start, estimate, reached, None, polls, False))
+                yield "sleep", self.poll_period
+        timedout = not reached and time.monotonic() >= deadline
+        truePosition = yield "call", self._get_position
+        if reached and not homing:
+            reached = target is None or abs(truePosition - target) <= self.target_tolerance*self.ul
+            if reached:
+                reached = (yield "call", self._read_state) != "FAULT"
+        elapsed = time.monotonic() - start
+        self._remember_position(truePosition, homed = homing and reached)
+        self.progress(Progress(self.nodeID, elapsed, estimate, reached, truePosition/self.ul, polls, True))
+        self.last_motion = MotionResult(self.nodeID, reached, truePosition, elapsed, polls, timedout)
+        return self.last_motion
+    
+    # Block inside the EPOS library until target reached or homing attained, False if not within timeout_ms
+    @_locked
+    def _wait_drive(self, timeout_ms, homing = False):
+        pErrorCode = c_uint()
+        try:
+            if homing:
+                if not self.epos.VCS_WaitForHomingAttained(self.keyHandle, self.nodeID, timeout_ms, byref(pErrorCode)):
+                    raise Exception("An Error has occurred, exiting...")
+            else:
+                if not self.epos.VCS_WaitForTargetReached(self.keyHandle, self.nodeID, timeout_ms, byref(pErrorCode)):
+                    raise Exception("An Error has occurred, exiting...")
+        except:
+            if pErrorCode.value != _ERROR_TIMEOUT: # still moving, the caller waits again
+                self._error(pErrorCode)
             return False
+        return True
     
-    # Switching of the 2-way valve connected to digital outputs C and D (bit 13 and 12, see Cetoni documentation)
-    def _switch_valve(self):
+    # Position still referenced to the home position (statusword bit 15): the drive has been homed since power on
+    @_locked
+    def _is_referenced(self):
         pErrorCode = c_uint()
-        current_state = c_ushort()
+        pNbOfBytesRead = c_uint()
+        statusword = c_uint16()
         try:
-            if not epos.VCS_GetAllDigitalOutputs(self.keyHandle, self.nodeID, byref(current_state), byref(pErrorCode)): # Get digital output word
+            if not self.epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x6041, 0, byref(statusword), 2, byref(pNbOfBytesRead), byref(pErrorCode)): # read statusword
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
-        newstate = c_ushort(current_state.value ^ 0x3000) # Flip bits 12 and 13 
+            return False
+        return (statusword.value & 0x8000) == 0x8000
+
+    # Abort a homing in progress
+    @_priority
+    def _stop_homing(self):
+        pErrorCode = c_uint()
+        self._snapshot = None
+        self._stopped.set()
         try:
-            if not epos.VCS_SetAllDigitalOutputs(self.keyHandle, self.nodeID, newstate, byref(pErrorCode)): # Send new digital output word
+            if not self.epos.VCS_StopHoming(self.keyHandle, self.nodeID, byref(pErrorCode)):
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
-        time.sleep(0.2)
+        return pErrorCode.value
+
+    # Query homing attained and homing error flags
+    @_locked
+    def _get_homing_state(self):
+        buf = self._buf
+        try:
+            if not self.epos.VCS_GetHomingState(self.keyHandle, self.nodeID, buf.pHomingAttained, buf.pHomingError, buf.pErrorCode):
+                raise Exception("An Error has occurred, exiting...")
+        except:
+            self._error(buf.errorCode)
+        return bool(buf.homingAttained.value), bool(buf.homingError.value)
+            
+    # Halt the motor
+    @_priority
+    def _halt(self):
+        pErrorCode = c_uint()
+        self._snapshot = None
+        self._stopped.set()
+        self._invalidate_shadow() # faults are cleared below
+        flowing = self._flow is not None
+        self._flow = None
+        self._flow_wake.set()
         try:
-            if not epos.VCS_GetAllDigitalOutputs(self.keyHandle, self.nodeID, byref(current_state), byref(pErrorCode)): # Get digital output word
+            if flowing:
+                if not self.epos.VCS_HaltVelocityMovement(self.keyHandle, self.nodeID, byref(pErrorCode)): # halt motor in profile velocity mode
+                    raise Exception("An Error has occurred, exiting...")
+            elif not self.epos.VCS_HaltPositionMovement(self.keyHandle, self.nodeID, byref(pErrorCode)): # halt motor
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
-        newstate = c_ushort(current_state.value ^ 0x2000) # Flip bit 13
         try:
-            if not epos.VCS_SetAllDigitalOutputs(self.keyHandle, self.nodeID, newstate, byref(pErrorCode)): # Send new digital output word
+            if not self.epos.VCS_ClearFault(self.keyHandle, self.nodeID, byref(pErrorCode)): # clear all faults
                 raise Exception("An Error has occurred, exiting...")
         except:
             self._error(pErrorCode)
-        time.sleep(0.01)
-        if (newstate.value & 0x1000) == 0x1000:
-            print("\nPump ID: %1d Valve has been opened!" %self.nodeID)
-        else:
-            print("\nPump ID: %1d Valve has been closed!" %self.nodeID)
         return pErrorCode.value
     
-    # Get internal data for conversions
-    def _get_conversion_data(self):
-        pErrorCode = c_uint()
-        pNbOfBytesRead = c_uint()
-        velexp = c_int8()
+    # Check if motor has reached target
+    @_locked
+    def _is_target_reached(self, cached = False):
+        if cached:
+            return self.snapshot().target_reached
+        buf = self._buf
         try:
-            if not epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x608B, 0, byref(velexp), 1, byref(pNbOfBytesRead), byref(pErrorCode)): #read velocity notation exponent
+            if not self.epos.VCS_GetMovementState(self.keyHandle, self.nodeID, buf.pTargetReached, buf.pErrorCode):
                 raise Exception("An Error has occurred, exiting...")
         except:
-            self._error(pErrorCode)
-        encres = c_uint32()
+            self._error(buf.errorCode)
+        return bool(buf.targetReached.value)
+    
+    # Check if motor is moving
+    @_locked
+    def _is_moving(self, cached = False):
+        if cached:
+            return self.snapshot().moving
+        buf = self._buf
         try:
-            if not epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x2210, 1, byref(encres), 4, byref(pNbOfBytesRead), byref(pErrorCode)): #read encoder resolution
+            if not self.epos.VCS_GetVelocityIs(self.keyHandle, self.nodeID, buf.pVelocity, buf.pErrorCode):
                 raise Exception("An Error has occurred, exiting...")
         except:
-            self._error(pErrorCode)
-        gearnum = c_uint32()
+            self._error(buf.errorCode)
+        return buf.velocity.value != 0
+    
+    # Check if valve is open
+    @_locked
+    def _is_valve_open(self, cached = False):
+        if cached:
+            return self.snapshot().valve_open
+        buf = self._buf
         try:
-            if not epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x200C, 1, byref(gearnum), 4, byref(pNbOfBytesRead), byref(pErrorCode)): #read gear factor numerator
+            if not self.epos.VCS_GetAllDigitalOutputs(self.keyHandle, self.nodeID, buf.pOutputs, buf.pErrorCode): # Get digital output word
                 raise Exception("An Error has occurred, exiting...")
+            self._shadow["outputs"] = buf.outputs.value
+        except:
+            self._error(buf.errorCode)
+        return (buf.outputs.value & 0x1000) == 0x1000
+    
+    # Switching of the 2-way valve connected to digital outputs C and D (bit 13 and 12, see Cetoni documentation)
+    def _switch_valve(self, confirm = False):
+        return self._set_valve(None, confirm)
+
+    # Open (True), close (False) or switch (None) the valve. The output word comes from the shadow and nothing is written
+    # when the valve is commanded there already. The power output stays on valve_pulse s: set it to the actuation time
+    # of the valve plus some margin. confirm reads the output word back from the drive, -1 if it differs.
+    def _set_valve(self, open_valve = None, confirm = False):
+        pErrorCode, newstate = self._valve_power(open_valve)
+        if newstate is None:
+            return pErrorCode
+        time.sleep(self.valve_pulse)
+        pErrorCode, newstate = self._valve_release()
+        time.sleep(self.valve_settle)
+        if confirm and pErrorCode == 0:
+            pErrorCode = self._valve_confirm(newstate)
+        self._valve_report(newstate)
+        return pErrorCode
+
+    # Command the valve position with the power output on, returns error code and new output word, None if nothing was written
+    @_locked
+    def _valve_power(self, open_valve = None):
+        pErrorCode = c_uint()
+        try:
+            current_state = self._outputs(pErrorCode) # Get digital output word, from the shadow if known
+        except:
+            self._error(pErrorCode)
+            return pErrorCode.value, None
+        if open_valve is None:
+            open_valve = not current_state & 0x1000
+        elif bool(current_state & 0x1000) == open_valve and not current_state & 0x2000:
+            return pErrorCode.value, None
+        newstate = (current_state & ~0x1000) | (0x1000 if open_valve else 0) | 0x2000 # bit 12 position, bit 13 power
+        self._snapshot = None
+        try:
+            self._write_outputs(newstate, pErrorCode) # Send new digital output word
         except:
             self._error(pErrorCode)
-        geardenom = c_uint32()
+        return pErrorCode.value, newstate
+
+    # Power output off, returns error code and new output word
+    @_locked
+    def _valve_release(self):
+        pErrorCode = c_uint()
+        self._snapshot = None
+        newstate = 0
         try:
-            if not epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x200C, 4, byref(geardenom), 4, byref(pNbOfBytesRead), byref(pErrorCode)): #read gear factor denominator
+            newstate = self._outputs(pErrorCode) & ~0x2000
+            self._write_outputs(newstate, pErrorCode)
+            self._remember(valve = (newstate & 0x1000) == 0x1000)
+        except:
+            self._error(pErrorCode)
+        return pErrorCode.value, newstate
+
+    # Read the output word back from the drive
+    @_locked
+    def _valve_confirm(self, outputs):
+        pErrorCode = c_uint()
+        self._shadow.pop("outputs", None)
+        try:
+            readback = self._outputs(pErrorCode)
+        except:
+            self._error(pErrorCode)
+            return pErrorCode.value
+        if readback != outputs:
+            print("\nPump ID: %1d Valve outputs read back 0x%04x instead of 0x%04x!" % (self.nodeID, readback, outputs))
+            return -1
+        return pErrorCode.value
+
+    def _valve_report(self, outputs):
+        if (outputs & 0x1000) == 0x1000:
+            print("\nPump ID: %1d Valve has been opened!" %self.nodeID)
+        else:
+            print("\nPump ID: %1d Valve has been closed!" %self.nodeID)
+    
+    # Get internal data for conversions
+    @_locked
+    def _get_conversion_data(self):
+        pErrorCode = c_uint()
+        pNbOfBytesRead = c_uint()
+        self.vel_notation = 1 # rpm per velocity unit
+        serial = c_uint32()
+        identity = None
+        try:
+            if not self.epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x1018, 4, byref(serial), 4, byref(pNbOfBytesRead), byref(pErrorCode)): #read serial number, identity of the cached objects
                 raise Exception("An Error has occurred, exiting...")
+            identity = serial.value
         except:
             self._error(pErrorCode)
+        self._serial = identity
+        entry = self._conversions.get(self._key) if identity is not None else None
+        if entry is not None and entry.get("serial") == identity:
+            velexp, encres, gearnum, geardenom = entry["objects"]
+        else:
+            failed = identity is None
+            velexp = c_int8()
+            try:
+                if not self.epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x608B, 0, byref(velexp), 1, byref(pNbOfBytesRead), byref(pErrorCode)): #read velocity notation exponent
+                    raise Exception("An Error has occurred, exiting...")
+            except:
+                self._error(pErrorCode)
+                failed = True
+            encres = c_uint32()
+            try:
+                if not self.epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x2210, 1, byref(encres), 4, byref(pNbOfBytesRead), byref(pErrorCode)): #read encoder resolution
+                    raise Exception("An Error has occurred, exiting...")
+            except:
+                self._error(pErrorCode)
+                failed = True
+            gearnum = c_uint32()
+            try:
+                if not self.epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x200C, 1, byref(gearnum), 4, byref(pNbOfBytesRead), byref(pErrorCode)): #read gear factor numerator
+                    raise Exception("An Error has occurred, exiting...")
+            except:
+                self._error(pErrorCode)
+                failed = True
+            geardenom = c_uint32()
+            try:
+                if not self.epos.VCS_GetObject(self.keyHandle, self.nodeID, 0x200C, 4, byref(geardenom), 4, byref(pNbOfBytesRead), byref(pErrorCode)): #read gear factor denominator
+                    raise Exception("An Error has occurred, exiting...")
+            except:
+                self._error(pErrorCode)
+                failed = True
+            velexp, encres, gearnum, geardenom = velexp.value, encres.value, gearnum.value, geardenom.value
+            if not failed:
+                self._conversions.put(self._key, {"serial": identity, "objects": [velexp, encres, gearnum, geardenom]})
+        self.vel_notation = 10**velexp
         try:
-            qc_to_mm = int((4*encres.value) * (gearnum.value/geardenom.value))
-            qc_to_ul = int(qc_to_mm / ((3.14 * (self.syr_diam**2))/4))
-            rpm_to_mms = int((self.syr_str * (gearnum.value/geardenom.value)) / (10**velexp.value))
-            rpm_to_uls = int(rpm_to_mms / ((3.14 * (self.syr_diam**2))/4))
+            area = math.pi * self.syr_diam**2 / 4 # mm2
+            qc_to_mm = 4*encres * (gearnum/geardenom)
+            qc_to_ul = qc_to_mm / area
+            rpm_to_mms = (self.syr_str * (gearnum/geardenom)) / (10**velexp)
+            rpm_to_uls = rpm_to_mms / area
         except:
             self._error(pErrorCode)
             qc_to_ul = 1
             rpm_to_uls = 1
         return qc_to_ul, rpm_to_uls
 
+    # Have the status of this pump read by the background poller of its bus, rate in snapshots/s for the whole bus
+    def _poll(self, rate = None):
+        with _buses_lock:
+            if self.bus.poller is None:
+                self.bus.poller = BusPoller(self.port)
+            poller = self.bus.poller
+        if rate is not None:
+            poller.rate = rate
+        poller.register(self)
+        poller.start()
+        return poller
+
+    # Queue wait statistics of the bus handle shared with the other pumps of the port
+    def _bus_stats(self, reset = False):
+        return self.bus.lock.stats(reset)
+
     def _print_info(self):
-        print('\nPumpID: %1d Motor position: %5d ul Velocity: %3.2f ul/s Moving: %5s  Target Reached: %5s  Valve open: %5s\n' % (self.nodeID, self._get_position()/self.ul, self._get_velocity()/self.uls, self._is_moving(), self._is_target_reached(), self._is_valve_open()), end='', flush = True)
+        snap = self.snapshot()
+        print('\nPumpID: %1d Motor position: %5d ul Velocity: %3.2f ul/s Moving: %5s  Target Reached: %5s  Valve open: %5s\n' % (self.nodeID, snap.position/self.ul, snap.velocity/self.uls, snap.moving, snap.target_reached, snap.valve_open), end='', flush = True)
         return 0
     
+    @_locked
     def _pump_state(self):
         pErrorCode = c_uint()
         pMode = c_int8()
         try:
-            if not epos.VCS_GetOperationMode(self.keyHandle, self.nodeID, byref(pMode), byref(pErrorCode)): # Check if device is in profile position mode
-                raise Exception("An Error has occurred, exiting...")
+            pMode.value = self._operation_mode(pErrorCode, fresh = True) # Check if device is in profile position mode
         except:
             self._error(pErrorCode)
         if pMode.value == 1:
@@ -450,27 +1723,268 @@ class Nemesys:
         self._print_info()
         return pErrorCode.value
 
-    def _get_state(self):
-        pErrorCode = c_uint()
-        pState = c_uint16()
+    @_locked
+    def _get_state(self, cached = False):
+        state = self.snapshot().state if cached else self._read_state()
+        if state == "FAULT":
+            self._invalidate_shadow()
+
+        if state is not None:
+            print("Pump %1d state: %s" % (self.nodeID, state))
+        return state
+
+    # Device state name, without printing it
+    @_locked
+    def _read_state(self):
+        buf = self._buf
         try:
-            if not epos.VCS_GetState(self.keyHandle, self.nodeID, byref(pState), byref (pErrorCode)):
+            if not self.epos.VCS_GetState(self.keyHandle, self.nodeID, buf.pState, buf.pErrorCode):
                 raise Exception("An Error has occurred, exiting...")
         except:
-            self._error(pErrorCode)
+            self._error(buf.errorCode)
+        return _STATES[buf.state.value] if buf.state.value < len(_STATES) else None
+
+    # Read position, averaged velocity, movement state, digital outputs and device state in one pass,
+    # a snapshot younger than snapshot_ttl is served from cache
+    @_locked
+    def snapshot(self, max_age = None):
+        if max_age is None:
+            max_age = self.snapshot_ttl
+            if self.poller is not None:
+                max_age = max(max_age, 2*self.poller.cycle()) # the background poller keeps the cache fresh
+        if self._snapshot is not None and time.monotonic() - self._snapshot.timestamp <= max_age:
+            return self._snapshot
+        buf = self._buf
+        failed = False
+        try:
+            if not self.epos.VCS_GetPositionIs(self.keyHandle, self.nodeID, buf.pPosition, buf.pErrorCode):
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_GetVelocityIsAveraged(self.keyHandle, self.nodeID, buf.pVelocity, buf.pErrorCode):
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_GetMovementState(self.keyHandle, self.nodeID, buf.pTargetReached, buf.pErrorCode):
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_GetAllDigitalOutputs(self.keyHandle, self.nodeID, buf.pOutputs, buf.pErrorCode):
+                raise Exception("An Error has occurred, exiting...")
+            if not self.epos.VCS_GetState(self.keyHandle, self.nodeID, buf.pState, buf.pErrorCode):
+                raise Exception("An Error has occurred, exiting...")
+        except:
+            self._error(buf.errorCode)
+            failed = True
+        velocity = buf.velocity.value
+        outputs = buf.outputs.value
+        state = buf.state.value
+        snap = Snapshot(self.nodeID, time.monotonic(), buf.position.value, velocity, velocity != 0, bool(buf.targetReached.value),
+                        outputs, (outputs & 0x1000) == 0x1000, _STATES[state] if state < len(_STATES) else None)
+        self._snapshot = None if failed else snap # errors are never cached
+        if not failed:
+            self._shadow["outputs"] = outputs
+            if snap.state == "FAULT":
+                self._invalidate_shadow()
+        return snap
+
+# Background thread reading round robin the status of the pumps registered on one bus,
+# every snapshot is published to the subscribers (callables or queues)
+class BusPoller:
+
+    def __init__(self, port, rate = 10.0):
+        self.port = port
+        self.rate = rate # snapshots/s for the whole bus, whatever the number of pumps
+        self.latest = {} # nodeID -> last published Snapshot
+        self._pumps = []
+        self._subscribers = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # Time in s between two snapshots of the same pump
+    def cycle(self):
+        with self._lock:
+            return max(1, len(self._pumps))/self.rate
+
+    def register(self, pump):
+        with self._lock:
+            if pump not in self._pumps:
+                self._pumps.append(pump)
+            pump.poller = self
+
+    def unregister(self, pump):
+        with self._lock:
+            if pump in self._pumps:
+                self._pumps.remove(pump)
+            self.latest.pop(pump.nodeID, None)
+            pump.poller = None
+
+    # Subscribe to the snapshots of one node, or of every node when nodeID is None; returns the token for unsubscribe
+    def subscribe(self, subscriber, nodeID = None):
+        with self._lock:
+            token = self._next_token
+            self._next_token += 1
+            self._subscribers[token] = (subscriber, nodeID)
+        return token
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._run, name = "BusPoller %s" % self.port, daemon = True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        index = 0
+        next_time = time.monotonic()
+        while not self._stop.is_set():
+            with self._lock:
+                pump = self._pumps[index % len(self._pumps)] if self._pumps else None
+                index += 1
+            if pump is not None and pump.bus is not None: # closed meanwhile, unregistered by _bus_close
+                try:
+                    snap = pump.snapshot(max_age = 0)
+                except Exception as e:
+                    print("\nBusPoller %s: snapshot error on pump %d: %s" % (self.port, pump.nodeID, e))
+                else:
+                    self._publish(snap)
+            next_time = max(next_time + 1/self.rate, time.monotonic())
+            self._stop.wait(next_time - time.monotonic())
+
+    def _publish(self, snap):
+        with self._lock:
+            self.latest[snap.nodeID] = snap
+            subscribers = [subscriber for subscriber, nodeID in self._subscribers.values() if nodeID is None or nodeID == snap.nodeID]
+        for subscriber in subscribers:
+            try:
+                if hasattr(subscriber, "put_nowait"):
+                    subscriber.put_nowait(snap)
+                else:
+                    subscriber(snap)
+            except Exception as e:
+                print("\nBusPoller %s: subscriber error on pump %d: %s" % (self.port, snap.nodeID, e))
+
+# Pumps moved together, possibly on different ports: profiles and targets are preloaded on every pump,
+# then the moves are triggered back to back (one thread per bus) and completion is awaited in one loop
+class NemesysGroup:
+
+    def __init__(self, pumps, deferred = False, poll_period = 0.05):
+        self.pumps = list(pumps)
+        self.deferred = deferred # trigger with one controlword write per pump instead of VCS_MoveToPosition
+        self.poll_period = poll_period # s between completion polls once the moves are expected to end
+        self.last_result = None
+        self._started = None
+
+    # targets: (position ul, speed ul/s) per pump in group order, or a dict pump -> (position, speed)
+    def move(self, targets, wait = True, timeout = None):
+        if isinstance(targets, dict):
+            targets = [targets[pump] for pump in self.pumps]
+        if len(targets) != len(self.pumps):
+            print("\n!! One target per pump is needed !!\n")
+            return None
+        for pump, (targetPosition, targetSpeed) in zip(self.pumps, targets):
+            if targetSpeed == 0 or pump._prepare_move(targetPosition, targetSpeed, self.deferred) != 0:
+                print("\n!! Pump ID: %1d could not be prepared, group move aborted !!\n" % pump.nodeID)
+                return None
+        skew = self._trigger()
+        self.last_result = GroupResult(False, [], skew, 0.0)
+        if wait == True:
+            return self.wait(timeout)
+        return self.last_result
+
+    # Trigger every prepared pump, returns the time spread in s between the first and the last trigger
+    def _trigger(self):
+        buses = {}
+        for pump in self.pumps:
+            buses.setdefault(pump.bus, []).append(pump)
+        times = []
+        times_lock = threading.Lock()
+        barrier = threading.Barrier(len(buses))
+        def trigger(bus, pumps):
+            with bus.lock:
+                barrier.wait()
+                stamps = []
+                for pump in pumps:
+                    pump._start_move(self.deferred)
+                    stamps.append(time.perf_counter())
+            with times_lock:
+                times.extend(stamps)
+        self._started = time.monotonic()
+        if len(buses) == 1:
+            trigger(*buses.popitem())
+        else:
+            threads = [threading.Thread(target = trigger, args = item) for item in buses.items()]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return max(times) - min(times)
+
+    # Home the pumps of the group together, see home_pumps
+    def home(self, negative = False, skip_referenced = True, timeout = None):
+        return home_pumps(self.pumps, negative, skip_referenced, timeout, max(self.poll_period, 0.1))
+
+    # Open, close or switch the valves of the group together, see set_valves
+    def set_valves(self, states = None, confirm = False):
+        return set_valves(self.pumps, states, confirm)
+
+    # Wait for every pump of the last move, one completion loop for the whole group.
+    # A pump halted or in fault is polled at once, the wait ends when no pump is still moving.
+    def wait(self, timeout = None):
+        if self._started is None or self.last_result is None:
+            return self.last_result
+        estimates = [pump._pending[1] if pump._pending is not None else 0.0 for pump in self.pumps]
+        if timeout is None:
+            timeout = max(2*max(estimates), max(estimates) + 10)
+        deadline = self._started + timeout
+        motions = [None]*len(self.pumps)
+        polls = [0]*len(self.pumps)
+        wake = self._started + min(estimates) - self.poll_period
+        while not any(pump._stopped.is_set() for pump in self.pumps): # through the shortest expected duration
+            remaining = wake - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, self.poll_period))
+        while True:
+            now = time.monotonic()
+            for i, pump in enumerate(self.pumps):
+                if motions[i] is not None or (now < self._started + estimates[i] - self.poll_period and not pump._stopped.is_set()):
+                    continue
+                polls[i] += 1
+                if pump._is_target_reached(): # also set by a halt, the final position tells
+                    motions[i] = self._motion(pump, polls[i])
+                elif pump._read_state() == "FAULT":
+                    motions[i] = MotionResult(pump.nodeID, False, pump._get_position(), time.monotonic() - self._started, polls[i], False)
+                    pump.last_motion = motions[i]
+            if all(motions) or time.monotonic() >= deadline:
+                break
+            time.sleep(self.poll_period)
+        for i, pump in enumerate(self.pumps):
+            if motions[i] is None:
+                motions[i] = MotionResult(pump.nodeID, False, pump._get_position(), time.monotonic() - self._started, polls[i], True)
+                pump.last_motion = motions[i]
+        reached = all(motion.reached for motion in motions)
+        self.last_result = GroupResult(reached, motions, self.last_result.skew, time.monotonic() - self._started)
+        self._started = None
+        return self.last_result
 
-        if pState.value == 0:
-            print("Pump %1d state: DISABLED" %self.nodeID)
-            return "DISABLED"
-        if pState.value == 1:
-            print("Pump %1d state: ENABLED" %self.nodeID)
-            return "ENABLED"
-        if pState.value == 2:
-            print("Pump %1d state: QUICKSTOP" %self.nodeID)
-            return "QUICKSTOP"
-        if pState.value == 3:
-            print("Pump %1d state: FAULT" %self.nodeID)
-            return "FAULT"
+    # Result of a pump whose target-reached flag is set: reached only at the commanded target and out of fault
+    def _motion(self, pump, polls):
+        position = pump._get_position()
+        reached = pump._pending is None or abs(position - pump._pending[0]) <= pump.target_tolerance*pump.ul
+        if reached:
+            reached = pump._read_state() != "FAULT"
+        motion = MotionResult(pump.nodeID, reached, position, time.monotonic() - self._started, polls, False)
+        pump.last_motion = motion
+        pump._remember_position(position)
+        return motion
         
 """
 Test code
@@ -484,8 +1998,8 @@ pumpB._reference_pos_lim()
 pumpA._switch_valve()
 pumpB._switch_valve()
 
-pumpA._move_to_position_speed(-50, 50, wait = False)
-pumpB._move_to_position_speed(-50, 50)
+pumps = NemesysGroup([pumpA, pumpB])
+print(pumps.move([(-50, 50), (-50, 50)]))
 
 pumpA._switch_valve()
 pumpB._switch_valve()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the bliss project
+#
+# Copyright (c) 2015-2023 Beamline Control Unit, ESRF
+# Distributed under the GNU LGPLv3. See LICENSE for more info.
+# Author: Antonino Calio'
+#
+# Progress reporting of the Nemesys completion loops. A reporter renders from what the loop holds already
+# (elapsed and expected time, target reached flag, final position), it never talks to the bus, and is rate limited
+# per pump except for the final report:
+#
+#   pump = Nemesys(2, progress = LoggerProgress(max_rate = 2))
+#   pump.progress = make_progress("none")
+
+import sys
+import time
+import logging
+import threading
+from collections import namedtuple
+
+# One report of a completion loop: times in s, position in ul, None until the loop has read it at the end
+Progress = namedtuple("Progress", ["nodeID", "elapsed", "estimate", "reached", "position", "polls", "done"])
+
+
+# Base reporter, renders nothing
+class NullProgress:
+
+    def __init__(self, max_rate = 0.0):
+        self.max_rate = max_rate # reports/s per pump while moving, 0 for the final report only
+        self._last = {}
+        self._lock = threading.Lock()
+
+    # s between intermediate reports, None if there are none
+    @property
+    def interval(self):
+        return 1.0/self.max_rate if self.max_rate > 0 else None
+
+    def __call__(self, progress):
+        if not progress.done:
+            if self.interval is None:
+                return
+            now = time.monotonic()
+            with self._lock:
+                if now - self._last.get(progress.nodeID, float("-inf")) < self.interval:
+                    return
+                self._last[progress.nodeID] = now
+        else:
+            with self._lock:
+                self._last.pop(progress.nodeID, None)
+        self.render(progress)
+
+    def render(self, progress):
+        pass
+
+
+# One status line per pump on the terminal, rewritten in place
+class ConsoleProgress(NullProgress):
+
+    def __init__(self, max_rate = 4.0, stream = None):
+        super().__init__(max_rate)
+        self.stream = stream
+
+    def render(self, progress):
+        stream = self.stream or sys.stdout
+        if progress.done:
+            stream.write('\rPump ID: %1d Motor position: %5d ul Target Reached: %5s Elapsed: %3.2f s' % (progress.nodeID, progress.position, progress.reached, progress.elapsed))
+        elif progress.estimate:
+            stream.write('\rPump ID: %1d Moving %3d %% Elapsed: %3.2f s of %3.2f s' % (progress.nodeID, min(100, 100*progress.elapsed/progress.estimate), progress.elapsed, progress.estimate))
+        else:
+            stream.write('\rPump ID: %1d Moving Elapsed: %3.2f s' % (progress.nodeID, progress.elapsed))
+        stream.flush()
+
+
+# Python logging, the final report at INFO and the intermediate ones at DEBUG
+class LoggerProgress(NullProgress):
+
+    def __init__(self, max_rate = 1.0, logger = None):
+        super().__init__(max_rate)
+        self.logger = logger or logging.getLogger("pyNemesys")
+
+    def render(self, progress):
+        if progress.done:
+            self.logger.info("Pump ID: %d Motor position: %d ul Target Reached: %s Elapsed: %.2f s", progress.nodeID, progress.position, progress.reached, progress.elapsed)
+        else:
+            self.logger.debug("Pump ID: %d Moving Elapsed: %.2f s of %.2f s", progress.nodeID, progress.elapsed, progress.estimate)
+
+
+# BLISS event "progress" sent by sender (the controller) with the Progress as value
+class BlissProgress(NullProgress):
+
+    def __init__(self, sender, max_rate = 4.0):
+        super().__init__(max_rate)
+        from bliss.common import event
+        self._send = event.send
+        self.sender = sender
+
+    def render(self, progress):
+        self._send(self.sender, "progress", progress)
+
+
+# Reporter by name: "console", "logger", "bliss" (needs sender) or "none"
+def make_progress(name = "console", max_rate = None, sender = None):
+    kwargs = {} if max_rate is None else {"max_rate": max_rate}
+    if name == "console":
+        return ConsoleProgress(**kwargs)
+    if name == "logger":
+        return LoggerProgress(**kwargs)
+    if name == "bliss":
+        return BlissProgress(sender, **kwargs)
+    if name in ("none", None):
+        return NullProgress()
+    raise ValueError("Unknown progress reporter %r" % name)
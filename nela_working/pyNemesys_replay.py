@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the bliss project
+#
+# Copyright (c) 2015-2023 Beamline Control Unit, ESRF
+# Distributed under the GNU LGPLv3. See LICENSE for more info.
+# Author: Antonino Calio'
+#
+# Record a bus session (every library call with its arguments, outputs, result and timing) to a compact binary file,
+# then replay it against the simulated EPOS2 backend, in real time, accelerated or as fast as possible:
+#
+#   NEMESYS_RECORD=run.nses python protocol.py                  # or SessionRecorder(tracer, "run.nses").start()
+#   python pyNemesys_replay.py run.nses --speed 10
+#   python pyNemesys_replay.py run.nses --compare before.nses     # same protocol, two driver versions
+#
+# File: gzip stream of records after the magic line. "F" defines a function id, "C" is one call:
+# function id, start offset s, duration s, argument count, tagged values (arguments, result, error code).
+
+import sys
+import time
+import gzip
+import atexit
+import struct
+import ctypes
+import argparse
+import threading
+from collections import namedtuple
+
+MAGIC = b"NEMSES1\n"
+
+# One recorded call: t is the start in s from the first call of the session
+SessionCall = namedtuple("SessionCall", ["t", "function", "args", "result", "error", "duration"])
+
+# Outcome of a replay: divergences are calls whose result or outputs differ from the recording, the first ones are kept
+ReplayResult = namedtuple("ReplayResult", ["calls", "errors", "divergences", "elapsed", "recorded", "first_divergences"])
+
+
+def _write_value(f, value):
+    if value is None:
+        f.write(b"n")
+    elif isinstance(value, bool) or isinstance(value, int):
+        f.write(b"i" + struct.pack("<q", int(value)))
+    elif isinstance(value, float):
+        f.write(b"f" + struct.pack("<d", value))
+    elif isinstance(value, bytes):
+        f.write(b"b" + struct.pack("<I", len(value)) + value)
+    else:
+        data = str(value).encode()
+        f.write(b"s" + struct.pack("<I", len(data)) + data)
+
+def _read_exact(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise EOFError
+    return data
+
+def _read_value(f):
+    tag = _read_exact(f, 1)
+    if tag == b"n":
+        return None
+    if tag == b"i":
+        return struct.unpack("<q", _read_exact(f, 8))[0]
+    if tag == b"f":
+        return struct.unpack("<d", _read_exact(f, 8))[0]
+    size = struct.unpack("<I", _read_exact(f, 4))[0]
+    data = _read_exact(f, size)
+    return data if tag == b"b" else data.decode()
+
+
+# Tracer hook writing every call of the session, from any thread
+class SessionRecorder:
+
+    def __init__(self, tracer, path):
+        self.tracer = tracer
+        self.path = path
+        self.calls = 0
+        self._file = None
+        self._functions = {}
+        self._start = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, "wb")
+                self._file.write(MAGIC)
+                self.tracer.add_hook(self)
+                atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        self.tracer.remove_hook(self)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def __call__(self, record):
+        with self._lock:
+            f = self._file
+            if f is None:
+                return
+            if self._start is None:
+                self._start = record.timestamp
+            function = self._functions.get(record.function)
+            if function is None:
+                function = self._functions[record.function] = len(self._functions)
+                name = record.function.encode()
+                f.write(b"F" + struct.pack("<HB", function, len(name)) + name)
+            f.write(b"C" + struct.pack("<HddB", function, record.timestamp - self._start, record.duration, len(record.args)))
+            for value in record.args:
+                _write_value(f, value)
+            _write_value(f, record.result)
+            _write_value(f, record.error)
+            self.calls += 1
+
+
+# Calls of a recorded session, in recording order
+def load(path):
+    functions = {}
+    with gzip.open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a recorded Nemesys session" % path)
+        while True:
+            kind = f.read(1)
+            if not kind:
+                return
+            try:
+                if kind == b"F":
+                    function, size = struct.unpack("<HB", _read_exact(f, 3))
+                    functions[function] = _read_exact(f, size).decode()
+                    continue
+                function, t, duration, count = struct.unpack("<HddB", _read_exact(f, 19))
+                args = tuple(_read_value(f) for _ in range(count))
+                result = _read_value(f)
+                error = _read_value(f)
+            except EOFError:
+                return # session cut short, keep what was written
+            yield SessionCall(t, functions[function], args, result, error, duration)
+
+
+# Calls, errors and time in the library per function
+def summarize(path):
+    summary = {}
+    for call in load(path):
+        entry = summary.setdefault(call.function, {"count": 0, "errors": 0, "total": 0.0})
+        entry["count"] += 1
+        entry["errors"] += call.error is not None
+        entry["total"] += call.duration
+    return summary
+
+# Per function differences of two sessions, b - a
+def compare(path_a, path_b):
+    a = summarize(path_a)
+    b = summarize(path_b)
+    empty = {"count": 0, "errors": 0, "total": 0.0}
+    return {name: {key: b.get(name, empty)[key] - a.get(name, empty)[key] for key in empty} for name in sorted(set(a) | set(b))}
+
+
+_SIZED = {1: ctypes.c_int8, 2: ctypes.c_int16, 4: ctypes.c_int32, 8: ctypes.c_int64}
+
+# ctypes arguments of a recorded call: by-value arguments as recorded, pointers to fresh objects, key handles mapped
+def _arguments(name, values, argtypes, handles):
+    args = []
+    outputs = []
+    for i, (argtype, value) in enumerate(zip(argtypes, values)):
+        if i == 0 and name != "VCS_GetErrorInfo":
+            args.append(handles.get(value, value))
+        elif argtype is ctypes.c_void_p and name in ("VCS_GetObject", "VCS_SetObject"): # object data, as wide as the byte count
+            obj = _SIZED.get(values[i + 1], ctypes.c_int64)(value if name == "VCS_SetObject" else 0)
+            args.append(ctypes.byref(obj))
+            if name == "VCS_GetObject":
+                outputs.append((i, obj, 8*ctypes.sizeof(obj))) # the signedness of the object is not known here
+        elif argtype is ctypes.c_char_p and name == "VCS_GetErrorInfo":
+            args.append(ctypes.create_string_buffer(max(1, values[i + 1])))
+        elif isinstance(argtype, type) and issubclass(argtype, ctypes._Pointer):
+            if isinstance(value, bytes):
+                obj = (argtype._type_*len(value))()
+                args.append(obj)
+            else:
+                obj = argtype._type_()
+                args.append(ctypes.byref(obj))
+            if i != len(argtypes) - 1: # the error code is compared through the result
+                outputs.append((i, obj, None))
+        else:
+            args.append(value)
+    return args, outputs
+
+
+def _same(replayed, recorded, bits = None):
+    if bits is not None and isinstance(replayed, int) and isinstance(recorded, int):
+        return (replayed - recorded) % (1 << bits) == 0
+    return replayed == recorded
+
+# Arguments for printing, long buffers shortened
+def _short(values):
+    return tuple("<%d bytes>" % len(value) if isinstance(value, bytes) and len(value) > 16 else value for value in values)
+
+# Replay a recorded session against backend, a fresh simulator by default. A simulator clock follows the recording.
+# speed 1 is real time, 10 ten times faster, None as fast as possible.
+def replay(path, backend = None, speed = 1.0, max_divergences = 20):
+    try:
+        from .pyNemesys_linux import _PROTOTYPES
+        from . import pyNemesys_sim
+        from .pyNemesys_trace import plain
+    except ImportError:
+        from pyNemesys_linux import _PROTOTYPES
+        import pyNemesys_sim
+        from pyNemesys_trace import plain
+    clock = [0.0, time.monotonic()] # recorded time of the current call, wall time it was issued
+    if backend is None:
+        backend = pyNemesys_sim.EposSim()
+    sim = getattr(backend, "_backend", backend) # behind a tracer
+    if isinstance(sim, pyNemesys_sim.EposSim):
+        sim.clock = lambda: clock[0] + (time.monotonic() - clock[1]) # recorded time, running at real speed inside a call
+    handles = {}
+    calls = errors = divergences = 0
+    first = []
+    recorded = 0.0
+    start = time.monotonic()
+    for call in load(path):
+        if speed:
+            delay = start + call.t/speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        clock[0] = call.t
+        clock[1] = time.monotonic()
+        recorded = call.t + call.duration
+        args, outputs = _arguments(call.function, call.args, _PROTOTYPES[call.function][1], handles)
+        result = getattr(backend, call.function)(*args)
+        calls += 1
+        if call.function == "VCS_OpenDevice" and result:
+            handles[call.result] = result
+        if not result and call.function != "VCS_GetErrorInfo":
+            errors += 1
+        differs = bool(result) != bool(call.result) or any(not _same(plain(obj), call.args[i], bits) for i, obj, bits in outputs)
+        if differs:
+            divergences += 1
+            if len(first) < max_divergences:
+                first.append((calls, call.function, call.args, call.result, tuple(plain(arg) for arg in args), result))
+    return ReplayResult(calls, errors, divergences, time.monotonic() - start, recorded, first)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Replay a recorded Nemesys bus session on the simulator")
+    parser.add_argument("session")
+    parser.add_argument("--speed", type = float, default = 1.0, help = "replay speed factor, 0 for as fast as possible")
+    parser.add_argument("--compare", help = "other session of the same protocol, per function differences")
+    parser.add_argument("--trace", action = "store_true", help = "print the latency statistics of the replay")
+    args = parser.parse_args(argv)
+
+    for name, entry in summarize(args.session).items():
+        print("%-36s %8d calls %6d errors %10.3f ms" % (name, entry["count"], entry["errors"], entry["total"]*1000))
+    if args.compare:
+        print("\n%s - %s" % (args.compare, args.session))
+        for name, delta in compare(args.session, args.compare).items():
+            if delta["count"] or delta["errors"]:
+                print("%-36s %+8d calls %+6d errors %+10.3f ms" % (name, delta["count"], delta["errors"], delta["total"]*1000))
+        return 0
+    backend = None
+    tracer = None
+    if args.trace:
+        try:
+            from .pyNemesys_trace import Tracer
+            from . import pyNemesys_sim
+        except ImportError:
+            from pyNemesys_trace import Tracer
+            import pyNemesys_sim
+        tracer = Tracer()
+        backend = tracer.wrap(pyNemesys_sim.EposSim())
+    result = replay(args.session, backend, args.speed or None)
+    print("\nreplayed %d calls in %.3f s (recorded %.3f s), %d errors, %d divergences" % (result.calls, result.elapsed, result.recorded, result.errors, result.divergences))
+    for index, function, recorded_args, recorded_result, replayed_args, replayed_result in result.first_divergences:
+        print("  #%d %s recorded %r -> %r replayed %r -> %r" % (index, function, _short(recorded_args), recorded_result, _short(replayed_args), replayed_result))
+    if tracer is not None:
+        print(tracer.dump())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
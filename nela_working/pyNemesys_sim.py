@@ -0,0 +1,951 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the bliss project
+#
+# Copyright (c) 2015-2023 Beamline Control Unit, ESRF
+# Distributed under the GNU LGPLv3. See LICENSE for more info.
+# Author: Antonino Calio'
+#
+# Simulated Maxon EPOS2 command library, drop-in replacement of the libEposCmd functions used by pyNemesys_linux.
+# Select it with NEMESYS_BACKEND=sim or Nemesys(..., backend = "sim").
+
+import os
+import time
+import random
+import threading
+from collections import deque
+
+# Error codes returned by the simulator (values of the EPOS command library where one exists)
+ERROR_NO_ERROR = 0x00000000
+ERROR_HANDLE = 0x10000003 # handle not valid
+ERROR_BAD_PARAMETER = 0x10000008
+ERROR_TIMEOUT = 0x1000000B
+ERROR_NODE = 0x06020000 # object or node does not exist
+ERROR_STATE = 0x08000022 # not possible in the present device state
+ERROR_MODE = 0x0F00FFC0 # wrong operation mode
+ERROR_LIMIT_SWITCH = 0x34100000 # limit switch reached, drive in fault
+ERROR_INJECTED = 0x34000000
+ERROR_IPM_OVERFLOW = 0x08A70000 # interpolated position mode buffer full
+ERROR_RECORDER = 0x08090030 # data recorder channel or parameter not valid
+
+_ERROR_INFO = {
+    ERROR_NO_ERROR: "No error",
+    ERROR_HANDLE: "Handle not valid",
+    ERROR_BAD_PARAMETER: "Bad parameter",
+    ERROR_TIMEOUT: "Timeout",
+    ERROR_NODE: "Object or node does not exist",
+    ERROR_STATE: "Command not possible in present device state",
+    ERROR_MODE: "Wrong operation mode",
+    ERROR_LIMIT_SWITCH: "Limit switch reached",
+    ERROR_INJECTED: "Simulated communication error",
+    ERROR_IPM_OVERFLOW: "IPM buffer overflow",
+    ERROR_RECORDER: "Data recorder parameter not valid",
+}
+
+# Operation modes
+MODE_PROFILE_POSITION = 1
+MODE_PROFILE_VELOCITY = 3
+MODE_HOMING = 6
+MODE_INTERPOLATED_POSITION = 7
+
+# Device states
+STATE_DISABLED = 0
+STATE_ENABLED = 1
+STATE_QUICKSTOP = 2
+STATE_FAULT = 3
+
+# Data recorder triggers, bit mask
+TRIGGER_MOVEMENT_START = 1
+TRIGGER_ERROR = 2
+TRIGGER_DIGITAL_INPUT = 4
+TRIGGER_MOVEMENT_END = 8
+
+# Valve outputs on the digital output word, see Cetoni documentation
+VALVE_POSITION_BIT = 0x1000
+VALVE_POWER_BIT = 0x2000
+
+
+# Value of a ctypes argument passed by value
+def _value(arg):
+    return getattr(arg, "value", arg)
+
+# ctypes object behind a byref() or pointer() argument
+def _target(arg):
+    if hasattr(arg, "_obj"):
+        return arg._obj
+    if hasattr(arg, "contents"):
+        return arg.contents
+    return arg
+
+def _set(arg, value):
+    _target(arg).value = value
+
+
+# One simulated drive with its syringe: position in qc, velocity in drive units (rpm scaled by the notation index)
+class SimNode:
+
+    def __init__(self, nodeID, encoder_resolution = 512, gear_numerator = 1, gear_denominator = 1, velocity_exponent = -3,
+                 syringe_stroke_mm = 60, syringe_diameter_mm = 3.2574, valve_actuation = 0.15, dt = 0.001, recorder_memory = 4096):
+        self.nodeID = nodeID
+        self.objects = {
+            (0x608B, 0): velocity_exponent,
+            (0x2210, 1): encoder_resolution,
+            (0x200C, 1): gear_numerator,
+            (0x200C, 4): gear_denominator,
+            (0x1018, 4): 0x0A000000 + nodeID, # identity object, serial number
+        }
+        qc_per_mm = 4*encoder_resolution*gear_numerator/gear_denominator
+        self.qc_per_unit = qc_per_mm*(10**velocity_exponent)/syringe_stroke_mm # qc/s for one velocity unit, consistent with Nemesys conversions
+        self.qc_per_rpm = self.qc_per_unit/(10**velocity_exponent) # accelerations are in rpm/s, not scaled by the velocity notation
+        self.qc_per_ul = qc_per_mm/(3.14159265*syringe_diameter_mm**2/4)
+        self.stroke_qc = syringe_stroke_mm*qc_per_mm
+        self.dt = dt # s integration step of the motion model
+        self.state = STATE_DISABLED
+        self.mode = 0
+        self.x = -self.stroke_qc/2 # physical plunger coordinate in qc, positive limit switch at 0
+        self.v = 0.0 # qc/s
+        self.origin = 0.0 # physical coordinate of position 0
+        self.neg_switch = -self.stroke_qc - 40000
+        self.pos_switch = 0.0
+        self.profile = [1000, 10000, 10000] # velocity, acceleration, deceleration in drive units
+        self.motion_profile = list(self.profile) # profile latched by the set point being executed
+        self.target = None # qc, absolute physical coordinate, None when not moving to a target
+        self.target_reached = True
+        self.next = None # (target, profile) of the set point buffered by a non-immediate move, started when the target is reached
+        self.velocity_setpoint = None # qc/s in profile velocity mode
+        self.ipm_buffer = deque() # PVT points (position qc, velocity drive units, time ms)
+        self.ipm_size = 64
+        self.ipm_limits = [10, 60] # underflow and overflow warning levels
+        self.ipm_running = False
+        self.ipm_segment = None # [start point, end point, s into the segment]
+        self.ipm_underflow = False
+        self.ipm_overflow = False
+        self.homing_parameters = [0, 0, 0, 0, 0, 0]
+        self.homing = None # [direction, phase]
+        self.homing_attained = False
+        self.homing_error = False
+        self.referenced = False # statusword bit 15, position referenced to home position
+        self.outputs = 0
+        self.valve_open = False
+        self.valve_actuation = valve_actuation # s the valve power bit must stay on to switch
+        self._power_on = None
+        self.pumped_out_ul = 0.0 # dispensed through the open valve
+        self.pumped_in_ul = 0.0 # aspirated through the closed valve
+        self.recorder_memory = recorder_memory # bytes shared by the active channels
+        self.recorder_period = 10 # samples every period current regulator cycles of 0.1 ms
+        self.recorder_preceding = 0 # samples kept from before the trigger
+        self.recorder_triggers = 0
+        self.recorder_channels = {} # channel number: (index, subindex, size)
+        self.recorder_running = False
+        self.recorder_triggered = False
+        self.recorder_samples = [] # one tuple of channel values per sample
+        self.recorder_next = None # time of the next sample
+        self.last_update = None
+
+    def position(self):
+        return int(round(self.x - self.origin))
+
+    def velocity(self):
+        return int(round(self.v/self.qc_per_unit))
+
+    def fill_volume(self):
+        return max(0.0, -(self.x - self.origin)/self.qc_per_ul)
+
+    # Advance the motion model up to time now
+    def update(self, now):
+        if self.last_update is None:
+            self.last_update = now
+            return
+        elapsed = now - self.last_update
+        self.last_update = now
+        if self.state != STATE_ENABLED and self.v == 0:
+            self._record(now)
+            return
+        steps = int(elapsed/self.dt)
+        t = now - elapsed
+        for _ in range(steps):
+            moving = self._step(self.dt)
+            t += self.dt
+            self._record(t)
+            if not moving:
+                break
+        self._step(elapsed - steps*self.dt)
+        self._record(now)
+
+    # Statusword bits the driver looks at
+    def statusword(self):
+        word = 0x0001 if self.state != STATE_DISABLED else 0
+        if self.state == STATE_ENABLED:
+            word |= 0x0006 # switched on, operation enabled
+        if self.state == STATE_FAULT:
+            word |= 0x0008
+        if self.target_reached:
+            word |= 0x0400
+        if self.mode == MODE_HOMING and self.homing_attained:
+            word |= 0x1000
+        if self.referenced:
+            word |= 0x8000
+        return word
+
+    # Live value of an object, the static ones come from the object dictionary
+    def object_value(self, index, subindex):
+        if index == 0x6041: # statusword
+            return self.statusword()
+        if index == 0x6064: # position actual value
+            return self.position()
+        if index in (0x606C, 0x2028): # velocity actual value, averaged
+            return self.velocity()
+        if index in (0x6078, 0x2027): # current actual value, averaged, mA: friction proportional to the speed
+            return int(round(abs(self.v)/self.qc_per_rpm*0.05))
+        if (index, subindex) not in self.objects:
+            raise _SimError(ERROR_NODE)
+        return self.objects[(index, subindex)]
+
+    # Recorder samples due up to time t, until the memory is full
+    def _record(self, t):
+        if not self.recorder_running:
+            return
+        period = self.recorder_period*0.0001
+        if self.recorder_next is None:
+            self.recorder_next = t
+        if not self.recorder_triggered and self.recorder_triggers & TRIGGER_MOVEMENT_START and not self.target_reached:
+            self.recorder_triggered = True
+            self.recorder_next = t
+            del self.recorder_samples[:max(0, len(self.recorder_samples) - self.recorder_preceding)]
+        size = sum(channel[2] for channel in self.recorder_channels.values())
+        capacity = self.recorder_memory//size if size else 0
+        while self.recorder_next <= t + 1e-9:
+            self.recorder_samples.append(tuple(self.object_value(index, subindex) for index, subindex, _ in self.recorder_channels.values()))
+            self.recorder_next += period
+            if not self.recorder_triggered:
+                del self.recorder_samples[:-self.recorder_preceding or len(self.recorder_samples)]
+            elif len(self.recorder_samples) >= capacity:
+                self.recorder_running = False
+                return
+
+    # One integration step, returns False once nothing moves anymore
+    def _step(self, dt):
+        if dt <= 0:
+            return True
+        if self.ipm_running and self.state == STATE_ENABLED:
+            return self._ipm_step(dt)
+        acc = self.motion_profile[1]*self.qc_per_rpm
+        dec = self.motion_profile[2]*self.qc_per_rpm
+        if self.homing is not None:
+            acc = dec = self.homing_parameters[0]*self.qc_per_rpm
+        if self.state != STATE_ENABLED:
+            v_des = 0.0
+        elif self.homing is not None:
+            v_des = self._homing_velocity()
+        elif self.velocity_setpoint is not None:
+            v_des = self.velocity_setpoint
+        elif self.target is not None:
+            remaining = self.target - self.x
+            if self.next is not None and abs(remaining) < 0.5 and (self.next[0] - self.target)*self.v > 0:
+                # buffered set point in the same direction: carry on without stopping
+                self.target, self.motion_profile = self.next
+                self.next = None
+                remaining = self.target - self.x
+                dec = self.motion_profile[2]*self.qc_per_rpm
+            vmax = self.motion_profile[0]*self.qc_per_unit
+            if abs(remaining) < 0.5 and abs(self.v) <= dec*dt + 1e-9:
+                if self.next is not None:
+                    self.x = self.target
+                    self.v = 0.0
+                    self.target, self.motion_profile = self.next
+                    self.next = None
+                    return True
+                self.x = self.target
+                self.v = 0.0
+                self.target = None
+                self.target_reached = True
+                return True
+            v_end = 0.0
+            if self.next is not None and (self.next[0] - self.target)*remaining > 0:
+                v_end = min(vmax, self.next[1][0]*self.qc_per_unit) # only slow down to the speed of the next set point
+            v_des = min(vmax, (v_end**2 + 2*dec*abs(remaining))**0.5)
+            v_des = v_des if remaining > 0 else -v_des
+        else:
+            v_des = 0.0
+        if v_des == self.v == 0.0:
+            return self.homing is not None # nothing moves anymore, except between two homing phases
+        rate = acc if abs(v_des) > abs(self.v) and v_des*self.v >= 0 else dec
+        dv = max(-rate*dt, min(rate*dt, v_des - self.v))
+        v_new = self.v + dv
+        dx = 0.5*(self.v + v_new)*dt
+        if self.target is not None and self.homing is None and self.velocity_setpoint is None:
+            remaining = self.target - self.x
+            if abs(dx) > abs(remaining) and dx*remaining > 0:
+                dx = remaining # do not overshoot in one step
+        self.v = v_new
+        self._displace(dx)
+        return True
+
+    def _displace(self, dx):
+        if self.x + dx >= self.pos_switch and self.homing is None:
+            dx = self.pos_switch - self.x
+            self._limit_fault()
+        elif self.x + dx <= self.neg_switch and self.homing is None:
+            dx = self.neg_switch - self.x
+            self._limit_fault()
+        self.x += dx
+        volume = abs(dx)/self.qc_per_ul
+        if dx > 0 and self.valve_open:
+            self.pumped_out_ul += volume
+        elif dx < 0 and not self.valve_open:
+            self.pumped_in_ul += volume
+
+    # Cubic interpolation between two PVT points, like the drive does
+    def _ipm_step(self, dt):
+        if self.ipm_segment is None:
+            if not self.ipm_buffer:
+                return self._ipm_underflow()
+            self.ipm_segment = [self.ipm_buffer.popleft(), None, 0.0]
+        start, end, t = self.ipm_segment
+        if start[2] == 0: # last point of the trajectory
+            self._displace(self.origin + start[0] - self.x)
+            self.v = 0.0
+            self.ipm_running = False
+            self.ipm_segment = None
+            self.target_reached = True
+            return False
+        if end is None:
+            if not self.ipm_buffer:
+                return self._ipm_underflow()
+            end = self.ipm_segment[1] = self.ipm_buffer.popleft()
+        T = start[2]/1000
+        t += dt
+        if t >= T:
+            self._displace(self.origin + end[0] - self.x)
+            self.v = end[1]*self.qc_per_unit
+            self.ipm_segment = [end, None, 0.0]
+            return True
+        self.ipm_segment[2] = t
+        p0, p1 = start[0], end[0]
+        m0, m1 = start[1]*self.qc_per_unit*T, end[1]*self.qc_per_unit*T
+        u = t/T
+        x = (2*u**3 - 3*u**2 + 1)*p0 + (u**3 - 2*u**2 + u)*m0 + (-2*u**3 + 3*u**2)*p1 + (u**3 - u**2)*m1
+        self.v = ((6*u**2 - 6*u)*p0 + (3*u**2 - 4*u + 1)*m0 + (-6*u**2 + 6*u)*p1 + (3*u**2 - 2*u)*m1)/T
+        self._displace(self.origin + x - self.x)
+        return True
+
+    # Buffer ran empty in the middle of a trajectory: the drive stops in fault
+    def _ipm_underflow(self):
+        self.ipm_underflow = True
+        self.ipm_running = False
+        self.ipm_segment = None
+        self._limit_fault()
+        return False
+
+    def _limit_fault(self):
+        self.state = STATE_FAULT
+        self.v = 0.0
+        self.target = None
+        self.next = None
+        self.velocity_setpoint = None
+        self.target_reached = True
+
+    def _homing_velocity(self):
+        direction, phase = self.homing
+        speed_switch, offset = self.homing_parameters[1], self.homing_parameters[3]
+        if phase == 0:
+            switch = self.pos_switch if direction > 0 else self.neg_switch
+            if (self.x - switch)*direction >= 0:
+                self.x = switch
+                self.v = 0.0
+                self.homing[1] = 1
+                self.target = switch - direction*offset
+                return 0.0
+            return direction*speed_switch*self.qc_per_unit
+        remaining = self.target - self.x
+        if abs(remaining) < 0.5:
+            self.x = self.target
+            self.v = 0.0
+            self.origin = self.x - self.homing_parameters[5]
+            self.target = None
+            self.homing = None
+            self.homing_attained = True
+            self.referenced = True
+            self.target_reached = True
+            return 0.0
+        vmax = speed_switch*self.qc_per_unit # the offset move runs at switch search speed
+        v = min(vmax, (2*self.homing_parameters[0]*self.qc_per_rpm*abs(remaining))**0.5, abs(remaining)/self.dt)
+        return v if remaining > 0 else -v
+
+    # Digital output word written by the host, the valve follows bit 12 after a long enough power pulse on bit 13
+    def set_outputs(self, word, now):
+        power_was_on = self.outputs & VALVE_POWER_BIT
+        self.outputs = word & 0xFFFF
+        if self.outputs & VALVE_POWER_BIT and not power_was_on:
+            self._power_on = now
+        elif power_was_on and not self.outputs & VALVE_POWER_BIT:
+            if self._power_on is not None and now - self._power_on >= self.valve_actuation:
+                self.valve_open = bool(self.outputs & VALVE_POSITION_BIT)
+            self._power_on = None
+
+
+# Simulated libEposCmd: same function names and ctypes calling convention as the real library
+class EposSim:
+
+    def __init__(self, latency = None, latencies = None, fault_rate = 0.0, node_options = None, seed = None):
+        if latency is None:
+            latency = float(os.environ.get("NEMESYS_SIM_LATENCY", 0))
+        self.latency = latency # s added to every call, models the serial transaction
+        self.latencies = dict(latencies or {}) # per function overrides of latency
+        self.fault_rate = fault_rate # probability of a random communication error on any call
+        self.node_options = dict(node_options or {}) # keyword arguments of SimNode
+        self.ports = {} # port -> {nodeID: SimNode}
+        self.handles = {} # key handle -> port
+        self.clock = time.monotonic
+        self.calls = 0
+        self._next_handle = 1
+        self._faults = []
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    # Make the next count calls of function fail with code, on any node if nodeID is None
+    def inject_fault(self, function, code = ERROR_INJECTED, count = 1, nodeID = None):
+        with self._lock:
+            self._faults.append([function, code, count, nodeID])
+
+    def node(self, port, nodeID):
+        with self._lock:
+            nodes = self.ports.setdefault(port, {})
+            if nodeID not in nodes:
+                nodes[nodeID] = SimNode(nodeID, **self.node_options)
+            return nodes[nodeID]
+
+    def __getattr__(self, name):
+        if not name.startswith("VCS_"):
+            raise AttributeError(name)
+        implementation = getattr(self, "_" + name[4:], None)
+        if implementation is None:
+            raise AttributeError("Simulated EPOS library has no function %s" % name)
+        return lambda *args: self._call(name, implementation, args)
+
+    def _call(self, name, implementation, args):
+        delay = self.latencies.get(name, self.latency)
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            self.calls += 1
+            perror = args[-1]
+            nodeID = _value(args[1]) if len(args) > 2 and name not in ("VCS_OpenDevice", "VCS_GetErrorInfo", "VCS_CloseDevice", "VCS_SetProtocolStackSettings") else None
+            code = self._injected(name, nodeID)
+            if code is None and self.fault_rate and name != "VCS_GetErrorInfo" and self._random.random() < self.fault_rate:
+                code = ERROR_INJECTED
+            if code is None:
+                try:
+                    return implementation(*args)
+                except _SimError as e:
+                    code = e.code
+            if name != "VCS_GetErrorInfo":
+                _set(perror, code)
+            return 0
+
+    def _injected(self, name, nodeID):
+        for fault in self._faults:
+            if fault[0] == name and (fault[3] is None or fault[3] == nodeID):
+                fault[2] -= 1
+                if fault[2] <= 0:
+                    self._faults.remove(fault)
+                return fault[1]
+        return None
+
+    def _node(self, handle, nodeID):
+        port = self.handles.get(_value(handle))
+        if port is None:
+            raise _SimError(ERROR_HANDLE)
+        node = self.node(port, _value(nodeID))
+        node.update(self.clock())
+        return node
+
+    def _enabled(self, handle, nodeID, mode = None):
+        node = self._node(handle, nodeID)
+        if node.state != STATE_ENABLED:
+            raise _SimError(ERROR_STATE)
+        if mode is not None and node.mode != mode:
+            raise _SimError(ERROR_MODE)
+        return node
+
+    # Bus
+    def _OpenDevice(self, deviceName, protocolStackName, interfaceName, portName, perror):
+        handle = self._next_handle
+        self._next_handle += 1
+        self.handles[handle] = _value(portName)
+        self.ports.setdefault(_value(portName), {})
+        _set(perror, 0)
+        return handle
+
+    def _SetProtocolStackSettings(self, handle, baudrate, timeout, perror):
+        if _value(handle) not in self.handles:
+            raise _SimError(ERROR_HANDLE)
+        _set(perror, 0)
+        return 1
+
+    def _CloseDevice(self, handle, perror):
+        if self.handles.pop(_value(handle), None) is None:
+            raise _SimError(ERROR_HANDLE)
+        _set(perror, 0)
+        return 1
+
+    def _GetErrorInfo(self, code, perrorinfo, maxlength):
+        info = _ERROR_INFO.get(_value(code), "Unknown error").encode()
+        _set(perrorinfo, info[:max(0, _value(_target(maxlength)) - 1)])
+        return 1
+
+    # State machine
+    def _ClearFault(self, handle, nodeID, perror):
+        node = self._node(handle, nodeID)
+        if node.state == STATE_FAULT:
+            node.state = STATE_DISABLED
+        _set(perror, 0)
+        return 1
+
+    def _SetEnableState(self, handle, nodeID, perror):
+        node = self._node(handle, nodeID)
+        if node.state == STATE_FAULT:
+            raise _SimError(ERROR_STATE)
+        node.state = STATE_ENABLED
+        _set(perror, 0)
+        return 1
+
+    def _SetDisableState(self, handle, nodeID, perror):
+        node = self._node(handle, nodeID)
+        node.state = STATE_DISABLED
+        node.v = 0.0
+        node.target = None
+        node.next = None
+        node.velocity_setpoint = None
+        node.homing = None
+        node.target_reached = True
+        _set(perror, 0)
+        return 1
+
+    def _GetState(self, handle, nodeID, pstate, perror):
+        _set(pstate, self._node(handle, nodeID).state)
+        _set(perror, 0)
+        return 1
+
+    def _GetOperationMode(self, handle, nodeID, pmode, perror):
+        _set(pmode, self._node(handle, nodeID).mode)
+        _set(perror, 0)
+        return 1
+
+    def _SetOperationMode(self, handle, nodeID, mode, perror):
+        self._node(handle, nodeID).mode = _value(mode)
+        _set(perror, 0)
+        return 1
+
+    # Object dictionary
+    def _GetObject(self, handle, nodeID, index, subindex, pdata, nbytes, pnbread, perror):
+        node = self._node(handle, nodeID)
+        _set(pdata, node.object_value(_value(index), _value(subindex)))
+        _set(pnbread, _value(nbytes))
+        _set(perror, 0)
+        return 1
+
+    def _SetObject(self, handle, nodeID, index, subindex, pdata, nbytes, pnbwritten, perror):
+        node = self._node(handle, nodeID)
+        key = (_value(index), _value(subindex))
+        value = _value(_target(pdata))
+        previous = node.objects.get(key, 0)
+        node.objects[key] = value
+        if key == (0x6040, 0) and value & 0x10 and not previous & 0x10 and node.mode == MODE_PROFILE_POSITION:
+            # controlword new setpoint rising edge starts a move to the target position object
+            if node.state != STATE_ENABLED:
+                raise _SimError(ERROR_STATE)
+            target = node.objects.get((0x607A, 0), 0)
+            node.motion_profile = list(node.profile)
+            node.target = (node.target if (value & 0x40 and node.target is not None) else (node.x if value & 0x40 else node.origin)) + target
+            node.target_reached = False
+        _set(pnbwritten, _value(nbytes))
+        _set(perror, 0)
+        return 1
+
+    # Motion readback
+    def _GetPositionIs(self, handle, nodeID, pposition, perror):
+        _set(pposition, self._node(handle, nodeID).position())
+        _set(perror, 0)
+        return 1
+
+    def _GetVelocityIs(self, handle, nodeID, pvelocity, perror):
+        _set(pvelocity, self._node(handle, nodeID).velocity())
+        _set(perror, 0)
+        return 1
+
+    _GetVelocityIsAveraged = _GetVelocityIs
+
+    def _GetMovementState(self, handle, nodeID, ptargetreached, perror):
+        _set(ptargetreached, int(self._node(handle, nodeID).target_reached))
+        _set(perror, 0)
+        return 1
+
+    # Homing mode
+    def _ActivateHomingMode(self, handle, nodeID, perror):
+        self._enabled(handle, nodeID).mode = MODE_HOMING
+        _set(perror, 0)
+        return 1
+
+    def _SetHomingParameter(self, handle, nodeID, acceleration, speedSwitch, speedIndex, homeOffset, currentThreshold, homePosition, perror):
+        node = self._node(handle, nodeID)
+        node.homing_parameters = [_value(acceleration), _value(speedSwitch), _value(speedIndex), _value(homeOffset), _value(currentThreshold), _value(homePosition)]
+        _set(perror, 0)
+        return 1
+
+    def _FindHome(self, handle, nodeID, method, perror):
+        node = self._enabled(handle, nodeID, MODE_HOMING)
+        method = _value(method)
+        if method not in (17, 18):
+            raise _SimError(ERROR_BAD_PARAMETER)
+        node.homing = [1 if method == 18 else -1, 0]
+        node.homing_attained = False
+        node.referenced = False
+        node.homing_error = False
+        node.target_reached = False
+        node.next = None
+        node.velocity_setpoint = None
+        _set(perror, 0)
+        return 1
+
+    def _StopHoming(self, handle, nodeID, perror):
+        node = self._enabled(handle, nodeID, MODE_HOMING)
+        if node.homing is not None:
+            node.homing = None
+            node.target = None
+            node.velocity_setpoint = 0.0 # brake with the profile deceleration
+        node.target_reached = True
+        _set(perror, 0)
+        return 1
+
+    def _GetHomingState(self, handle, nodeID, pattained, perror_flag, perror):
+        node = self._node(handle, nodeID)
+        _set(pattained, int(node.homing_attained))
+        _set(perror_flag, int(node.homing_error))
+        _set(perror, 0)
+        return 1
+
+    def _WaitForHomingAttained(self, handle, nodeID, timeout, perror):
+        return self._wait(handle, nodeID, timeout, lambda node: node.homing_attained)
+
+    # Profile position mode
+    def _ActivateProfilePositionMode(self, handle, nodeID, perror):
+        node = self._enabled(handle, nodeID)
+        node.mode = MODE_PROFILE_POSITION
+        node.velocity_setpoint = None
+        _set(perror, 0)
+        return 1
+
+    def _SetPositionProfile(self, handle, nodeID, velocity, acceleration, deceleration, perror):
+        node = self._node(handle, nodeID)
+        if _value(velocity) <= 0 or _value(acceleration) <= 0 or _value(deceleration) <= 0:
+            raise _SimError(ERROR_BAD_PARAMETER)
+        node.profile = [_value(velocity), _value(acceleration), _value(deceleration)]
+        _set(perror, 0)
+        return 1
+
+    def _GetPositionProfile(self, handle, nodeID, pvelocity, pacceleration, pdeceleration, perror):
+        node = self._node(handle, nodeID)
+        _set(pvelocity, node.profile[0])
+        _set(pacceleration, node.profile[1])
+        _set(pdeceleration, node.profile[2])
+        _set(perror, 0)
+        return 1
+
+    def _MoveToPosition(self, handle, nodeID, target, absolute, immediately, perror):
+        node = self._enabled(handle, nodeID, MODE_PROFILE_POSITION)
+        target = _value(target)
+        if not _value(immediately) and node.target is not None:
+            # buffered behind the current set point with the profile in force now, one set point deep like the EPOS2
+            node.next = ((node.origin + target) if _value(absolute) else (node.target + target), list(node.profile))
+            _set(perror, 0)
+            return 1
+        node.target = (node.origin + target) if _value(absolute) else ((node.target if node.target is not None else node.x) + target)
+        node.motion_profile = list(node.profile)
+        node.next = None
+        node.target_reached = False
+        _set(perror, 0)
+        return 1
+
+    def _HaltPositionMovement(self, handle, nodeID, perror):
+        node = self._node(handle, nodeID)
+        if node.state == STATE_ENABLED and node.v != 0:
+            # brake with the profile deceleration
+            stop = node.v*abs(node.v)/(2*node.profile[2]*node.qc_per_rpm)
+            node.target = node.x + stop
+            node.motion_profile = list(node.profile)
+            node.target_reached = False
+        else:
+            node.target = None
+            node.target_reached = True
+        node.next = None
+        node.velocity_setpoint = None
+        node.homing = None
+        _set(perror, 0)
+        return 1
+
+    # Profile velocity mode
+    def _ActivateProfileVelocityMode(self, handle, nodeID, perror):
+        node = self._enabled(handle, nodeID)
+        node.mode = MODE_PROFILE_VELOCITY
+        node.target = None
+        node.next = None
+        _set(perror, 0)
+        return 1
+
+    def _SetVelocityProfile(self, handle, nodeID, acceleration, deceleration, perror):
+        node = self._node(handle, nodeID)
+        if _value(acceleration) <= 0 or _value(deceleration) <= 0:
+            raise _SimError(ERROR_BAD_PARAMETER)
+        node.profile[1:] = [_value(acceleration), _value(deceleration)]
+        node.motion_profile[1:] = node.profile[1:] # applies to the running velocity at once
+        _set(perror, 0)
+        return 1
+
+    def _GetVelocityProfile(self, handle, nodeID, pacceleration, pdeceleration, perror):
+        node = self._node(handle, nodeID)
+        _set(pacceleration, node.profile[1])
+        _set(pdeceleration, node.profile[2])
+        _set(perror, 0)
+        return 1
+
+    def _MoveWithVelocity(self, handle, nodeID, velocity, perror):
+        node = self._enabled(handle, nodeID, MODE_PROFILE_VELOCITY)
+        node.velocity_setpoint = _value(velocity)*node.qc_per_unit
+        node.target_reached = False
+        _set(perror, 0)
+        return 1
+
+    def _HaltVelocityMovement(self, handle, nodeID, perror):
+        node = self._node(handle, nodeID)
+        if node.velocity_setpoint is not None:
+            node.velocity_setpoint = 0.0
+        node.target_reached = True
+        _set(perror, 0)
+        return 1
+
+    # Interpolated position mode
+    def _ActivateInterpolatedPositionMode(self, handle, nodeID, perror):
+        node = self._enabled(handle, nodeID)
+        node.mode = MODE_INTERPOLATED_POSITION
+        node.target = None
+        node.next = None
+        node.velocity_setpoint = None
+        _set(perror, 0)
+        return 1
+
+    def _SetIpmBufferParameter(self, handle, nodeID, underflowWarning, overflowWarning, perror):
+        node = self._node(handle, nodeID)
+        node.ipm_limits = [_value(underflowWarning), _value(overflowWarning)]
+        _set(perror, 0)
+        return 1
+
+    def _GetIpmBufferParameter(self, handle, nodeID, punderflowWarning, poverflowWarning, pmaxBufferSize, perror):
+        node = self._node(handle, nodeID)
+        _set(punderflowWarning, node.ipm_limits[0])
+        _set(poverflowWarning, node.ipm_limits[1])
+        _set(pmaxBufferSize, node.ipm_size)
+        _set(perror, 0)
+        return 1
+
+    def _ClearIpmBuffer(self, handle, nodeID, perror):
+        node = self._node(handle, nodeID)
+        node.ipm_buffer.clear()
+        node.ipm_running = False
+        node.ipm_segment = None
+        node.ipm_underflow = False
+        node.ipm_overflow = False
+        _set(perror, 0)
+        return 1
+
+    def _GetFreeIpmBufferSize(self, handle, nodeID, pbufferSize, perror):
+        node = self._node(handle, nodeID)
+        _set(pbufferSize, node.ipm_size - len(node.ipm_buffer))
+        _set(perror, 0)
+        return 1
+
+    def _AddPvtValueToIpmBuffer(self, handle, nodeID, position, velocity, time, perror):
+        node = self._node(handle, nodeID)
+        if len(node.ipm_buffer) >= node.ipm_size:
+            node.ipm_overflow = True
+            raise _SimError(ERROR_IPM_OVERFLOW)
+        node.ipm_buffer.append((_value(position), _value(velocity), _value(time)))
+        _set(perror, 0)
+        return 1
+
+    def _StartIpmTrajectory(self, handle, nodeID, perror):
+        node = self._enabled(handle, nodeID, MODE_INTERPOLATED_POSITION)
+        node.ipm_running = True
+        node.target_reached = False
+        _set(perror, 0)
+        return 1
+
+    def _StopIpmTrajectory(self, handle, nodeID, perror):
+        node = self._node(handle, nodeID)
+        if node.ipm_running:
+            node.ipm_running = False
+            node.ipm_segment = None
+            node.velocity_setpoint = 0.0 # brake with the profile deceleration
+        node.target_reached = True
+        _set(perror, 0)
+        return 1
+
+    def _GetIpmStatus(self, handle, nodeID, prunning, punderflowWarning, poverflowWarning, pvelocityWarning, paccelerationWarning,
+                      punderflowError, poverflowError, pvelocityError, paccelerationError, perror):
+        node = self._node(handle, nodeID)
+        level = len(node.ipm_buffer)
+        _set(prunning, int(node.ipm_running))
+        _set(punderflowWarning, int(node.ipm_running and level < node.ipm_limits[0]))
+        _set(poverflowWarning, int(level > node.ipm_limits[1]))
+        _set(pvelocityWarning, 0)
+        _set(paccelerationWarning, 0)
+        _set(punderflowError, int(node.ipm_underflow))
+        _set(poverflowError, int(node.ipm_overflow))
+        _set(pvelocityError, 0)
+        _set(paccelerationError, 0)
+        _set(perror, 0)
+        return 1
+
+    # Data recorder
+    def _SetRecorderParameter(self, handle, nodeID, samplingPeriod, precedingSamples, perror):
+        node = self._node(handle, nodeID)
+        if _value(samplingPeriod) < 1:
+            raise _SimError(ERROR_RECORDER)
+        node.recorder_period = _value(samplingPeriod)
+        node.recorder_preceding = _value(precedingSamples)
+        _set(perror, 0)
+        return 1
+
+    def _GetRecorderParameter(self, handle, nodeID, psamplingPeriod, pprecedingSamples, perror):
+        node = self._node(handle, nodeID)
+        _set(psamplingPeriod, node.recorder_period)
+        _set(pprecedingSamples, node.recorder_preceding)
+        _set(perror, 0)
+        return 1
+
+    def _EnableTrigger(self, handle, nodeID, triggerType, perror):
+        self._node(handle, nodeID).recorder_triggers |= _value(triggerType)
+        _set(perror, 0)
+        return 1
+
+    def _DisableAllTriggers(self, handle, nodeID, perror):
+        self._node(handle, nodeID).recorder_triggers = 0
+        _set(perror, 0)
+        return 1
+
+    def _ActivateChannel(self, handle, nodeID, channelNumber, index, subIndex, objectSize, perror):
+        node = self._node(handle, nodeID)
+        if not 1 <= _value(channelNumber) <= 4 or _value(objectSize) not in (1, 2, 4):
+            raise _SimError(ERROR_RECORDER)
+        node.object_value(_value(index), _value(subIndex))
+        node.recorder_channels[_value(channelNumber)] = (_value(index), _value(subIndex), _value(objectSize))
+        _set(perror, 0)
+        return 1
+
+    def _DeactivateAllChannels(self, handle, nodeID, perror):
+        self._node(handle, nodeID).recorder_channels = {}
+        _set(perror, 0)
+        return 1
+
+    def _StartRecorder(self, handle, nodeID, perror):
+        node = self._node(handle, nodeID)
+        node.recorder_channels = dict(sorted(node.recorder_channels.items()))
+        node.recorder_samples = []
+        node.recorder_next = None
+        node.recorder_triggered = False
+        node.recorder_running = bool(node.recorder_channels)
+        _set(perror, 0)
+        return 1
+
+    def _StopRecorder(self, handle, nodeID, perror):
+        self._node(handle, nodeID).recorder_running = False
+        _set(perror, 0)
+        return 1
+
+    def _ForceTrigger(self, handle, nodeID, perror):
+        node = self._node(handle, nodeID)
+        if node.recorder_running and not node.recorder_triggered:
+            node.recorder_triggered = True
+            node.recorder_next = self.clock()
+            del node.recorder_samples[:max(0, len(node.recorder_samples) - node.recorder_preceding)]
+        _set(perror, 0)
+        return 1
+
+    def _IsRecorderRunning(self, handle, nodeID, prunning, perror):
+        _set(prunning, int(self._node(handle, nodeID).recorder_running))
+        _set(perror, 0)
+        return 1
+
+    def _IsRecorderTriggered(self, handle, nodeID, ptriggered, perror):
+        _set(ptriggered, int(self._node(handle, nodeID).recorder_triggered))
+        _set(perror, 0)
+        return 1
+
+    # Number of samples recorded per channel
+    def _ReadChannelVectorSize(self, handle, nodeID, pvectorSize, perror):
+        _set(pvectorSize, len(self._node(handle, nodeID).recorder_samples))
+        _set(perror, 0)
+        return 1
+
+    # Samples of one channel, little endian, objectSize bytes each
+    def _ReadChannelDataVector(self, handle, nodeID, channelNumber, pdataVector, vectorSize, perror):
+        node = self._node(handle, nodeID)
+        channels = list(node.recorder_channels)
+        if _value(channelNumber) not in channels:
+            raise _SimError(ERROR_RECORDER)
+        column = channels.index(_value(channelNumber))
+        size = node.recorder_channels[_value(channelNumber)][2]
+        data = b"".join((sample[column] & (1 << 8*size) - 1).to_bytes(size, "little") for sample in node.recorder_samples)
+        buffer = _target(pdataVector)
+        count = min(len(data), _value(vectorSize))
+        buffer[:count] = data[:count]
+        _set(perror, 0)
+        return 1
+
+    def _WaitForTargetReached(self, handle, nodeID, timeout, perror):
+        return self._wait(handle, nodeID, timeout, lambda node: node.target_reached and node.v == 0)
+
+    # Block like the library does, the lock is released so the model keeps running
+    def _wait(self, handle, nodeID, timeout, condition):
+        deadline = self.clock() + _value(timeout)/1000
+        while True:
+            node = self._node(handle, nodeID)
+            if condition(node):
+                return 1
+            if self.clock() >= deadline:
+                raise _SimError(ERROR_TIMEOUT)
+            self._lock.release()
+            try:
+                time.sleep(0.001)
+            finally:
+                self._lock.acquire()
+
+    # Digital outputs
+    def _GetAllDigitalOutputs(self, handle, nodeID, pstate, perror):
+        _set(pstate, self._node(handle, nodeID).outputs)
+        _set(perror, 0)
+        return 1
+
+    def _SetAllDigitalOutputs(self, handle, nodeID, state, perror):
+        self._node(handle, nodeID).set_outputs(_value(state), self.clock())
+        _set(perror, 0)
+        return 1
+
+
+class _SimError(Exception):
+
+    def __init__(self, code):
+        super().__init__(hex(code))
+        self.code = code
+
+
+_default = None
+_default_lock = threading.Lock()
+
+# Simulator shared by every Nemesys created with backend = "sim"
+def default():
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = EposSim()
+        return _default
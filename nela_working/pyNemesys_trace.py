@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the bliss project
+#
+# Copyright (c) 2015-2023 Beamline Control Unit, ESRF
+# Distributed under the GNU LGPLv3. See LICENSE for more info.
+# Author: Antonino Calio'
+#
+# Tracing of the EPOS command library calls: counts, errors and latency histograms per function and per port:node,
+# an optional ring buffer of the last calls, and hooks called with every call. Wrap the backend once and give it
+# to every pump, pumps sharing a port must share the wrapped backend to share the bus handle:
+#
+#   tracer = Tracer(ring_size = 1000)
+#   backend = tracer.wrap(pyNemesys_linux.epos)
+#   pumps = [Nemesys(node, backend = backend) for node in (2, 3)]
+#   print(tracer.dump())
+#
+# NEMESYS_TRACE=<ring size> does the same for every pump using the default backend, see pyNemesys_linux.tracer.
+
+import json
+import time
+import ctypes
+import threading
+from collections import namedtuple, deque
+
+# Upper bounds in s of the latency histogram buckets, the last one catches everything slower
+BUCKETS = (1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 0.2, 0.5, 1.0, float("inf"))
+
+# Functions without a node argument
+BUS_FUNCTIONS = ("VCS_OpenDevice", "VCS_SetProtocolStackSettings", "VCS_CloseDevice", "VCS_GetErrorInfo")
+
+# One library call: start time (time.time), arguments as plain values (outputs as left by the call), error code if it failed
+TraceRecord = namedtuple("TraceRecord", ["timestamp", "function", "port", "nodeID", "args", "result", "error", "duration", "thread"])
+
+
+# Plain value of a ctypes argument, the pointed value for byref() arguments and bytes for buffers
+def plain(arg):
+    obj = getattr(arg, "_obj", None)
+    if obj is None:
+        obj = arg.contents if isinstance(arg, ctypes._Pointer) else arg
+    if isinstance(obj, ctypes.Array):
+        return obj.value if obj._type_ is ctypes.c_char else bytes(obj)
+    return getattr(obj, "value", obj)
+
+
+# Call count, error count and latency histogram of one function or one node
+class _Stats:
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0]*len(BUCKETS)
+
+    def add(self, duration, failed):
+        self.count += 1
+        self.errors += bool(failed)
+        self.total += duration
+        self.min = duration if self.min is None else min(self.min, duration)
+        self.max = duration if self.max is None else max(self.max, duration)
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+
+    # Upper bound of the bucket holding the q quantile
+    def quantile(self, q):
+        rank = q*self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return None
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total": self.total,
+            "mean": self.total/self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "histogram": {("%g" % bound if bound != float("inf") else "inf"): count for bound, count in zip(BUCKETS, self.buckets) if count},
+        }
+
+
+class Tracer:
+
+    def __init__(self, ring_size = 0):
+        self.ring_size = ring_size # last calls kept with their arguments, 0 for none
+        self._lock = threading.Lock()
+        self._hooks = []
+        self._ports = {} # key handle -> port
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._functions = {}
+            self._nodes = {}
+            self._ring = deque(maxlen = self.ring_size) if self.ring_size else None
+            self._in_calls = 0.0
+            self._wall = time.monotonic()
+            self._cpu = time.process_time()
+
+    def wrap(self, backend):
+        return TracedEpos(backend, self)
+
+    # hook(record) is called after every library call, from the calling thread
+    def add_hook(self, hook):
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        with self._lock:
+            if hook in self._hooks:
+                self._hooks.remove(hook)
+
+    def _record(self, function, args, result, timestamp, duration, failed):
+        if function == "VCS_OpenDevice" and result:
+            self._ports[result] = plain(args[3])
+        port = self._ports.get(plain(args[0])) if args and function != "VCS_GetErrorInfo" else None
+        nodeID = plain(args[1]) if len(args) > 2 and function not in BUS_FUNCTIONS else None
+        error = None
+        if failed and function != "VCS_GetErrorInfo":
+            error = plain(args[-1]) if args else None
+        with self._lock:
+            hooks = list(self._hooks)
+            self._in_calls += duration
+            self._functions.setdefault(function, _Stats()).add(duration, failed)
+            if nodeID is not None:
+                self._nodes.setdefault(node_key(port, nodeID), _Stats()).add(duration, failed)
+            if self._ring is None and not hooks:
+                return
+        record = TraceRecord(timestamp, function, port, nodeID, tuple(plain(arg) for arg in args), plain(result), error, duration, threading.current_thread().name)
+        with self._lock:
+            if self._ring is not None:
+                self._ring.append(record)
+        for hook in hooks:
+            hook(record)
+
+    # Statistics by "function" or by "node" (port:node keys)
+    def stats(self, by = "function"):
+        with self._lock:
+            table = self._functions if by == "function" else self._nodes
+            return {key: stats.as_dict() for key, stats in sorted(table.items(), key = lambda item: str(item[0]))}
+
+    # Last n recorded calls, optionally of one function and/or one node
+    def recent(self, n = None, function = None, nodeID = None):
+        with self._lock:
+            records = list(self._ring or ())
+        records = [r for r in records if (function is None or r.function == function) and (nodeID is None or r.nodeID == nodeID)]
+        return records[-n:] if n else records
+
+    # Where the time went since reset: wall time, time inside the library (bus), process CPU time, and the rest (sleeps, waits)
+    def summary(self):
+        with self._lock:
+            wall = time.monotonic() - self._wall
+            cpu = time.process_time() - self._cpu
+            in_calls = self._in_calls
+            calls = sum(stats.count for stats in self._functions.values())
+            errors = sum(stats.errors for stats in self._functions.values())
+        return {"wall": wall, "in_calls": in_calls, "cpu": cpu, "other": max(0.0, wall - in_calls - cpu), "calls": calls, "errors": errors}
+
+    def as_dict(self):
+        return {
+            "summary": self.summary(),
+            "functions": self.stats("function"),
+            "nodes": self.stats("node"),
+            "recent": [record._asdict() for record in self.recent()],
+        }
+
+    def dump_json(self, f = None, indent = 1):
+        text = json.dumps(self.as_dict(), indent = indent, default = lambda value: value.hex() if isinstance(value, bytes) else str(value))
+        if f is not None:
+            f.write(text)
+        return text
+
+    def dump(self):
+        summary = self.summary()
+        lines = ["wall %.3f s  in library calls %.3f s  cpu %.3f s  other %.3f s  calls %d  errors %d" % (
+            summary["wall"], summary["in_calls"], summary["cpu"], summary["other"], summary["calls"], summary["errors"])]
+        for title, by in (("function", "function"), ("port:node", "node")):
+            lines.append("%-36s %8s %6s %10s %10s %10s %10s" % (title, "calls", "errors", "mean ms", "p50 ms", "p99 ms", "max ms"))
+            for key, stats in self.stats(by).items():
+                lines.append("%-36s %8d %6d %10.3f %10.3f %10.3f %10.3f" % (key, stats["count"], stats["errors"], stats["mean"]*1000,
+                                                                          stats["p50"]*1000, stats["p99"]*1000, stats["max"]*1000))
+        return "\n".join(lines)
+
+
+def node_key(port, nodeID):
+    return "%s:%s" % (port.decode(errors = "replace") if isinstance(port, bytes) else port, nodeID)
+
+
+# EPOS library (or simulator) with every VCS_* function traced, anything else is passed through
+class TracedEpos:
+
+    def __init__(self, backend, tracer):
+        self._backend = backend
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        if not name.startswith("VCS_"):
+            return getattr(self._backend, name)
+        function = getattr(self._backend, name)
+        record = self.tracer._record
+        def traced(*args):
+            timestamp = time.time()
+            start = time.perf_counter()
+            try:
+                result = function(*args)
+            except BaseException:
+                record(name, args, None, timestamp, time.perf_counter() - start, True)
+                raise
+            record(name, args, result, timestamp, time.perf_counter() - start, not result)
+            return result
+        traced.__name__ = name
+        setattr(self, name, traced) # later lookups skip __getattr__
+        return traced
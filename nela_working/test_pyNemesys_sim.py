@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of the bliss project
+#
+# Copyright (c) 2015-2023 Beamline Control Unit, ESRF
+# Distributed under the GNU LGPLv3. See LICENSE for more info.
+# Author: Antonino Calio'
+#
+# Driver tests on the simulated EPOS2 backend, no hardware and no state files: python -m pytest -q
+
+import os
+
+os.environ["NEMESYS_STATE"] = "" # before the driver reads them at import
+os.environ["NEMESYS_CACHE"] = ""
+
+import time
+import queue
+import asyncio
+import threading
+
+import pytest
+
+import pyNemesys_linux as nemesys
+from pyNemesys_sim import EposSim, ERROR_INJECTED
+from pyNemesys_async import AsyncNemesys
+from pyNemesys_flow import ContinuousFlow, FlowProgram, PvtStream, pvt_from_flow
+from pyNemesys_progress import NullProgress
+from pyNemesys_trace import Tracer
+from pyNemesys_replay import SessionRecorder, replay
+
+PORT = b"/dev/ttyS4"
+
+
+@pytest.fixture
+def sim():
+    return EposSim()
+
+# Pumps on the simulator, closed at the end of the test
+@pytest.fixture
+def make(sim):
+    pumps = []
+    def make(nodeID, **kwargs):
+        pump = nemesys.Nemesys(nodeID, PORT, backend = sim, progress = NullProgress(), **kwargs)
+        pumps.append(pump)
+        return pump
+    yield make
+    for pump in pumps:
+        pump._bus_close()
+
+
+def test_sim_moves_the_plunger(sim, make):
+    p = make(2)
+    p._reference_pos_lim()
+    p._set_valve(False)
+    node = sim.node(PORT, 2)
+    aspirated, dispensed = node.pumped_in_ul, node.pumped_out_ul
+    assert p._move_to_position_speed(-10, 40) == 0
+    assert abs(node.pumped_in_ul - aspirated - 10) < 0.5 and node.pumped_out_ul == dispensed
+
+def test_sim_injected_fault(sim, make):
+    p = make(2)
+    sim.inject_fault("VCS_MoveToPosition")
+    assert p._move_to_position_speed(-5, 40, wait = False) == ERROR_INJECTED
+    assert p._move_to_position_speed(-5, 40, wait = False) == 0 # one call only
+
+def test_shared_handle_refcount(sim, make):
+    p = make(2)
+    q = make(3)
+    assert p.bus is q.bus and p.bus.refs == 2
+    assert len(sim.handles) == 1
+    p._bus_close()
+    assert q.bus.refs == 1 and len(sim.handles) == 1
+    q._bus_close()
+    assert sim.handles == {} and (sim, PORT) not in nemesys._buses
+
+def test_move_completion(make):
+    p = make(2)
+    p._reference_pos_lim()
+    assert p._move_to_position_speed(-20, 40) == 0
+    assert p.last_motion.reached and not p.last_motion.timeout
+    assert p.last_motion.polls <= 3 # the expected duration is close to the real one
+    assert abs(p._get_position()/p.ul + 20) < 1
+
+def test_halted_move_is_not_reached(make):
+    p = make(2)
+    p._reference_pos_lim()
+    threading.Timer(0.5, p._halt).start()
+    start = time.monotonic()
+    p._move_to_position_speed(-100, 20)
+    assert time.monotonic() - start < 1.0 # the halt ends the wait, not the estimate of 5 s
+    assert not p.last_motion.reached and not p.last_motion.timeout
+
+def test_failed_move_is_not_awaited(sim, make):
+    p = make(2)
+    p._reference_pos_lim()
+    p.last_motion = None
+    sim.inject_fault("VCS_MoveToPosition")
+    assert p._move_to_position_speed(-100, 20) == ERROR_INJECTED
+    assert p.last_motion is None
+
+def test_snapshot_ttl(sim, make):
+    p = make(2, snapshot_ttl = 0.2)
+    first = p.snapshot()
+    calls = sim.calls
+    assert p.snapshot() is first and sim.calls == calls
+    time.sleep(0.25)
+    assert p.snapshot() is not first and sim.calls > calls
+
+def test_poller_survives_failing_pump(make, monkeypatch):
+    p = make(2)
+    q = make(3)
+    poller = p._poll(50)
+    q._poll()
+    def closed(max_age = None):
+        raise AttributeError("'NoneType' object has no attribute 'lock'") # handle closed after the poller picked the pump
+    monkeypatch.setattr(p, "snapshot", closed)
+    seen = queue.Queue()
+    poller.subscribe(seen, nodeID = 3)
+    time.sleep(0.3)
+    assert poller._thread.is_alive() and not seen.empty()
+    poller.stop()
+
+def test_group_move(make):
+    pumps = [make(2), make(3)]
+    nemesys.home_pumps(pumps)
+    result = nemesys.NemesysGroup(pumps).move([(-30, 40), (-10, 40)])
+    assert result.reached
+    for pump, target in zip(pumps, (-30, -10)):
+        assert abs(pump._get_position()/pump.ul - target) < 1
+
+def test_group_move_with_a_halted_pump(make):
+    pumps = [make(2), make(3)]
+    nemesys.home_pumps(pumps)
+    group = nemesys.NemesysGroup(pumps)
+    group.move([(-100, 20), (-100, 20)], wait = False)
+    time.sleep(0.5)
+    for pump in pumps:
+        pump._halt()
+    start = time.monotonic()
+    result = group.wait()
+    assert time.monotonic() - start < 1.0 # not the 5 s expected for the moves
+    assert not result.reached
+    assert not any(motion.reached or motion.timeout for motion in result.motions)
+
+def test_async_moves(make):
+    pumps = [AsyncNemesys(make(nodeID)) for nodeID in (2, 3)]
+    async def run():
+        await asyncio.gather(*(pump.home() for pump in pumps))
+        asyncio.get_running_loop().call_later(0.5, pumps[1].pump._halt)
+        return await asyncio.gather(pumps[0].move(-20, 40), pumps[1].move(-100, 20))
+    start = time.monotonic()
+    moved, halted = asyncio.run(run())
+    assert moved.reached and abs(moved.position/pumps[0].pump.ul + 20) < 1
+    assert not halted.reached and not halted.timeout
+    assert time.monotonic() - start < 3 # homing and the halt, not the 5 s expected for the halted move
+
+def test_halt_priority_under_load(sim, make):
+    sim.latency = 0.002
+    p = make(2)
+    q = make(3)
+    p._reference_pos_lim()
+    stop = threading.Event()
+    def load():
+        while not stop.is_set():
+            q.snapshot(max_age = 0)
+    threads = [threading.Thread(target = load) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    try:
+        p._move_to_position_speed(-200, 20, wait = False)
+        time.sleep(0.2)
+        p.bus.lock.stats(reset = True)
+        start = time.monotonic()
+        assert p._halt() == 0
+        latency = time.monotonic() - start
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    assert latency < 0.1
+    assert p.bus.lock.stats()["priority"]["max_wait"] < 0.05 # at most the transaction in progress
+    time.sleep(0.3)
+    assert sim.node(PORT, 2).v == 0
+
+def test_drive_wait_leaves_the_bus_to_a_stop(make):
+    p = make(2, drive_wait = True)
+    p.homing_timeout = 3
+    homing = threading.Thread(target = p._reference_neg_lim)
+    homing.start()
+    time.sleep(0.3)
+    start = time.monotonic()
+    p._stop_homing()
+    latency = time.monotonic() - start
+    homing.join(1.0)
+    assert latency < 0.2 and not homing.is_alive() # the stop also ends the wait of the homing
+
+def test_continuous_flow_stops_during_a_refill(sim, make):
+    pumps = [make(2), make(3)]
+    nemesys.home_pumps(pumps)
+    flow = ContinuousFlow(*pumps, fill_volume = 100, refill_rate = 20) # a refill of 5 s
+    assert flow.start(5)
+    time.sleep(1.0)
+    start = time.monotonic()
+    flow.stop()
+    assert time.monotonic() - start < 0.5
+    assert flow.error is None and not flow.is_running()
+    time.sleep(0.2)
+    assert sim.node(PORT, 2).v == 0 and sim.node(PORT, 3).v == 0
+
+def test_continuous_flow_hands_over(make):
+    pumps = [make(2), make(3)]
+    nemesys.home_pumps(pumps)
+    flow = ContinuousFlow(*pumps, fill_volume = 20, refill_rate = 40, handover_time = 0.5)
+    assert flow.start(10)
+    deadline = time.monotonic() + 5
+    while not flow.handovers and time.monotonic() < deadline:
+        time.sleep(0.1)
+    flow.stop()
+    assert flow.error is None and flow.handovers
+    assert flow.handovers[0].from_node == 2 and flow.handovers[0].to_node == 3
+
+def test_flow_program(make):
+    p = make(2)
+    p._reference_pos_lim()
+    result = FlowProgram(p, [(-10, 20), (-10, 40), (5, 20)]).run()
+    assert result.completed and None not in result.starts
+    assert result.stops == 2 # the two aspirations chained on the drive, the valve switch in between the dose
+    assert abs(p._get_position()/p.ul + 15) < 1
+
+def test_flow_program_stops_promptly(make):
+    p = make(2)
+    p._reference_pos_lim()
+    program = FlowProgram(p, [(-20, 20), (-100, 20)])
+    program.start()
+    time.sleep(1.5) # in the last segment of the chain
+    start = time.monotonic()
+    program.stop()
+    assert time.monotonic() - start < 0.5
+    assert not program.result.completed
+    assert p._get_position()/p.ul > -50
+
+def test_flow_stops_at_the_volume_limit(make):
+    p = make(2)
+    p._reference_pos_lim()
+    assert p.start_flow(-40, volume = 20) == 0
+    p._flow_guard.join(3)
+    time.sleep(0.2) # the landing move onto the limit
+    assert p._flow is None and not p.snapshot(max_age = 0).moving
+    assert abs(p._get_position()/p.ul + 20) < 1
+
+def test_stop_flow(make):
+    p = make(2)
+    p._reference_pos_lim()
+    assert p.start_flow(-20) == 0
+    time.sleep(0.3)
+    assert p.stop_flow() == 0
+    time.sleep(0.1)
+    assert p._flow is None and not p.snapshot(max_age = 0).moving
+
+def test_pvt_stream(make):
+    p = make(2)
+    p._reference_pos_lim()
+    rates = [-20.0]*40 # 20 ul/s for 2 s in points of 50 ms
+    stream = PvtStream(p, pvt_from_flow(rates, 50, 0.0))
+    assert stream.run()
+    assert not stream.underflow and stream.error is None
+    assert stream.sent == len(rates) + 1 and stream.telemetry
+    assert abs(p._get_position()/p.ul + 39.5) < 1 # the last point ramps down to rest
+
+def test_shadowed_mode_and_profile(sim, make):
+    p = make(2)
+    p._reference_pos_lim()
+    counts = []
+    for _ in range(2):
+        calls = sim.calls
+        assert p._prepare_move(-10, 40) == 0
+        counts.append(sim.calls - calls)
+    assert counts[1] == counts[0] - 2 # neither the mode nor the profile written again
+    p._invalidate_shadow()
+    calls = sim.calls
+    p._prepare_move(-10, 40)
+    assert sim.calls - calls == counts[0]
+
+def test_conversion_cache_hit(sim, make):
+    p = make(2)
+    calls = sim.calls
+    assert p._get_conversion_data() == (p.ul, p.uls)
+    assert sim.calls - calls == 1 # the serial number alone, the objects come from the cache
+    p._conversions.put(p._key, dict(p._conversions.get(p._key), serial = 0)) # cached for another drive on that node
+    calls = sim.calls
+    assert p._get_conversion_data() == (p.ul, p.uls)
+    assert sim.calls - calls == 5
+
+def test_reconnect_keeps_subscribers(make):
+    p = make(2)
+    poller = p._poll(50)
+    snapshots = queue.Queue()
+    poller.subscribe(snapshots)
+    p._reconnect()
+    received = snapshots.qsize()
+    time.sleep(0.3)
+    assert p.poller is poller and snapshots.qsize() > received
+    poller.stop()
+
+
+def test_record_move(make):
+    p = make(2)
+    p._reference_pos_lim()
+    recording = p._record_move(-10, 40, sampling_period_ms = 2.0)
+    assert recording is not None and recording.triggered
+    positions = list(recording.channels["position"])
+    assert len(positions) == len(recording.time) > 10
+    assert abs(positions[-1] + 10) < 1 # ul, the recording ends at the target
+
+def test_progress_reports(make):
+    reports = []
+    class Recorder(NullProgress):
+        def render(self, progress):
+            reports.append(progress)
+    p = make(2)
+    p._reference_pos_lim()
+    p.progress = Recorder(max_rate = 10)
+    p._move_to_position_speed(-20, 20) # 1 s
+    moving, final = reports[:-1], reports[-1]
+    assert final.done and final.reached and abs(final.position + 20) < 1
+    assert 5 <= len(moving) <= 12 and not any(report.done for report in moving)
+
+def test_valve_set_and_confirm(sim, make):
+    p = make(2)
+    assert p._set_valve(True, confirm = True) == 0
+    assert p._is_valve_open() and sim.node(PORT, 2).valve_open
+    calls = sim.calls
+    assert p._set_valve(True) == 0 and sim.calls == calls # commanded there already, no transaction
+    assert nemesys.set_valves([p, make(3)], False, confirm = True) == [0, 0]
+    assert not sim.node(PORT, 2).valve_open and not sim.node(PORT, 3).valve_open
+
+
+def test_home_pumps_skips_referenced(sim, make):
+    pumps = [make(2), make(3)]
+    results = nemesys.home_pumps(pumps)
+    assert all(r.attained and not r.skipped for r in results)
+    calls = sim.calls
+    results = nemesys.home_pumps(pumps)
+    assert all(r.attained and r.skipped for r in results)
+    assert sim.calls - calls == len(pumps) # one statusword read per pump
+
+
+def test_simulated_state_stays_in_memory(tmp_path, monkeypatch, make):
+    monkeypatch.setattr(nemesys, "state_path", str(tmp_path/"state.json"))
+    monkeypatch.setattr(nemesys, "conversion_cache_path", str(tmp_path/"conversion.json"))
+    p = make(2)
+    asyncio.run(AsyncNemesys(p).home())
+    assert p._persisted_state()["referenced"]
+    assert make(2).restored # same process, same simulator
+    assert not os.listdir(tmp_path)
+
+def test_state_written_in_the_background(tmp_path, monkeypatch):
+    path = tmp_path/"state.json"
+    store = nemesys._JsonStore(lambda: str(path))
+    replace = os.replace
+    writes = []
+    def slow_replace(src, dst):
+        time.sleep(0.3) # a slow disk
+        writes.append(dst)
+        replace(src, dst)
+    monkeypatch.setattr(nemesys.os, "replace", slow_replace)
+    start = time.monotonic()
+    for position in range(5):
+        store.put("port:2", {"position": position})
+    store.put("port:3", {"position": 0})
+    assert time.monotonic() - start < 0.1 # with the bus lock held, the caller does not wait for the file
+    assert store.get("port:2") == {"position": 4}
+    store.flush()
+    assert len(writes) <= 2 # the entries put during a write go in the next one
+    assert nemesys._JsonStore._read(str(path)) == {"port:2": {"position": 4}, "port:3": {"position": 0}}
+
+def test_tracer_stats(sim):
+    tracer = Tracer(ring_size = 100)
+    p = nemesys.Nemesys(2, PORT, backend = tracer.wrap(sim), progress = NullProgress())
+    try:
+        tracer.reset()
+        sim.inject_fault("VCS_MoveToPosition")
+        p._move_to_position_speed(-5, 40, wait = False)
+        p._get_position()
+        functions = tracer.stats()
+        assert functions["VCS_MoveToPosition"]["count"] == 1 and functions["VCS_MoveToPosition"]["errors"] == 1
+        assert functions["VCS_GetPositionIs"]["errors"] == 0
+        assert list(tracer.stats("node")) == ["/dev/ttyS4:2"]
+        assert tracer.recent(1, function = "VCS_MoveToPosition")[0].error == ERROR_INJECTED
+        assert tracer.summary()["calls"] == sum(stats["count"] for stats in functions.values())
+    finally:
+        p._bus_close()
+
+def test_record_and_replay(sim, tmp_path):
+    tracer = Tracer()
+    path = str(tmp_path/"session.nses")
+    with SessionRecorder(tracer, path) as recorder:
+        p = nemesys.Nemesys(2, PORT, backend = tracer.wrap(sim), progress = NullProgress())
+        p._reference_pos_lim()
+        p._set_valve(False)
+        p._move_to_position_speed(-10, 40)
+        p._bus_close()
+    result = replay(path, speed = None)
+    assert result.calls == recorder.calls > 0
+    assert result.divergences == 0, result.first_divergences